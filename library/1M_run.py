@@ -21,6 +21,6 @@ pl = [2, 3, 4, 5]
 inputs = get_input_dists(10, ['activity.npy', 'circadian.npy', 'frequency.npy'], '../inputs/')
 df = begin_unicity_series(max_size, step, sample_size,
                           inputs, pl, cs, sgs, seed,
-                          verbose=True, autosave='../tmp')
+                          verbose=True, autosave='../tmp', legacy_rng=True)
 
 df.to_csv('../results/1M_model_example.csv')
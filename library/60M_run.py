@@ -7,20 +7,25 @@ Author: Ali Farzanehfar
 
 from unicity_utils import begin_unicity_series
 from dataformat_utils import get_input_dists
+from planner import autotune
 
 
 max_size = int(6e7)
 step = int(5e5)
 sample_size = int(1e4)
 sgs = 10
-cs = int(1e5)
 seed = 1038
 pl = [2, 3, 4, 5]
+mem_budget = None  # bytes, None for the RAM of the machine
 
 
 inputs = get_input_dists(10, ['activity.npy', 'circadian.npy', 'frequency.npy'], '../inputs/')
+# the chunk size is tuned for this machine (see planner.autotune). Batches
+# stay at step users, as the users drawn with legacy_rng depend on them.
+cs = autotune(max_size, step, sample_size, inputs, mem_budget, pl, sgs,
+              step_list=[step])['cs']
 df = begin_unicity_series(max_size, step, sample_size,
                           inputs, pl, cs, sgs, seed,
-                          verbose=True, autosave='../tmp')
+                          verbose=True, autosave='../tmp', legacy_rng=True)
 
 df.to_csv('../results/60M_model.csv')
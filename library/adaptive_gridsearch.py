@@ -0,0 +1,416 @@
+"""
+This script runs the sensitivity analysis of gridsearch.py adaptively: it
+spends full runs only on the configurations of the grid which can move the
+envelope of the unicity curves (the smallest and largest unicity over all
+configurations at every population size), and reports the envelope of the
+whole grid.
+
+The configurations of the gridsearch form a regular grid over the frequency
+exponent and the two parameters of the activity beta function. The driver
+ - evaluates every configuration with a cheap pilot: a small population
+   shared by groups of configurations (begin_unicity_series_multi), so that
+   the differences between configurations are not blurred by independent
+   sampling noise,
+ - runs the corners of a coarse lattice of the grid in full, and
+   interpolates the curves of the other configurations multilinearly
+   between them,
+ - bounds the error of this interpolation at every configuration by that of
+   the pilot curves interpolated the same way, scaled by the ratio of the
+   spread of the full and pilot curves of the lattice. This is large where
+   the unicity surface bends, and vanishes where it is linear.
+ - runs in full the configurations whose interpolated curves, give or take
+   this bound, could reach more than tol beyond the envelope of the
+   configurations run so far, and repeats until none could.
+Configurations well inside the envelope are never run, whatever their error,
+and neither are those whose unicity is saturated at 1. For the grid of
+wrapped_gen_dist(0.7, 4, 16), evaluated up to 200k users with a pilot of
+40k users and tol=0.01, this ran 13 or 14 of the 64 configurations (with
+pilots of two seeds) and gave exactly the envelope of the full grid. The
+bound assumes that the surface bends at the same parameters at the size of
+the pilot and at the size of the full runs, and safety can be raised to
+widen it.
+
+Author: Ali Farzanehfar
+"""
+
+import numpy as np
+import pandas as pd
+import random as rnd
+import multiprocessing as mp
+import os
+from tqdm import tqdm as tq
+from unicity_utils import begin_unicity_series_multi
+from generate_gridsearch_params import wrapped_gen_dist
+from gridsearch import config_inputs, worker, results_dir
+from results_store import load_results, export_results
+from planner import autotune, heaviest_inputs
+
+
+def coarse_nodes(shape, ncoarse=2):
+    """Picks the indices of a coarse lattice along each axis of the grid,
+    evenly spaced and always including the first and last ones.
+
+    Inputs:
+        - shape: tuple of ints, the number of values of each parameter
+        - ncoarse: int, the number of lattice indices along each axis
+
+    Outputs:
+        - nodes: list of ndarrays, the lattice indices of each axis
+    -------
+    AF
+    """
+    return [np.unique(np.linspace(0, n - 1, min(ncoarse, n)).round().astype(
+        int)) for n in shape]
+
+
+def interpolate_lattice(node_vals, nodes, shape):
+    """Interpolates values known on a lattice of the grid multilinearly
+    (linearly along one axis after the other) to every point of the grid.
+
+    Inputs:
+        - node_vals: ndarray whose first axes are those of the lattice (see
+          coarse_nodes), and the others those of the values (e.g. the
+          population sizes and the numbers of points of unicity curves)
+        - nodes: list of ndarrays, output of coarse_nodes
+        - shape: tuple of ints, the shape of the grid
+
+    Outputs:
+        - ndarray of shape shape + node_vals.shape[len(nodes):]
+    -------
+    AF
+    """
+    vals = node_vals
+    for axis, (idx, n) in enumerate(zip(nodes, shape)):
+        pos = np.arange(n)
+        hi = np.clip(np.searchsorted(idx, pos), 1, max(len(idx) - 1, 1))
+        if len(idx) == 1:
+            lo = hi = np.zeros(n, dtype=int)
+            w = np.zeros(n)
+        else:
+            lo = hi - 1
+            w = (pos - idx[lo]) / (idx[hi] - idx[lo])
+        w = w.reshape((-1,) + (1,) * (vals.ndim - axis - 1))
+        vals = np.take(vals, lo, axis) * (1 - w) + np.take(vals, hi, axis) * w
+    return vals
+
+
+def pilot_errors(pilot, shape, nodes):
+    """Largest difference between the pilot curves and their interpolation
+    from the lattice, for each configuration and number of points.
+
+    Inputs:
+        - pilot: ndarray of shape (number of configurations, number of
+          population sizes, number of points), the pilot curves, with the
+          configurations in the order of the grid
+        - shape: tuple of ints, the shape of the grid
+        - nodes: list of ndarrays, output of coarse_nodes
+
+    Outputs:
+        - ndarray of shape (number of configurations, number of points)
+    -------
+    AF
+    """
+    grid = pilot.reshape(tuple(shape) + pilot.shape[1:])
+    interp = interpolate_lattice(grid[np.ix_(*nodes)], nodes, shape)
+    return np.abs(grid - interp).reshape(pilot.shape).max(axis=1)
+
+
+def error_scale(full_nodes, pilot_nodes):
+    """Ratio of the spread of the full curves of the lattice to that of their
+    pilot curves, for each number of points. The interpolation errors of the
+    pilot are scaled by it to bound those of the full curves. Numbers of
+    points at which the pilot does not spread take the largest ratio.
+
+    Inputs:
+        - full_nodes, pilot_nodes: ndarrays of shape (number of lattice
+          configurations, number of population sizes, number of points)
+
+    Outputs:
+        - ndarray of floats, one per number of points
+    -------
+    AF
+    """
+    full_spread = (full_nodes.max(axis=0) - full_nodes.min(axis=0)).max(
+        axis=0)
+    pilot_spread = (pilot_nodes.max(axis=0) - pilot_nodes.min(axis=0)).max(
+        axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = full_spread / pilot_spread
+    known = np.isfinite(scale)
+    scale[~known] = scale[known].max(initial=1.)
+    return scale
+
+
+def envelope_candidates(estimates, bounds, run, curves, tol):
+    """Finds the configurations not run yet which could move the envelope of
+    the configurations run by more than tol.
+
+    Inputs:
+        - estimates: ndarray of shape (number of configurations, number of
+          population sizes, number of points), the interpolated curves
+        - bounds: ndarray of shape (number of configurations, number of
+          points), the bound on the error of the estimates
+        - run: ndarray of bools, whether each configuration was run
+        - curves: ndarray, the full curves of the configurations run, in
+          the same format as estimates
+        - tol: float, the error on the envelope (in unicity) which is
+          accepted
+
+    Outputs:
+        - ndarray of bools, one per configuration
+    -------
+    AF
+    """
+    high = np.minimum(estimates + bounds[:, None, :], 1)
+    low = np.maximum(estimates - bounds[:, None, :], 0)
+    reach = (high > curves.max(axis=0) + tol) | \
+        (low < curves.min(axis=0) - tol)
+    return ~run & reach.any(axis=(1, 2))
+
+
+def sensitivity_envelope(curves, index, pl, run=None):
+    """Smallest and largest unicity over configurations.
+
+    Inputs:
+        - curves: ndarray of shape (number of configurations, number of
+          population sizes, number of points)
+        - index: the population sizes
+        - pl: list of ints, the numbers of points
+        - run: ndarray of bools or None, whether the curve of each
+          configuration was run, rather than interpolated (default: all of
+          them were run)
+
+    Outputs:
+        - envelope: pandas.DataFrame() indexed by the population values, with
+          (number of points, statistic) columns holding the minimum and
+          maximum unicity, the ids of the configurations reaching them
+          ('argmin' and 'argmax'), and whether these were run ('min_run' and
+          'max_run'). Only the configurations run have a curve in the results
+          store, under 'iter_{id}'.
+    -------
+    AF
+    """
+    run = np.ones(len(curves), dtype=bool) if run is None else run
+    stats = {}
+    for j, point in enumerate(pl):
+        argmin = curves[:, :, j].argmin(axis=0)
+        argmax = curves[:, :, j].argmax(axis=0)
+        stats[(point, 'min')] = curves[:, :, j].min(axis=0)
+        stats[(point, 'max')] = curves[:, :, j].max(axis=0)
+        stats[(point, 'argmin')] = argmin + 1
+        stats[(point, 'argmax')] = argmax + 1
+        stats[(point, 'min_run')] = run[argmin]
+        stats[(point, 'max_run')] = run[argmax]
+    return pd.DataFrame(stats, index=index)
+
+
+def pilot_worker(params):
+    """Computes the pilot curves of a group of configurations on a shared
+    population.
+    -------
+    AF
+    """
+    max_size, step, sample_size, group_pars, pl, cs, sgs, seed = params
+    inputs_list = [config_inputs(pars, sgs) for pars in group_pars]
+    dfs = begin_unicity_series_multi(max_size, step, sample_size, inputs_list,
+                                     pl, cs, sgs, seed)
+    return [df[pl].values for df in dfs]
+
+
+def pilot_curves(allpars, max_size, step, sample_size, pl, cs, sgs, nproc,
+                 group_size=8, seed=1):
+    """Computes the pilot curves of every configuration, in groups of at most
+    group_size configurations (the users of a step of all the configurations
+    of a group are in memory at once) spread over nproc processes. All
+    groups use the same seed, as in gridsearch.shared_worker, so that they
+    share their sample users and the uniforms behind the activity of the
+    users.
+
+    Outputs:
+        - ndarray of shape (len(allpars), number of population sizes,
+          len(pl))
+    -------
+    AF
+    """
+    groups = np.array_split(np.arange(len(allpars)),
+                            -(-len(allpars) // group_size))
+    nproc = min(nproc, len(groups))
+    data = [[max_size, step, sample_size, [allpars[i] for i in g], pl, cs,
+             sgs, seed] for g in groups]
+    if nproc > 1:
+        with mp.Pool(nproc) as pool:
+            res = pool.map(pilot_worker, data)
+    else:
+        res = [pilot_worker(d) for d in data]
+    return np.array([curve for group in res for curve in group])
+
+
+def run_configs(allpars, ids, max_size, step, sample_size, pl, cs, sgs,
+                max_nprc):
+    """Runs configurations in full as gridsearch.py does, skipping those whose
+    results are already complete in the store, so that an interrupted search
+    can be resumed.
+
+    Inputs:
+        - allpars: list, the parameters of all configurations
+        - ids: ndarray of ints, the indices of the configurations to run
+
+    Outputs:
+        - curves: dict with the configuration indices as keys and ndarrays of
+          shape (number of population sizes, len(pl)) as values
+    -------
+    AF
+    """
+    directory = results_dir(max_size)
+    path = os.path.join(directory, 'results.sqlite')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    nsteps = len(np.arange(step, max_size + step, step))
+
+    def completed():
+        res = load_results(path) if os.path.exists(path) else {}
+        return {i: res[('iter_{}'.format(i + 1), 0)][pl].values for i in ids
+                if len(res.get(('iter_{}'.format(i + 1), 0), [])) == nsteps}
+
+    done = completed()
+    todo = [i for i in ids if i not in done]
+    if todo:
+        data = [[max_size, step, sample_size, allpars[i], pl, cs, sgs, i + 1]
+                for i in todo]
+        mypool = mp.Pool(min(max_nprc, len(todo)))
+        jobs = [mypool.apply_async(worker, args=(elem,)) for elem in data]
+        mypool.close()
+        for proc in tq(jobs):
+            proc.get()
+        mypool.join()
+        done = completed()
+    return done
+
+
+def adaptive_gridsearch(allpars, shape, max_size, step, sample_size, pl, cs,
+                        sgs, max_nprc, pilot_size, pilot_step, pilot_sample,
+                        pilot_group=8, tol=0.01, ncoarse=2, safety=1.,
+                        verbose=True):
+    """Computes the sensitivity envelope of a grid of configurations with full
+    runs of only part of them, see the top of the file.
+
+    Inputs:
+        - allpars: list, the parameters of the configurations, in the order
+          of wrapped_gen_dist (the last parameter varying fastest)
+        - shape: tuple of ints, the number of values of each parameter, e.g.
+          (number of frequency values, number of values of a, number of
+          values of b)
+        - max_size, step, sample_size, pl, cs, sgs: see begin_unicity_series,
+          for the full runs
+        - max_nprc: int, the maximum number of processes
+        - pilot_size, pilot_step, pilot_sample: max_size, step and
+          sample_size of the pilot
+        - pilot_group: int, see the group_size of pilot_curves
+        - tol: float, see envelope_candidates
+        - ncoarse: int, see coarse_nodes
+        - safety: float, factor applied to the error bounds
+
+    Outputs:
+        - envelope: pandas.DataFrame(), see sensitivity_envelope, from the
+          full curves of the configurations run and the interpolated curves
+          of the others. An extreme can be reached by an interpolated curve
+          (within tol of the runs), see the 'min_run' and 'max_run' columns.
+        - report: pandas.DataFrame() with one row per configuration (indexed
+          by its run id), holding its pilot interpolation error, the bound
+          on the error of its interpolated curve (both the largest over the
+          numbers of points, 0 for the lattice) and whether it was run
+    -------
+    AF
+    """
+    fprint = print if verbose else lambda *x, **y: None
+    assert np.prod(shape) == len(allpars), 'shape does not match allpars'
+    fprint('Pilot of {} configurations...'.format(len(allpars)))
+    pilot = pilot_curves(allpars, pilot_size, pilot_step, pilot_sample, pl,
+                         cs, sgs, max_nprc, pilot_group)
+
+    nodes = coarse_nodes(shape, ncoarse)
+    node_ids = np.ravel_multi_index(np.meshgrid(*nodes, indexing='ij'),
+                                    shape).ravel()
+    errors = pilot_errors(pilot, shape, nodes)
+    fprint('Running the {} configurations of the lattice...'.format(
+        len(node_ids)))
+    run = np.zeros(len(allpars), dtype=bool)
+    run[node_ids] = True
+    done = run_configs(allpars, node_ids, max_size, step, sample_size, pl, cs,
+                       sgs, max_nprc)
+    node_vals = np.array([done[i] for i in node_ids])
+    estimates = interpolate_lattice(
+        node_vals.reshape(tuple(len(n) for n in nodes) + node_vals.shape[1:]),
+        nodes, shape).reshape((len(allpars),) + node_vals.shape[1:])
+    bounds = safety * errors * error_scale(node_vals, pilot[node_ids])
+
+    # every round of runs can widen the envelope
+    while True:
+        ids = np.flatnonzero(run)
+        todo = np.flatnonzero(envelope_candidates(
+            estimates, bounds, run, np.array([done[i] for i in ids]), tol))
+        if len(todo) == 0:
+            break
+        fprint('Running {} configurations near the envelope...'.format(
+            len(todo)))
+        run[todo] = True
+        done.update(run_configs(allpars, todo, max_size, step, sample_size,
+                                pl, cs, sgs, max_nprc))
+
+    curves = estimates
+    for i in ids:
+        curves[i] = done[i]
+        bounds[i] = 0
+    pop_list = np.arange(step, max_size + step, step)
+    envelope = sensitivity_envelope(curves, pop_list, pl, run)
+    report = pd.DataFrame({'pilot_error': errors.max(axis=1),
+                           'bound': bounds.max(axis=1), 'run': run},
+                          index=np.arange(1, len(allpars) + 1))
+    fprint('Full runs: {} of {}, largest error bound of the interpolated '
+           'configurations: {:.4f}'.format(
+               len(ids), len(allpars), bounds.max(initial=0)))
+    return envelope, report
+
+
+if __name__ == '__main__':
+    emthresh = 0.7
+    nf, na = 4, 16
+    allpars = wrapped_gen_dist(emthresh, nf, na)
+    side = int(round(na ** 0.5))
+    shape = (nf, side, side)
+
+    # setting seed
+    rnd.seed(1370)
+    np.random.seed(1370)
+
+    max_size = int(6e7)
+    step = int(5e5)
+    sample_size = int(1e4)
+    pl = [2, 3, 4, 5]
+    sgs = 10
+    max_nprc = 12
+    mem_budget = None  # bytes, None for the RAM of the machine
+
+    # the pilot costs about pilot_size / max_size of a full run per
+    # configuration
+    pilot_size = int(1e6)
+    pilot_step = int(1e5)
+    pilot_sample = int(1e4)
+    pilot_group = 8  # configurations sharing the population of a pilot
+    tol = 0.01
+
+    # the chunk size is tuned on the configuration with the most records per
+    # user (see planner.heaviest_inputs)
+    nproc = min(max_nprc, len(allpars))
+    cs = autotune(max_size, step, sample_size,
+                  heaviest_inputs([config_inputs(pars, sgs)
+                                   for pars in allpars]), mem_budget, pl, sgs,
+                  nprocs=nproc, step_list=[step])['cs']
+
+    envelope, report = adaptive_gridsearch(
+        allpars, shape, max_size, step, sample_size, pl, cs, sgs, max_nprc,
+        pilot_size, pilot_step, pilot_sample, pilot_group, tol)
+    directory = results_dir(max_size)
+    export_results(os.path.join(directory, 'results.sqlite'), directory)
+    envelope.to_csv(os.path.join(directory, 'adaptive_envelope.csv'))
+    report.to_csv(os.path.join(directory, 'adaptive_report.csv'))
@@ -12,10 +12,11 @@ from tqdm import tqdm as tq
 import pickle
 import datetime
 from collections import defaultdict
+from compact_tracks import CompactTracks
 
 
 def get_u2p(rootdir, start_date, end_date,
-            max_pop=False, uselist=False):
+            max_pop=False, uselist=False, compact=False, lants=None):
     """
     This function loads up pre-processed pickled arrays in pre-specified date
     ranges.
@@ -32,6 +33,10 @@ def get_u2p(rootdir, start_date, end_date,
     file runs smoothly.
     
     The format of the dates must be YYYY-MM-DD as one string. 
+
+    With compact=True, every array is encoded as soon as it is loaded and a
+    compact_tracks.CompactTracks is returned instead of the dictionary, using
+    about 20 times less memory. It needs lants, the number of antennas.
     -------
     AF
     """
@@ -39,6 +44,11 @@ def get_u2p(rootdir, start_date, end_date,
     names = list(map(lambda x: rootdir + x, narrs))
     a = []
     print('loading arrays')
+    if compact:
+        assert lants is not None and max_pop is False and not uselist
+        return CompactTracks.concat([
+            CompactTracks.from_lists(pickle.load(open(name, 'rb')), lants)
+            for name in tq(names)])
     for name in tq(names):
         a += pickle.load(open(name, 'rb'))
 
@@ -208,6 +218,29 @@ def get_pool_data(max_size, step, dist_pars, sample_size=int(1e4),
     return data
 
 
+def gather_ranges(starts, lengths):
+    """Vectorised equivalent of np.concatenate([np.arange(s, s + l) ...]) for
+    arrays of starts and lengths.
+
+    Inputs:
+        - starts: ndarray of ints, the start of each range
+        - lengths: ndarray of ints, the length of each range
+
+    Outputs:
+        - ndarray of int64 containing all the ranges back to back
+    -------
+    AF
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total = lengths.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    offsets = np.repeat(np.asarray(starts, dtype=np.int64) - ends + lengths,
+                        lengths)
+    return offsets + np.arange(total, dtype=np.int64)
+
+
 def sparsify_mat_list(mat_list):
     """Takes a list of inputs that can feed into
     scipy.sparse.csr_matrix((data, (row, col), shape)) and returns a list of
@@ -228,6 +261,169 @@ def sparsify_mat_list(mat_list):
     return res
 
 
+def stack_queries(sample_dict):
+    """Concatenates the sample matrices of all numbers of points column-wise
+    into a single query matrix.
+
+    Inputs:
+        - sample_dict: dict of scipy.sparse.csr_matrix() objects where keys are
+          number of points
+
+    Outputs:
+        - query: scipy.sparse.csc_matrix, the hstacked sample matrices. It is
+          stored by column so that its size does not depend on the number of
+          space-time points.
+        - colk: ndarray, the number of points of each column of query
+    -------
+    AF
+    """
+    data, rows, cols, colk = [], [], [], []
+    ncols = 0
+    for point in sample_dict:
+        smat = sample_dict[point].tocoo()
+        data.append(smat.data)
+        rows.append(smat.row)
+        cols.append(smat.col + ncols)
+        colk.append(np.full(smat.shape[1], point))
+        ncols += smat.shape[1]
+    shape = (smat.shape[0], ncols)
+    query = sps.csc_matrix((np.concatenate(data), (np.concatenate(rows),
+                                                   np.concatenate(cols))),
+                           shape=shape)
+    return query, np.concatenate(colk)
+
+
+def hstack_queries(queries):
+    """Concatenates several outputs of stack_queries column-wise, so that
+    they are evaluated with a single multiplication.
+
+    Inputs:
+        - queries: list of outputs of stack_queries
+
+    Outputs:
+        - query, colk: see stack_queries
+    -------
+    AF
+    """
+    if len(queries) == 1:
+        return queries[0]
+    return sps.hstack([q for q, _ in queries], format='csc'), \
+        np.concatenate([colk for _, colk in queries])
+
+
+def multiply_query(res, query):
+    """Multiplies every matrix of res by the query matrix and vstacks the
+    results.
+
+    Inputs:
+        - res: list of scipy.sparse.csr_matrix()
+        - query: scipy.sparse matrix, e.g. output of stack_queries
+
+    Outputs:
+        - scipy.sparse.csc_matrix() of shape (sum of rows of res, number of
+          columns of query)
+    -------
+    AF
+    """
+    query = query.tocsr()
+    return sps.vstack([smat.dot(query) for smat in res], format='csc')
+
+
+def column_matches(prod, colk):
+    """Counts, for each column of a product returned by multiply_query, the
+    number of rows which contain all of the points of the query column.
+
+    Inputs:
+        - prod: scipy.sparse.csc_matrix(), output of multiply_query
+        - colk: ndarray, the number of points of each column of the query
+
+    Outputs:
+        - ndarray of ints, the number of matching rows for each column
+    -------
+    AF
+    """
+    ncols = prod.shape[1]
+    cols = np.repeat(np.arange(ncols), np.diff(prod.indptr))
+    return np.bincount(cols[prod.data == colk[cols]], minlength=ncols)
+
+
+def multiply_matches(res, query, colk):
+    """Counts, for each column of the query, the number of rows of the
+    matrices of res which contain all of the points of the column. This gives
+    the same result as column_matches(multiply_query(res, query), colk), but
+    the product of each matrix is reduced into the counts as soon as it is
+    computed and then discarded, so the memory used does not grow with the
+    number of matrices.
+
+    Inputs:
+        - res: list of scipy.sparse.csr_matrix()
+        - query, colk: see stack_queries
+
+    Outputs:
+        - ndarray of int32, the number of matching rows for each column
+    -------
+    AF
+    """
+    # int16 products cannot overflow, a column has at most one point per hour
+    query = query.tocsr().astype(np.int16)
+    ncols = query.shape[1]
+    matches = np.zeros(ncols, dtype=np.int32)
+    for smat in res:
+        prod = smat.dot(query)
+        hits = prod.indices[prod.data == colk[prod.indices]]
+        matches += np.bincount(hits, minlength=ncols).astype(np.int32)
+    return matches
+
+
+def nested_matches(res, query, colk):
+    """Same as multiply_matches, for queries of nested point sets (see
+    unicity_utils.get_random_points): the i-th column with k points holds
+    the points of the i-th column with fewer points, for every k. A row
+    holding all the points of a column then holds those of the smaller
+    columns, so only the columns with the fewest points are multiplied by the
+    matrices of res. The rows matching them are the candidates for the next
+    number of points, whose columns are evaluated on the candidate rows only,
+    and so on, the candidates shrinking at every number of points.
+
+    Inputs:
+        - res: list of scipy.sparse.csr_matrix()
+        - query, colk: see stack_queries, with as many columns for each
+          number of points
+
+    Outputs:
+        - ndarray of int32, the number of matching rows for each column
+    -------
+    AF
+    """
+    levels = [np.flatnonzero(colk == k) for k in np.unique(colk)]
+    assert all(len(cols) == len(levels[0]) for cols in levels), \
+        'Nested queries have as many columns for each number of points'
+    query = query.astype(np.int16)
+    base = query[:, levels[0]].tocsr()
+    # one row per query column, to pair the columns with candidate rows
+    query_t = query.T.tocsr()
+    ncols = query.shape[1]
+    matches = np.zeros(ncols, dtype=np.int32)
+    for smat in res:
+        prod = smat.dot(base)
+        rows = np.repeat(np.arange(prod.shape[0]), np.diff(prod.indptr))
+        hit = prod.data == colk[levels[0]][prod.indices]
+        rows, pos = rows[hit], prod.indices[hit]
+        matches += np.bincount(levels[0][pos], minlength=ncols).astype(
+            np.int32)
+        for cols in levels[1:]:
+            if len(rows) == 0:
+                break
+            # the product of each candidate row with its column
+            vals = np.asarray(smat[rows].multiply(
+                query_t[cols[pos]]).sum(axis=1)).ravel()
+            keep = vals == colk[cols[pos]]
+            rows, pos = rows[keep], pos[keep]
+            matches += np.bincount(cols[pos], minlength=ncols).astype(
+                np.int32)
+    return matches
+
+
 def vstack_multiply(res, sample_dict):
     """Takes in a list of sparse matrices and a dict of sparse matrices. Returns
     a dictionary with the same keys of 'sample_dict' where each entry is the
@@ -235,34 +431,230 @@ def vstack_multiply(res, sample_dict):
     all matices in the matrix list were vstacked and multiplied by the other
     matrix.
 
+    The sample matrices are first stacked into one query matrix (see
+    stack_queries) so that each matrix of res is multiplied only once,
+    whatever the number of keys in sample_dict.
+
     Inputs:
         - res: list of scipy.sparse.csr_matrix()
         - sample_dict: dict of scipy.sparse.csr_matrix() objects where keys are
           number of points
 
     Outputs:
-        - ps: dict of scipy.sparse.csr_matrix() which is the dot product of all
+        - ps: dict of scipy.sparse.csc_matrix() which is the dot product of all
           the res with sample dict
     -------
     AF
     """
+    query, colk = stack_queries(sample_dict)
+    prod = multiply_query(res, query)
     ps = {}
+    start = 0
     for point in sample_dict:
-        s = sample_dict[point]
-        ps_list = []
-        for smat in res:
-            ps_list.append(smat.dot(s))
-        ps[point] = sps.vstack(ps_list)
+        end = start + sample_dict[point].shape[1]
+        ps[point] = prod[:, start:end]
+        start = end
     return ps
 
 
+def query_last_use(queries_list):
+    """Finds, for every space-time point, the last step whose sample queries
+    contain it.
+
+    Inputs:
+        - queries_list: list (one element per configuration) of lists (one
+          element per step) of outputs of stack_queries
+
+    Outputs:
+        - last_use: ndarray of int32, -1 for the points which are never
+          queried
+    -------
+    AF
+    """
+    last_use = np.full(queries_list[0][0][0].shape[0], -1, dtype=np.int32)
+    for queries in queries_list:
+        for step, (query, _) in enumerate(queries):
+            touched = query.tocoo().row
+            last_use[touched] = np.maximum(last_use[touched], step)
+    return last_use
+
+
+def get_projection(last_use, first):
+    """Computes the projection of the space-time points onto the compact set
+    of points queried by the samples of steps first and above. Points outside
+    this set can never contribute to a match and are dropped.
+
+    Inputs:
+        - last_use: ndarray, output of query_last_use
+        - first: int, the first step whose samples are evaluated
+
+    Outputs:
+        - col_map: ndarray of int32, the compact index of every point, -1 for
+          the points which are dropped
+        - q_rows: ndarray, the points which are kept, in compact order (i.e.
+          the rows to keep in the query matrices)
+    -------
+    AF
+    """
+    q_rows = np.flatnonzero(last_use >= first)
+    col_map = np.full(len(last_use), -1, dtype=np.int32)
+    col_map[q_rows] = np.arange(len(q_rows), dtype=np.int32)
+    return col_map, q_rows
+
+
+def project_u2p(u2p, col_map):
+    """Projects the columns of u2p (see resampler) with col_map (see
+    get_projection), dropping the points which are mapped to -1.
+
+    Inputs:
+        - u2p: 5-tuple, output of resampler
+        - col_map: ndarray, output of get_projection
+
+    Outputs:
+        - 5-tuple in the same format as u2p, where the last element now holds
+          the number of points kept for each user.
+    -------
+    AF
+    """
+    data, rows, cols, shape, _ = u2p
+    cols = col_map[cols]
+    keep = cols >= 0
+    rows = rows[keep]
+    counts = np.bincount(rows, minlength=shape[0]).astype(np.int32)
+    ncols = np.count_nonzero(col_map >= 0)
+    return data[keep], rows, cols[keep], (shape[0], ncols), counts
+
+
+def concat_u2p(u2ps):
+    """Stacks the users of several u2p (see resampler), in order.
+
+    Inputs:
+        - u2ps: list of 5-tuples, outputs of resampler with the same number
+          of columns
+
+    Outputs:
+        - 5-tuple in the same format as u2p
+    -------
+    AF
+    """
+    data, _, cols, shapes, acts = zip(*u2ps)
+    rand_acts = np.concatenate(acts)
+    rows = np.repeat(np.arange(len(rand_acts), dtype=np.int32), rand_acts)
+    return np.concatenate(data), rows, np.concatenate(cols), \
+        (len(rand_acts), shapes[0][1]), rand_acts
+
+
+def get_hour_map(nhours, width):
+    """Maps every hour to a bin of 'width' consecutive hours (e.g. 24 for
+    daily resolution).
+
+    Inputs:
+        - nhours: int, the number of hours (length of the circadian
+          distribution)
+        - width: int, the number of hours in a bin
+
+    Outputs:
+        - ndarray of int32, the bin of each hour
+    -------
+    AF
+    """
+    return (np.arange(nhours) // width).astype(np.int32)
+
+
+def resolution_size(resolution):
+    """Number of space-time points of a resolution (see coarsen_columns).
+    -------
+    AF
+    """
+    ant_map, hour_map = resolution
+    return (int(ant_map.max()) + 1) * (int(hour_map.max()) + 1)
+
+
+def coarsen_columns(cols, resolution, lants):
+    """Maps space-time points (t * lants + x, see resampler) to the points of
+    a coarser resolution.
+
+    Inputs:
+        - cols: ndarray of ints, space-time points
+        - resolution: 2-tuple (ant_map, hour_map) of ndarrays of ints giving
+          the cell of each antenna (see geoloc_utils.get_antenna_map) and the
+          bin of each hour (see get_hour_map)
+        - lants: int, the total number of antennas
+
+    Outputs:
+        - ndarray of int32, the coarse points, hour_bin * ncells + cell
+    -------
+    AF
+    """
+    ant_map, hour_map = resolution
+    ncells = int(ant_map.max()) + 1
+    return (hour_map[cols // lants] * ncells +
+            ant_map[cols % lants]).astype(np.int32)
+
+
+def coarsen_query(query, resolution, lants):
+    """Maps the rows of a query to a coarser resolution. Points of a sample
+    which fall in the same coarse point are merged into one entry holding
+    their number, so that the product with a binary population matrix is
+    still equal to the number of points of the column (colk) exactly when a
+    user holds all of them.
+
+    Inputs:
+        - query: 2-tuple, output of stack_queries
+        - resolution, lants: see coarsen_columns
+
+    Outputs:
+        - query, colk: see stack_queries
+    -------
+    AF
+    """
+    query, colk = query
+    coo = query.tocoo()
+    shape = (resolution_size(resolution), query.shape[1])
+    return sps.csc_matrix((coo.data, (coarsen_columns(coo.row, resolution,
+                                                      lants), coo.col)),
+                          shape=shape), colk
+
+
+def coarsen_u2p(u2p, resolution, lants, q_rows=None):
+    """Maps the columns of u2p to a coarser resolution, merging the points of
+    a user which fall in the same coarse point.
+
+    Inputs:
+        - u2p: 5-tuple, output of resampler or project_u2p
+        - resolution, lants: see coarsen_columns
+        - q_rows: ndarray or None, if u2p was projected, the original point of
+          each of its columns (see get_projection)
+
+    Outputs:
+        - 5-tuple in the same format as u2p, over the points of the
+          resolution. The last element holds the number of coarse points of
+          each user.
+    -------
+    AF
+    """
+    _, rows, cols, shape, _ = u2p
+    if q_rows is not None:
+        cols = q_rows[cols]
+    ncoarse = resolution_size(resolution)
+    keys = np.unique(rows.astype(np.int64) * ncoarse +
+                     coarsen_columns(cols, resolution, lants))
+    rows = (keys // ncoarse).astype(np.int32)
+    cols = (keys % ncoarse).astype(np.int32)
+    counts = np.bincount(rows, minlength=shape[0]).astype(np.int32)
+    return np.ones(len(keys), dtype=np.int8), rows, cols, \
+        (shape[0], ncoarse), counts
+
+
 def chunkify_mat_list(u2p, cs):
     """splits up u2p (returned by resampler) into parts of cs size and returns
     them in a list to be converted to sparse matrices.
 
     Inputs:
         - u2p: 5-tuple, output of resampler
-        - cs: int, representing the number of users in each chunk
+        - cs: int, representing the number of users in each chunk. If it
+          does not divide the number of users, the last chunk holds the
+          remaining users.
 
     Outputs:
         - mat_list: list of inputs to be fed into scipy.sparse.csr_matrix.
@@ -273,34 +665,18 @@ def chunkify_mat_list(u2p, cs):
     data, rows, cols, shape, rand_acts = u2p
     n, p = shape
 
-    # make sure the matrices are full
-    assert n % cs == 0
-
-    start_col_inds = np.cumsum(rand_acts, dtype=np.int32)
-    nchunks = n // cs
-
-    cshape = (cs, p)
+    # the users and the nonzeros of each chunk are contiguous
+    bounds = np.append(np.arange(0, n, cs), n)
+    starts = np.concatenate([[0], np.cumsum(rand_acts, dtype=np.int64)])
+    starts = starts[bounds]
 
     mat_list = []
-    cchunk = 0
-    for chunk in range(nchunks):
-        cacts = rand_acts[cchunk:cchunk + cs]
-        nnz = cacts.sum()
-
-        crows = np.ones(nnz, dtype=np.int32)
-        ccols = np.zeros(nnz, dtype=np.int32)
-        cdata = np.ones(nnz, dtype=np.int8)
-        mat_list.append((cdata, crows, ccols, cshape, cacts))
-
-        cind = 0
-        for user in range(cs):
-            ind = cchunk + user
-            a = cacts[user]
-            crows[cind:cind + a] = user * crows[cind:cind + a]
-            start = start_col_inds[ind]
-            ccols[cind:cind + a] = cols[start - a:start]
-            cind += a
-        cchunk += cs
+    for u0, u1, s0, s1 in zip(bounds[:-1], bounds[1:], starts[:-1],
+                              starts[1:]):
+        cacts = rand_acts[u0:u1]
+        crows = np.repeat(np.arange(u1 - u0, dtype=np.int32), cacts)
+        cdata = np.ones(s1 - s0, dtype=np.int8)
+        mat_list.append((cdata, crows, cols[s0:s1], (u1 - u0, p), cacts))
     return mat_list
 
 
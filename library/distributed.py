@@ -0,0 +1,285 @@
+"""
+This file contains a coordinator/worker version of begin_unicity_series which
+can be spread over several machines.
+
+The population steps of a unicity series are independent tasks: step i only
+needs the users it generates and the sample (drawn from the users of the first
+step) to produce the match counts of the sample queries of steps i and above.
+The coordinator hands out step indices over TCP (multiprocessing.connection)
+and sums the integer match counts it receives, which gives the same result
+whatever the number of workers and the order in which tasks complete, since
+every step is generated from its own random stream (see
+unicity_utils.get_streams), and is that of begin_unicity_series with the
+same seed. Tasks held by a worker whose connection drops (or which exceed
+task_timeout) are handed out again.
+
+A worker on another machine is started with:
+    UNICITY_AUTHKEY=KEY python distributed.py HOST PORT
+where KEY is the key printed by the coordinator, in hexadecimal (or with
+UNICITY_AUTHKEY_FILE naming a file holding it). The messages are pickled, so
+anyone holding the key can run code on the coordinator and the workers: the
+key is random unless one is given, and is never passed on the command line.
+
+Author: Ali Farzanehfar
+"""
+
+import numpy as np
+import pandas as pd
+import threading
+import multiprocessing as mp
+import os
+import sys
+import time
+from collections import deque
+from multiprocessing.connection import Listener, Client
+from multiprocessing import AuthenticationError
+from unicity_utils import get_population_generator, step_match_counts
+from unicity_utils import get_sample_queries, get_streams
+from dataformat_utils import query_last_use, get_projection, project_u2p
+from results_store import ResultsStore
+
+
+def new_authkey():
+    """Draws a random key for the connections of a coordinator or service.
+    -------
+    AF
+    """
+    return os.urandom(32)
+
+
+def read_authkey():
+    """Reads the key of the connections from the UNICITY_AUTHKEY environment
+    variable, or from the file named by UNICITY_AUTHKEY_FILE, in hexadecimal.
+    -------
+    AF
+    """
+    key = os.environ.get('UNICITY_AUTHKEY')
+    if key is None and os.environ.get('UNICITY_AUTHKEY_FILE'):
+        with open(os.environ['UNICITY_AUTHKEY_FILE']) as f:
+            key = f.read()
+    if not key or not key.strip():
+        raise ValueError('Set UNICITY_AUTHKEY or UNICITY_AUTHKEY_FILE to '
+                         'the key of the coordinator or service')
+    return bytes.fromhex(key.strip())
+
+
+def get_job(max_size, step, sample_size, inputs, pl=[2, 3, 4, 5],
+            cs=int(1e4), sgs=10, seed=0, cluster_bank=None,
+            fast_sampling=False):
+    """Packs the parameters of a unicity series into a job for the
+    coordinator. See begin_unicity_series for the meaning of the inputs.
+    -------
+    AF
+    """
+    pop_list = np.arange(step, max_size + step, step, dtype=np.int32)
+    step_seqs, sample_seqs, _ = get_streams(seed, len(pop_list))
+    return {'step': step, 'sample_size': sample_size, 'inputs': inputs,
+            'pl': list(pl), 'cs': cs, 'sgs': sgs,
+            'cluster_bank': cluster_bank, 'fast_sampling': fast_sampling,
+            'pop_list': pop_list, 'sample_seqs': sample_seqs[0],
+            'step_seqs': step_seqs}
+
+
+def _step_rng(job, iii):
+    return np.random.default_rng(job['step_seqs'][iii])
+
+
+def _prepare(job):
+    """Loads the inputs of a job, generates the users of the first step, from
+    which all samples are drawn, and the sample queries.
+    -------
+    AF
+    """
+    new_population = get_population_generator(
+        [job['inputs']], job['step'], job['sgs'], job['cluster_bank'],
+        job['fast_sampling'])
+    s_u2p = new_population(rng=_step_rng(job, 0))[0]
+    queries = get_sample_queries(s_u2p, job['sample_seqs'],
+                                 job['sample_size'], job['pl'],
+                                 job['fast_sampling'])
+    return new_population, s_u2p, queries, query_last_use([queries])
+
+
+def run_task(job, state, iii):
+    """Computes the match counts of population step iii of a job.
+
+    Inputs:
+        - job: dict, output of get_job
+        - state: 4-tuple, output of _prepare
+        - iii: int, index of the step
+
+    Outputs:
+        - dict of ndarrays of shape (nsteps - iii, sample_size), see
+          unicity_utils.step_match_counts
+    -------
+    AF
+    """
+    new_population, s_u2p, queries, last_use = state
+    col_map, q_rows = get_projection(last_use, iii)
+    if iii == 0:
+        u2p = project_u2p(s_u2p, col_map)
+    else:
+        u2p = new_population(col_map, _step_rng(job, iii))[0]
+    return step_match_counts(u2p, queries[iii:], job['pl'], job['cs'],
+                             q_rows)
+
+
+def run_worker(address, authkey):
+    """Connects to a coordinator and processes tasks until told to stop.
+
+    Inputs:
+        - address: 2-tuple (host, port) of the coordinator
+        - authkey: bytes, the key shared with the coordinator
+    -------
+    AF
+    """
+    conn = Client(address, authkey=authkey)
+    _, job = conn.recv()
+    state = _prepare(job)
+    conn.send(('ready',))
+    while True:
+        msg = conn.recv()
+        if msg[0] == 'stop':
+            break
+        iii = msg[1]
+        conn.send(('result', iii, run_task(job, state, iii)))
+    conn.close()
+
+
+def run_coordinator(job, address=('localhost', 0), authkey=None,
+                    nlocal=0, task_timeout=None, autosave=False, run='tmp',
+                    verbose=False):
+    """Hands out the steps of a job to workers and merges their results.
+
+    Inputs:
+        - job: dict, output of get_job
+        - address: 2-tuple (host, port) to listen on. Port 0 picks a free
+          port, use ('0.0.0.0', port) to accept workers from other machines.
+        - authkey: bytes or None, the key shared with the workers. If None,
+          a random key is drawn and printed in hexadecimal for the workers
+          of other machines (see read_authkey).
+        - nlocal: int, number of worker processes to start on this machine
+        - task_timeout: float or None, if given, a task which has not
+          returned after this many seconds is handed out again
+        - autosave, run: see begin_unicity_series. Rows are saved as soon as
+          all the steps they depend on are done.
+        - verbose: bool, if true then display the progress
+
+    Outputs:
+        - df: pandas.DataFrame() as returned by begin_unicity_series
+    -------
+    AF
+    """
+    fprint = print if verbose else lambda *x, **y: None
+    pl = job['pl']
+    pop_list = job['pop_list']
+    nsteps = len(pop_list)
+    sample_size = job['sample_size']
+
+    if authkey is None:
+        authkey = new_authkey()
+        print('Coordinator key: {}'.format(authkey.hex()))
+    listener = Listener(address, authkey=authkey)
+    fprint('Coordinator listening on {}:{}'.format(*listener.address))
+    cond = threading.Condition()
+    pending = deque(range(nsteps))
+    inflight = {}  # step -> time at which it was handed out
+    results = {}
+
+    def serve(conn):
+        current = None
+        try:
+            conn.send(('job', job))
+            while True:
+                msg = conn.recv()
+                with cond:
+                    if msg[0] == 'result':
+                        # steps are deterministic, keep the first copy only
+                        results.setdefault(msg[1], msg[2])
+                        inflight.pop(msg[1], None)
+                        current = None
+                        cond.notify_all()
+                    while not pending and len(results) < nsteps:
+                        cond.wait(1)
+                    if len(results) == nsteps:
+                        conn.send(('stop',))
+                        return
+                    current = pending.popleft()
+                    inflight[current] = time.time()
+                conn.send(('task', current))
+        except (EOFError, OSError):
+            with cond:
+                if current is not None and current not in results:
+                    fprint('\nWorker lost, reassigning step {}'.format(
+                        current + 1))
+                    inflight.pop(current, None)
+                    pending.appendleft(current)
+                    cond.notify_all()
+        finally:
+            conn.close()
+
+    def accept():
+        while True:
+            try:
+                conn = listener.accept()
+            except (EOFError, AuthenticationError):  # e.g. a wrong key
+                continue
+            except OSError:
+                return
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    procs = [mp.Process(target=run_worker, args=(listener.address, authkey))
+             for _ in range(nlocal)]
+    for proc in procs:
+        proc.start()
+
+    store = None
+    if autosave:
+        if not os.path.exists(autosave):
+            os.mkdir(autosave)
+        store = ResultsStore(os.path.join(autosave, 'results.sqlite'))
+
+    colsum_dict = {}
+    for point in pl:
+        colsum_dict[point] = np.zeros((nsteps, sample_size), dtype=np.int64)
+    df = pd.DataFrame(np.zeros((nsteps, len(pl))), index=pop_list, columns=pl)
+
+    merged = 0
+    with cond:
+        while merged < nsteps:
+            # merge in step order, row merged is final once step merged is in
+            while merged in results:
+                counts = results[merged]
+                for point in pl:
+                    colsum_dict[point][merged:] += counts[point]
+                    u = np.count_nonzero(
+                        colsum_dict[point][merged] == 1) / sample_size
+                    df.loc[pop_list[merged], point] = u
+                if store is not None:
+                    store.append(run, 0, merged, pop_list[merged],
+                                 df.loc[pop_list[merged]].to_dict())
+                results[merged] = None  # free the memory
+                merged += 1
+                fprint('\rStep %d/%d...' % (merged, nsteps), end='')
+            if task_timeout is not None:
+                now = time.time()
+                for iii, start in list(inflight.items()):
+                    if now - start > task_timeout and iii not in pending:
+                        pending.append(iii)
+                        inflight[iii] = now
+                        cond.notify_all()
+            cond.wait(1)
+
+    listener.close()
+    for proc in procs:
+        proc.join()
+    if store is not None:
+        store.close()
+    fprint('\nDone!')
+    return df
+
+
+if __name__ == '__main__':
+    host, port = sys.argv[1:3]
+    run_worker((host, int(port)), read_authkey())
@@ -0,0 +1,258 @@
+"""
+This file contains the differentially private (DP) release of the input
+distributions of the model (circadian, activity and frequency).
+
+The trajectories are flattened once into arrays of times and antennas, and
+every record is given a random rank within its user. Bounding the
+contributions of every user to K records is then a comparison of these ranks
+with K, so the histograms of any number of bounds are computed from a single
+pass over the data, and released for any number of epsilons by adding Laplace
+noise to them.
+
+Sensitivities (adding or removing one user):
+ - circadian: K, a user contributes at most K records (see extract_time_dp).
+ - activity: 1, a user contributes one count to the bucket of its activity.
+ - frequency: 1, a user contributes a vector of rank frequencies summing to 1.
+
+Each histogram is released with the full epsilon. The activity and frequency
+are released once per epsilon and shared by all the bounds, while a circadian
+histogram is released for every (epsilon, bound). By sequential composition,
+the set of files of one (epsilon, bound) costs 3 epsilon, the sets of all the
+bounds of one epsilon cost (number of bounds + 2) epsilon, and all the saved
+files together cost the sum of these over the epsilons (see composed_epsilon).
+
+Author: Ali Farzanehfar
+"""
+
+import numpy as np
+import itertools
+import os
+from sampling_utils import get_rng
+from compact_tracks import CompactTracks
+
+
+def flatten_u2p(u2p, lants):
+    """Flattens the trajectories of get_u2p into arrays.
+
+    Inputs:
+        - u2p: dict, output of get_u2p, each value is a list of integers
+          representing space-time points, or CompactTracks
+        - lants: int, the total number of antennas
+
+    Outputs:
+        - indptr: ndarray of int64, the records of user i are
+          indptr[i]:indptr[i + 1]
+        - t: ndarray of int32, the time of each record
+        - x: ndarray of int32, the antenna of each record
+    -------
+    AF
+    """
+    if isinstance(u2p, CompactTracks):
+        _, rows, cols, _, acts = u2p.decode()
+        return np.concatenate([[0], np.cumsum(acts, dtype=np.int64)]), \
+            (cols // lants).astype(np.int32), (cols % lants).astype(np.int32)
+    tracks = list(u2p.values())
+    lengths = np.fromiter(map(len, tracks), dtype=np.int64, count=len(tracks))
+    indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    flat = np.fromiter(itertools.chain.from_iterable(tracks), dtype=np.int64,
+                       count=indptr[-1])
+    return indptr, (flat // lants).astype(np.int32), \
+        (flat % lants).astype(np.int32)
+
+
+def contribution_ranks(indptr, rng=None):
+    """Gives every record a uniformly random rank within its user. Keeping
+    the records of rank < K is the same as keeping K random records of each
+    user (all of them if the user has fewer), and the records kept for a bound
+    are included in those kept for any larger bound.
+
+    Inputs:
+        - indptr: ndarray, see flatten_u2p
+        - rng: numpy.random.Generator or None, see sampling_utils.get_rng
+
+    Outputs:
+        - ndarray of int64, the rank of each record
+    -------
+    AF
+    """
+    lengths = np.diff(indptr)
+    users = np.repeat(np.arange(len(lengths)), lengths)
+    order = np.lexsort((get_rng(rng).random(len(users)), users))
+    ranks = np.empty(len(users), dtype=np.int64)
+    ranks[order] = np.arange(len(users)) - np.repeat(indptr[:-1], lengths)
+    return ranks
+
+
+def circadian_histogram(t, ranks, bound, lhrs):
+    """Histogram of the times of the records kept for a contribution bound.
+    -------
+    AF
+    """
+    return np.bincount(t[ranks < bound], minlength=lhrs).astype(np.float64)
+
+
+def activity_histogram(indptr, lhrs):
+    """Histogram of the number of records of each user, in the format of
+    extract_activity.
+    -------
+    AF
+    """
+    return np.bincount(np.diff(indptr), minlength=lhrs).astype(np.float64)
+
+
+def user_antenna_counts(indptr, x, lants):
+    """Number of records of each user at each of its antennas.
+
+    Inputs:
+        - indptr, x: ndarrays, see flatten_u2p
+        - lants: int, the total number of antennas
+
+    Outputs:
+        - pusers: ndarray of int64, the user of each (user, antenna) pair
+        - pants: ndarray of int32, the antenna of each pair
+        - counts: ndarray of int64, the number of records of each pair
+        The pairs are sorted by user, then antenna.
+    -------
+    AF
+    """
+    lengths = np.diff(indptr)
+    users = np.repeat(np.arange(len(lengths)), lengths)
+    pairs, counts = np.unique(users.astype(np.int64) * lants + x,
+                              return_counts=True)
+    return pairs // lants, (pairs % lants).astype(np.int32), counts
+
+
+def frequency_histogram(indptr, x, lants, lhrs):
+    """Sum over users of the frequency with which they visit their most to
+    least visited antennas, in the format of extract_frequency.
+    -------
+    AF
+    """
+    pusers, _, counts = user_antenna_counts(indptr, x, lants)
+    return rank_frequency_histogram(pusers, counts, np.diff(indptr), lhrs)
+
+
+def rank_frequency_histogram(pusers, counts, lengths, lhrs):
+    """Same as frequency_histogram, from the counts of user_antenna_counts
+    and the number of records of each user.
+    -------
+    AF
+    """
+    # order antennas by decreasing visits within each user
+    order = np.lexsort((-counts, pusers))
+    pusers, counts = pusers[order], counts[order]
+    nants = np.bincount(pusers, minlength=len(lengths))
+    ranks = np.arange(len(pusers)) - np.repeat(np.cumsum(nants) - nants,
+                                               nants)
+    return np.bincount(ranks, weights=counts / lengths[pusers],
+                       minlength=lhrs)
+
+
+def dp_histogram(hist, sensitivity, epsilon, rng=None):
+    """Adds Laplace noise to a histogram and post-processes it into a
+    probability distribution.
+
+    Inputs:
+        - hist: ndarray, the histogram
+        - sensitivity: float, L1 sensitivity of the histogram
+        - epsilon: float, privacy parameter
+        - rng: numpy.random.Generator or None, see sampling_utils.get_rng
+
+    Outputs:
+        - ndarray, the released distribution
+    -------
+    AF
+    """
+    dp_hist = hist + get_rng(rng).laplace(loc=0, scale=sensitivity / epsilon,
+                                          size=hist.shape)
+    # Post-processing: round, and normalize.
+    #  1. Set negative entries to 0 (project on R^n+).
+    dp_hist[dp_hist < 0] = 0
+    #  2. Round to integers (this prevents the LSB attack from Mironov et al.
+    #     "On significance of the least significant bits for differential
+    #     privacy")
+    dp_hist = np.round(dp_hist)
+    #  3. Normalise to a probability distribution.
+    return dp_hist / dp_hist.sum()
+
+
+def release_inputs(u2p, lants, lhrs, epsilons, bounds, rng=None):
+    """Releases the circadian, activity and frequency distributions for every
+    combination of epsilon and contribution bound, from a single pass over the
+    data.
+
+    Inputs:
+        - u2p: dict, output of get_u2p
+        - lants: int, the total number of antennas
+        - lhrs: int, the total number of hours
+        - epsilons: list of floats, privacy parameters
+        - bounds: list of ints, maximum number of records of a user
+          contributing to the circadian histogram
+        - rng: numpy.random.Generator or None, see sampling_utils.get_rng
+
+    Outputs:
+        - dict with (epsilon, bound) keys and dict values mapping 'circadian',
+          'activity' and 'frequency' to the released distributions. The
+          activity and frequency are released once per epsilon, so the
+          entries of the bounds of one epsilon hold the same arrays.
+    -------
+    AF
+    """
+    indptr, t, x = flatten_u2p(u2p, lants)
+    rng = get_rng(rng)
+    ranks = contribution_ranks(indptr, rng)
+    activity = activity_histogram(indptr, lhrs)
+    frequency = frequency_histogram(indptr, x, lants, lhrs)
+    circadians = {bound: circadian_histogram(t, ranks, bound, lhrs)
+                  for bound in bounds}
+
+    releases = {}
+    for eps in epsilons:
+        shared = {'activity': dp_histogram(activity, 1, eps, rng),
+                  'frequency': dp_histogram(frequency, 1, eps, rng)}
+        for bound in bounds:
+            releases[(eps, bound)] = dict(
+                circadian=dp_histogram(circadians[bound], bound, eps, rng),
+                **shared)
+    return releases
+
+
+def composed_epsilon(releases):
+    """Privacy budget spent by the output of release_inputs, by sequential
+    composition.
+
+    Inputs:
+        - releases: dict, output of release_inputs
+
+    Outputs:
+        - per_set: dict with (epsilon, bound) keys, the epsilon spent by the
+          files of that key alone (3 epsilon)
+        - per_eps: dict with epsilon keys, the epsilon spent by the files of
+          all the bounds of that epsilon, since their activity and frequency
+          are shared ((number of bounds + 2) epsilon)
+        - total: float, the epsilon spent by all the files together
+    -------
+    AF
+    """
+    per_set = {(eps, bound): 3 * eps for eps, bound in releases}
+    per_eps = {}
+    for eps, _ in releases:
+        per_eps[eps] = per_eps.get(eps, 2 * eps) + eps
+    return per_set, per_eps, sum(per_eps.values())
+
+
+def save_releases(releases, outdir, fname='{name}_eps{eps:g}_k{bound}.npy'):
+    """Saves the output of release_inputs as numpy arrays.
+
+    Inputs:
+        - releases: dict, output of release_inputs
+        - outdir: str, the folder in which the arrays are saved
+        - fname: str, format of the file names, can use {name}, {eps} and
+          {bound}
+    -------
+    AF
+    """
+    for (eps, bound), dists in releases.items():
+        for name, arr in dists.items():
+            np.save(os.path.join(outdir, fname.format(name=name, eps=eps,
+                                                      bound=bound)), arr)
@@ -2,25 +2,30 @@
 This file extracts the activity for each user in the data and puts the values
 in a list to be fit later.
 
+The data is folded into the statistics shared by the extractors (see
+extraction_stats), so that only the periods not processed yet are read:
+    python extract_activity.py [START_DATE END_DATE ...]
+The users of get_u2p cannot be matched across periods, so the activity is
+extracted from a single period until get_u2p gives stable user identifiers.
+
 Author: Ali Farzanehfar
 """
 import dataformat_utils as dut
+import extraction_stats as exs
 import numpy as np
-from tqdm import tqdm as tq
 import pickle
+import sys
 
 
-u2p = dut.get_u2p()
+lhrs = len(dut.get_date_array())
+lants = len(dut.get_ant_array())
 
-activity = []
-actarr = np.zeros(len(dut.get_date_array()))
-for user in tq(u2p):
-    a = len(u2p[user])
-    activity.append(a)
-    actarr[a] += 1
+stats = exs.update_stats(exs.get_periods(sys.argv[1:]), lants, lhrs,
+                         users=True)
+activity = exs.user_activity(stats).tolist()
 
 with open('../inputs/activity.p', 'wb') as actfile:
     pickle.dump(activity, actfile)
 
 # this is the one of interest and the one used in the model
-np.save('../inputs/activity.npy', actarr)
+np.save('../inputs/activity.npy', exs.activity_distribution(stats))
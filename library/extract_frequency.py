@@ -2,35 +2,25 @@
 This file extracts the frequency vectory for each user in the data and puts
 the values in a histogram
 
+The data is folded into the statistics shared by the extractors (see
+extraction_stats), so that only the periods not processed yet are read:
+    python extract_frequency.py [START_DATE END_DATE ...]
+The users of get_u2p cannot be matched across periods, so the frequency is
+extracted from a single period until get_u2p gives stable user identifiers.
+
 Author: Ali Farzanehfar
 """
 
 import dataformat_utils as dut
+import extraction_stats as exs
 import numpy as np
-from tqdm import tqdm as tq
-from functools import partial
-from collections import Counter
-
+import sys
 
-u2p = dut.get_u2p()
 
 lhrs = len(dut.get_date_array())
 lants = len(dut.get_ant_array())
 
-mean_f = np.zeros(lhrs)
-
-get_track = partial(dut.get_user_track, lants=lants)
-
-for user in tq(u2p):
-
-    _, xi = get_track(u2p[user])
-    md = Counter(xi)
-    fi = sorted(md.items(), key=lambda tup: tup[1], reverse=True)
-    fi = list(zip(*fi))[1]
-    fi = np.array(fi)
-    fi = fi / np.sum(fi)
-    fi = np.pad(fi, (0, lhrs - len(fi)), 'constant')
-    mean_f += fi
-
+stats = exs.update_stats(exs.get_periods(sys.argv[1:]), lants, lhrs,
+                         users=True)
 
-np.save('../inputs/frequency.npy', mean_f)
+np.save('../inputs/frequency.npy', exs.frequency_distribution(stats))
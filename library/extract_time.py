@@ -2,26 +2,22 @@
 This file extracts the time for each user in the data and puts the values
 in a histogram
 
+The data is folded into the statistics shared by the extractors (see
+extraction_stats), so that only the periods not processed yet are read:
+    python extract_time.py [START_DATE END_DATE ...]
+The circadian histogram adds up across disjoint periods, so new periods are
+folded in as they come.
+
 Author: Ali Farzanehfar
 """
 import dataformat_utils as dut
+import extraction_stats as exs
 import numpy as np
-from tqdm import tqdm as tq
-from functools import partial
-
-u2p = dut.get_u2p()
+import sys
 
 lhrs = len(dut.get_date_array())
 lants = len(dut.get_ant_array())
 
-time_arr = np.zeros(lhrs)
-
-get_track = partial(dut.get_user_track, lants=lants)
-
-for user in tq(u2p):
-
-    t, x = get_track(u2p[user])
-    time_arr[t] += 1
-
+stats = exs.update_stats(exs.get_periods(sys.argv[1:]), lants, lhrs)
 
-np.save('../inputs/circadian.npy', time_arr)
+np.save('../inputs/circadian.npy', exs.circadian_distribution(stats))
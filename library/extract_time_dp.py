@@ -14,13 +14,20 @@ Method:
  - We finally post-process the noisy histogram, setting negative values to 0, rounding to integers,
      then normalizing so the vector sums to 1 (and is thus a probability distribution over hours).
 
+The bounding and the release are done by dp_utils, which computes the
+histograms of all the bounds in PRIV_CONTRIBUTION_BOUNDS in one vectorized
+pass and releases them for every epsilon in PRIV_EPSILONS. The activity and
+frequency distributions are released alongside, once per epsilon (see
+dp_utils), every variant is saved in ../inputs/dp/, and the epsilon spent by
+the saved files is printed.
+
 Authors: Ali Farzanehfar and Florimond Houssiau
 """
 
 import dataformat_utils as dut
+import dp_utils as dpu
 import numpy as np
-from tqdm import tqdm as tq
-from functools import partial
+import os
 
 
 # PRIVACY PARAMETERS.
@@ -30,6 +37,9 @@ PRIV_EPSILON = 1
 # This seems like a reasonable compromise.
 PRIV_CONTRIBUTION_BOUND = 50
 
+# Variants released alongside the default parameters above.
+PRIV_EPSILONS = [0.1, 0.5, PRIV_EPSILON, 2, 5]
+PRIV_CONTRIBUTION_BOUNDS = [10, 25, PRIV_CONTRIBUTION_BOUND, 100]
 
 
 # Get samples from the dataset.
@@ -39,42 +49,21 @@ u2p = dut.get_u2p()
 lhrs = len(dut.get_date_array())
 lants = len(dut.get_ant_array())
 
-# User contribution histogram (the result).
-time_arr = np.zeros(lhrs)
-
-get_track = partial(dut.get_user_track, lants=lants)
-
-# Build the histogram for each user.
-for user in tq(u2p):
-
-    times, _ = get_track(u2p[user])
-    n_times = len(times)
-    # Limit any user's contributions to the result
-    if n_times > PRIV_CONTRIBUTION_BOUND:
-        indices = np.arange(n_times)
-        np.random.shuffle(indices)
-        chosen_samples = indices[:PRIV_CONTRIBUTION_BOUND]
-        # Restrict the `times` vector to the chosen samples.
-        times = times[chosen_samples]
-    # Increase by 1 the count for each element in the remaining array.
-    time_arr[times] += 1
-
-
-# Add Laplace noise to the histogram.
-dp_noise = np.random.laplace(loc=0, scale=PRIV_CONTRIBUTION_BOUND/PRIV_EPSILON, size=(lhrs,))
-
-dp_time_arr = time_arr + dp_noise
-
+releases = dpu.release_inputs(u2p, lants, lhrs, PRIV_EPSILONS,
+                              PRIV_CONTRIBUTION_BOUNDS)
 
-# Post-processing: round, and normalize.
-# This is needed to ensure that the results are usable.
-#  1. Set negative entries to 0 (project on R^n+).
-dp_time_arr[dp_time_arr < 0] = 0
-#  2. Round to integers (this is a neat trick to prevent the LSB attack from Mironov et al.
-#     "On significance of the least significant bits for differential privacy")
-dp_time_arr = np.round(dp_time_arr)
-#  3. Normalise to a probability distribution.
-dp_time_arr = dp_time_arr / dp_time_arr.sum()
+outdir = '../inputs/dp/'
+if not os.path.exists(outdir):
+    os.mkdir(outdir)
+dpu.save_releases(releases, outdir)
 
+# Privacy budget actually spent by the saved files.
+per_set, per_eps, total = dpu.composed_epsilon(releases)
+for (eps, bound), spent in sorted(per_set.items()):
+    print('eps={:g}, K={}: one file set spends {:g}'.format(eps, bound, spent))
+for eps, spent in sorted(per_eps.items()):
+    print('eps={:g}: all bounds together spend {:g}'.format(eps, spent))
+print('All saved files together spend {:g}'.format(total))
 
-np.save('../inputs/circadian.npy', dp_time_arr)
\ No newline at end of file
+np.save('../inputs/circadian.npy',
+        releases[(PRIV_EPSILON, PRIV_CONTRIBUTION_BOUND)]['circadian'])
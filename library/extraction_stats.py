@@ -0,0 +1,305 @@
+"""
+This file contains the mergeable statistics from which the input distributions
+of the model are extracted (see extract_activity.py, extract_frequency.py and
+extract_time.py), so that new data can be folded in without going through the
+data already processed.
+
+The statistics of a shard of data (e.g. a period of days) are:
+ - users: the identifiers of its users,
+ - the number of records of each user at each of its antennas, as the arrays
+   pair_user, pair_ant and pair_count, sorted by user then antenna,
+ - circadian: the number of users active in each hour (a user with several
+   records in an hour counts once, as in the original extract_time),
+ - shards: the names of the shards they were computed from,
+ - periods: the (start date, end date) of each shard, empty if unknown,
+ - stable: whether the users of each shard have stable identifiers.
+The statistics of two shards are merged by adding the counts of the pairs and
+of the hours they share. The activity of a user is the sum of its counts and
+its frequency vector is given by its sorted counts, so the distributions
+derived from merged statistics are those of the data of all the shards, as
+long as users are identified consistently across shards and no record is in
+two shards.
+
+Shards are only merged if their periods do not overlap, since the records of
+the common days would be counted twice. The circadian histogram then simply
+adds up. The keys of get_u2p, however, are the positions of the users in the
+data it loads, not identifiers: the same key is another user in another
+period. The users and pairs are therefore only kept when all the merged
+shards have stable user identifiers (see shard_stats), and the activity and
+frequency of statistics without them raise ValueError. With get_u2p as it is,
+the circadian histogram is folded in period by period, while the activity and
+frequency are extracted from a single period.
+
+Folding a new shard in only reads the new data. The merge then sorts the
+distinct (user, antenna) pairs, which are far fewer than the records.
+
+Author: Ali Farzanehfar
+"""
+
+import numpy as np
+import multiprocessing as mp
+import os
+import dataformat_utils as dut
+from dp_utils import flatten_u2p, user_antenna_counts, \
+    rank_frequency_histogram
+
+
+STATS_FILE = '../inputs/extraction_stats.npz'
+
+
+def shard_stats(u2p, lants, lhrs, name=None, period=None, user_ids=None):
+    """Computes the statistics of a shard of data.
+
+    Inputs:
+        - u2p: dict, output of get_u2p
+        - lants: int, the total number of antennas
+        - lhrs: int, the total number of hours
+        - name: str or None, the name of the shard, which prevents it from
+          being merged twice
+        - period: None or 2-tuple of str, the first and last dates
+          (YYYY-MM-DD) of the data of the shard
+        - user_ids: None or ndarray of ints, identifiers of the users of u2p
+          (in its order) which are the same in every shard. If None, the
+          users are identified by the keys of u2p, and only the circadian
+          histogram of the shard is kept when it is merged with others (see
+          the top of the file).
+
+    Outputs:
+        - stats: dict of ndarrays, see the top of the file
+    -------
+    AF
+    """
+    indptr, t, x = flatten_u2p(u2p, lants)
+    if user_ids is None:
+        users = np.fromiter(u2p.keys(), dtype=np.int64, count=len(u2p))
+    else:
+        users = np.asarray(user_ids, dtype=np.int64)
+        assert len(users) == len(indptr) - 1, 'One identifier per user'
+        if len(np.unique(users)) < len(users):
+            raise ValueError('The user identifiers must be distinct')
+    pusers, pants, counts = user_antenna_counts(indptr, x, lants)
+    # the distinct (user, hour) pairs
+    nhrs = max(lhrs, int(t.max(initial=-1)) + 1)
+    rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64),
+                     np.diff(indptr))
+    hours = np.unique(rows * nhrs + t) % nhrs
+    return merge_stats({
+        'users': users, 'pair_user': users[pusers], 'pair_ant': pants,
+        'pair_count': counts,
+        'circadian': np.bincount(hours, minlength=lhrs).astype(np.int64),
+        'shards': np.array(['' if name is None else name], dtype=str),
+        'periods': np.array([['', ''] if period is None else period],
+                            dtype=str),
+        'stable': np.array([user_ids is not None])})
+
+
+def check_mergeable(shards, periods):
+    """Raises ValueError if shards cannot be merged: if one is merged more
+    than once, or if two cover overlapping periods (an unknown period
+    overlaps every other).
+
+    Inputs:
+        - shards, periods: ndarrays, see the top of the file
+    -------
+    AF
+    """
+    named = shards[shards != '']
+    if len(np.unique(named)) < len(named):
+        raise ValueError('A shard is merged more than once')
+    for i in range(len(shards)):
+        for j in range(i):
+            (s0, e0), (s1, e1) = periods[i], periods[j]
+            if not (s0 and s1) or (s0 <= e1 and s1 <= e0):
+                raise ValueError('Shards {} and {} cover overlapping '
+                                 'periods'.format(shards[j], shards[i]))
+
+
+def has_users(stats):
+    """Whether stats holds the users and pairs, see the top of the file.
+    -------
+    AF
+    """
+    return len(stats['stable']) < 2 or bool(np.all(stats['stable']))
+
+
+def _no_users_error(stats):
+    return ValueError(
+        'The users of shards {} have no stable identifiers across shards, so '
+        'their activity and frequency cannot be merged'.format(
+            list(stats['shards'][~stats['stable']])))
+
+
+def merge_stats(*stats_list):
+    """Merges the statistics of disjoint shards. The users and pairs are
+    dropped unless all the shards have stable user identifiers.
+
+    Inputs:
+        - stats_list: dicts, outputs of shard_stats or merge_stats
+
+    Outputs:
+        - stats: dict of ndarrays, the statistics of all the shards
+    -------
+    AF
+    """
+    shards, periods, stable = [
+        np.concatenate([s[name] for s in stats_list])
+        for name in ['shards', 'periods', 'stable']]
+    check_mergeable(shards, periods)
+    # the hours of a shard covering a later period can go further
+    circadian = np.zeros(max(len(s['circadian']) for s in stats_list),
+                         dtype=np.int64)
+    for s in stats_list:
+        circadian[:len(s['circadian'])] += s['circadian']
+    merged = {'circadian': circadian, 'shards': shards, 'periods': periods,
+              'stable': stable}
+    if not has_users(merged):
+        return merged
+
+    users = np.unique(np.concatenate([s['users'] for s in stats_list]))
+    pair_user, pair_ant, pair_count = [
+        np.concatenate([s[name] for s in stats_list])
+        for name in ['pair_user', 'pair_ant', 'pair_count']]
+    order = np.lexsort((pair_ant, pair_user))
+    pair_user, pair_ant = pair_user[order], pair_ant[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (pair_user[1:] != pair_user[:-1]) | \
+        (pair_ant[1:] != pair_ant[:-1])
+    starts = np.nonzero(first)[0]
+    if len(starts):
+        pair_count = np.add.reduceat(pair_count[order], starts)
+    merged.update(users=users, pair_user=pair_user[starts],
+                  pair_ant=pair_ant[starts], pair_count=pair_count)
+    return merged
+
+
+def user_activity(stats):
+    """Number of records of each user of stats['users'].
+    -------
+    AF
+    """
+    if not has_users(stats):
+        raise _no_users_error(stats)
+    return np.bincount(np.searchsorted(stats['users'], stats['pair_user']),
+                       weights=stats['pair_count'],
+                       minlength=len(stats['users'])).astype(np.int64)
+
+
+def activity_distribution(stats):
+    """Histogram of the activity of the users, as saved by extract_activity.
+    -------
+    AF
+    """
+    return np.bincount(user_activity(stats),
+                       minlength=len(stats['circadian'])).astype(np.float64)
+
+
+def frequency_distribution(stats):
+    """Sum over users of the frequency with which they visit their most to
+    least visited antennas, as saved by extract_frequency.
+    -------
+    AF
+    """
+    return rank_frequency_histogram(
+        np.searchsorted(stats['users'], stats['pair_user']),
+        stats['pair_count'], user_activity(stats), len(stats['circadian']))
+
+
+def circadian_distribution(stats):
+    """Number of users active in each hour, as saved by extract_time.
+    -------
+    AF
+    """
+    return stats['circadian'].astype(np.float64)
+
+
+def load_stats(path=STATS_FILE):
+    """Loads the statistics saved by save_stats, or returns None if there
+    are none.
+    -------
+    AF
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        return {name: f[name] for name in f.files}
+
+
+def save_stats(stats, path=STATS_FILE):
+    tmp = path[:-len('.npz')] + '.tmp.npz'
+    np.savez(tmp, **stats)
+    os.replace(tmp, path)
+
+
+def get_periods(args):
+    """Reads the periods of data given on the command line of the extractors
+    as START_DATE END_DATE pairs. Without any, the data of get_u2p() with its
+    default dates is used.
+    -------
+    AF
+    """
+    if len(args) % 2:
+        raise ValueError('Periods are given as START_DATE END_DATE pairs')
+    if not args:
+        return [None]
+    return list(zip(args[::2], args[1::2]))
+
+
+def _period_name(period):
+    return 'default' if period is None else '{}:{}'.format(*period)
+
+
+def _period_stats(period, lants, lhrs):
+    if period is None:
+        u2p = dut.get_u2p()
+    else:
+        u2p = dut.get_u2p(start_date=period[0], end_date=period[1])
+    return shard_stats(u2p, lants, lhrs, _period_name(period), period)
+
+
+def update_stats(periods, lants, lhrs, path=STATS_FILE, nproc=None,
+                 users=False):
+    """Folds the data of the periods which are not in the saved statistics
+    yet into them, reading the new periods in parallel.
+
+    Inputs:
+        - periods: list, outputs of get_periods
+        - lants: int, the total number of antennas
+        - lhrs: int, the total number of hours
+        - path: str, the file of the statistics
+        - nproc: int or None, number of periods read at the same time
+          (default: one per period, up to the number of cores)
+        - users: bool, if true then raise ValueError before reading any
+          data if the statistics would not hold the users and pairs, which
+          the activity and frequency need (see the top of the file)
+
+    Outputs:
+        - stats: dict of ndarrays, the statistics of all the periods
+    -------
+    AF
+    """
+    stats = load_stats(path)
+    done = set() if stats is None else set(stats['shards'])
+    new = [p for p in periods if _period_name(p) not in done]
+    if not new:
+        return stats
+    # fails before reading the data, the users of get_u2p have no stable
+    # identifiers
+    planned = {'shards': np.array([_period_name(p) for p in new], dtype=str),
+               'periods': np.array([['', ''] if p is None else p
+                                    for p in new], dtype=str),
+               'stable': np.zeros(len(new), dtype=bool)}
+    planned = {name: np.concatenate(([] if stats is None else [stats[name]])
+                                    + [arr]) for name, arr in planned.items()}
+    check_mergeable(planned['shards'], planned['periods'])
+    if users and not has_users(planned):
+        raise _no_users_error(planned)
+    args = [(p, lants, lhrs) for p in new]
+    nproc = min(len(new), mp.cpu_count()) if nproc is None else nproc
+    if nproc > 1:
+        with mp.Pool(nproc) as pool:
+            parts = pool.starmap(_period_stats, args)
+    else:
+        parts = [_period_stats(*a) for a in args]
+    stats = merge_stats(*([] if stats is None else [stats]) + parts)
+    save_stats(stats, path)
+    return stats
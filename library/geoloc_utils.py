@@ -1,15 +1,29 @@
 """
-This file provides two funcitons used for generating the correct graph from a
+This file provides the funcitons used for generating the correct graph from a
 series of geographic locations corresponding to antennas or any other points of
 interest.
 
+The graph is built at the tower level (antennas sharing a location form a
+tower) and then expanded to antennas, such that each antenna neighbours all the
+antennas in the towers that neighbour its own tower. The adjacency is stored
+as CSR arrays (indptr, indices) and cached on disk, keyed by the hash of the
+location file, so that it is only ever built once per input file.
+
 Author: Ali Farzanehfar
 """
 
 import numpy as np
 import scipy.spatial as sp
 import pandas as pd
+from scipy import sparse as sps
+import hashlib
+import os
 from collections import defaultdict
+from dataformat_utils import gather_ranges
+
+
+# in-process copy of the graphs already loaded, keyed by file hash and mode
+_GEO_MEMO = {}
 
 
 def find_neighbors(pindex, triang):
@@ -31,7 +45,159 @@ def find_neighbors(pindex, triang):
     return a[b:c]
 
 
-def get_geo(inputdir, fname, pandas_sep=' '):
+def tower_graph(points, mode='delaunay', k=8, radius=None):
+    """Computes the tower level adjacency in CSR form.
+
+    Inputs:
+        - points: ndarray of shape (ntowers, 2), the tower coordinates
+        - mode: str, one of 'delaunay', 'knn' or 'radius'
+        - k: int, number of nearest neighbours used when mode is 'knn'
+        - radius: float, distance (in the units of points) used when mode is
+          'radius'
+
+    Outputs:
+        - indptr, indices: ndarrays such that the neighbours of tower i are
+          indices[indptr[i]:indptr[i + 1]]
+    -------
+    AF
+    """
+    ntow = len(points)
+    if mode == 'delaunay':
+        tri = sp.Delaunay(points)
+        indptr, indices = tri.vertex_neighbor_vertices
+        return indptr.astype(np.int64), indices.astype(np.int32)
+
+    tree = sp.cKDTree(points)
+    if mode == 'knn':
+        kk = min(k + 1, ntow)
+        _, nbrs = tree.query(points, k=kk)
+        rows = np.repeat(np.arange(ntow), kk - 1)
+        cols = nbrs[:, 1:].ravel()
+        # the k-nn relation is not symmetric, the graph is made undirected
+        rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+    elif mode == 'radius':
+        assert radius is not None, 'radius must be given when mode is radius'
+        pairs = tree.query_pairs(radius, output_type='ndarray')
+        rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    else:
+        raise ValueError('Unknown graph mode: {}'.format(mode))
+
+    keep = rows != cols
+    adj = sps.csr_matrix((np.ones(keep.sum(), dtype=np.int8),
+                          (rows[keep], cols[keep])), shape=(ntow, ntow))
+    adj.sort_indices()
+    return adj.indptr.astype(np.int64), adj.indices.astype(np.int32)
+
+
+def build_geo_csr(pdf, mode='delaunay', k=8, radius=None):
+    """Builds the antenna adjacency from a dataframe of antenna locations
+    without any python level loops over antennas.
+
+    Inputs:
+        - pdf: pandas.DataFrame with columns 'lat' and 'long', one row per
+          antenna
+        - mode, k, radius: see tower_graph()
+
+    Outputs:
+        - indptr: ndarray of int64, of size nants + 1
+        - indices: ndarray of int32, neighbouring antennas of each antenna
+        - keys: ndarray of int32, the antennas which have at least one
+          neighbour in the order used by the original dictionary version of
+          get_geo (towers sorted by location, antennas in file order)
+    -------
+    AF
+    """
+    nants = len(pdf)
+    coords = np.stack([pdf['long'].values, pdf['lat'].values], axis=1)
+    # towers are sorted by (long, lat) as in pandas' groupby
+    points, tower_of = np.unique(coords, axis=0, return_inverse=True)
+    tower_of = tower_of.ravel()
+    ntow = len(points)
+
+    # antennas grouped by tower, in file order within each tower
+    ant_order = np.argsort(tower_of, kind='stable').astype(np.int32)
+    tsize = np.bincount(tower_of, minlength=ntow)
+    tptr = np.concatenate([[0], np.cumsum(tsize)])
+
+    t_indptr, t_indices = tower_graph(points, mode, k, radius)
+
+    # for each tower, the antennas of all neighbouring towers back to back
+    t_rows = np.repeat(np.arange(ntow), np.diff(t_indptr))
+    nbr_len = np.bincount(t_rows, weights=tsize[t_indices],
+                          minlength=ntow).astype(np.int64)
+    tower_nbrs = ant_order[gather_ranges(tptr[t_indices], tsize[t_indices])]
+    tower_nbr_ptr = np.concatenate([[0], np.cumsum(nbr_len)])
+
+    # each antenna inherits the neighbour list of its tower
+    lengths = nbr_len[tower_of]
+    indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    indices = tower_nbrs[gather_ranges(tower_nbr_ptr[tower_of], lengths)]
+
+    keys = ant_order[lengths[ant_order] > 0]
+    assert indptr[-1] == len(indices) and len(indptr) == nants + 1
+    return indptr, indices.astype(np.int32), keys
+
+
+def get_geo_csr(inputdir, fname, pandas_sep=' ', mode='delaunay', k=8,
+                radius=None, cache=True):
+    """Loads the antenna graph in CSR form. The graph is built once and stored
+    as an .npz file inside inputdir/cache/, keyed by the hash of fname and the
+    graph parameters, so subsequent calls only read a few arrays from disk.
+
+    Inputs:
+        - inputdir: str, indicates path of where input files are located
+        - fname: str, name of file containing antenna ids, lat and long
+        - pandas_sep: str, the separator for the fields inside elements of
+                      fname (within a line).
+        - mode: str, 'delaunay' (default, as in the publication), 'knn' or
+                'radius'. The latter two use scipy's cKDTree and are intended
+                for grids with a very large number of antennas.
+        - k: int, number of neighbouring towers when mode is 'knn'
+        - radius: float, neighbourhood radius (in degrees) when mode is
+                  'radius'
+        - cache: bool, whether to read and write the on-disk cache
+
+    Outputs:
+        - indptr, indices, keys: see build_geo_csr()
+    -------
+    AF
+    """
+    fpath = os.path.join(inputdir, fname)
+    with open(fpath, 'rb') as fgeo:
+        fhash = hashlib.sha1(fgeo.read()).hexdigest()[:16]
+
+    if mode == 'knn':
+        tag = 'knn{:d}'.format(k)
+    elif mode == 'radius':
+        tag = 'radius{}'.format(radius)
+    else:
+        tag = mode
+    memo_key = (fhash, tag, pandas_sep)
+    if memo_key in _GEO_MEMO:
+        return _GEO_MEMO[memo_key]
+
+    cpath = os.path.join(inputdir, 'cache',
+                         '{}.{}.{}.npz'.format(fname, tag, fhash))
+    if cache and os.path.exists(cpath):
+        with np.load(cpath) as npz:
+            res = npz['indptr'], npz['indices'], npz['keys']
+    else:
+        pdf = pd.read_csv(fpath, names=['antid', 'lat', 'long'],
+                          sep=pandas_sep)
+        res = build_geo_csr(pdf, mode, k, radius)
+        if cache:
+            os.makedirs(os.path.dirname(cpath), exist_ok=True)
+            # write then rename so parallel workers never read partial files
+            tmp = '{}.{}.tmp.npz'.format(cpath[:-4], os.getpid())
+            np.savez(tmp, indptr=res[0], indices=res[1], keys=res[2])
+            os.replace(tmp, cpath)
+
+    _GEO_MEMO[memo_key] = res
+    return res
+
+
+def get_geo(inputdir, fname, pandas_sep=' ', **graph_kwargs):
     """This function reads lat and long information from input files and returns
     a dictionary linking antennas to neighbouring antennas.
 
@@ -40,6 +206,7 @@ def get_geo(inputdir, fname, pandas_sep=' '):
         - fname: str, name of file containing antenna ids, lat and long
         - pandas_sep: str, the separator for the fields inside elements of
                       fname (within a line).
+        - graph_kwargs: passed on to get_geo_csr (mode, k, radius, cache)
 
     Outputs:
         - dict with keys being integers which enumerate antennas in the order
@@ -49,6 +216,27 @@ def get_geo(inputdir, fname, pandas_sep=' '):
     -------
     AF
     """
+    indptr, indices, keys = get_geo_csr(inputdir, fname, pandas_sep,
+                                        **graph_kwargs)
+    nbrs = np.split(indices, indptr[1:-1])
+    return {int(ant): set(nbrs[ant].tolist()) for ant in keys}
+
+
+def get_geo_legacy(inputdir, fname, pandas_sep=' '):
+    """Same as get_geo, built as in the publication. The neighbour sets hold
+    the same antennas, but they are built by successive unions, which sets
+    the order in which they are iterated. The clusters drawn with the global
+    generators (see model_source.gen_cluster) depend on this order, so this
+    version is needed to reproduce the published results.
+
+    Inputs:
+        - see get_geo
+
+    Outputs:
+        - see get_geo
+    -------
+    AF
+    """
     pdf = pd.read_csv(inputdir + fname,
                       names=['antid', 'lat', 'long'], sep=pandas_sep)
     pdf['antid'] = np.int16(pdf['antid'])
@@ -68,3 +256,30 @@ def get_geo(inputdir, fname, pandas_sep=' '):
             for ant in ant_in_tower[i]:
                 ant_neighbour_ant[ant] = a
     return dict(ant_neighbour_ant)
+
+
+def get_antenna_map(inputdir, fname, cell=None, pandas_sep=' '):
+    """Maps every antenna to a coarser spatial unit.
+
+    Inputs:
+        - inputdir: str, indicates path of where input files are located
+        - fname: str, name of file containing antenna ids, lat and long
+        - cell: None or float. If None, antennas are grouped by tower (i.e.
+                by location), otherwise by square cells of 'cell' degrees of
+                latitude and longitude.
+        - pandas_sep: str, the separator for the fields inside elements of
+                      fname (within a line).
+
+    Outputs:
+        - ndarray of int32, the unit of each antenna (in the order of fname),
+          numbered from 0
+    -------
+    AF
+    """
+    pdf = pd.read_csv(os.path.join(inputdir, fname),
+                      names=['antid', 'lat', 'long'], sep=pandas_sep)
+    coords = np.stack([pdf['long'].values, pdf['lat'].values], axis=1)
+    if cell is not None:
+        coords = np.floor(coords / cell)
+    _, unit = np.unique(coords, axis=0, return_inverse=True)
+    return unit.ravel().astype(np.int32)
@@ -8,7 +8,7 @@ The results of the sensitivity analysis in the publication are from here.
 Author: Ali Farzanehfar
 """
 
-from unicity_utils import begin_unicity_series
+from unicity_utils import begin_unicity_series, begin_unicity_series_multi
 from dataformat_utils import get_pool_data, gen_act, gen_freq, get_input_dists
 import numpy as np
 import random as rnd
@@ -16,29 +16,62 @@ import multiprocessing as mp
 import os
 from tqdm import tqdm as tq
 from generate_gridsearch_params import wrapped_gen_dist
+from results_store import export_results
+from planner import autotune, heaviest_inputs
 
 
-def worker(params):
-    print('Instantiating unicity worker {}'.format(params[-1]))
-    _, _, circ = get_input_dists()
+def results_dir(max_size):
+    nmils = max_size // 1e6
+    return '../results/gridsearch_{:.0f}M/'.format(nmils)
+
+
+def config_inputs(pars, sgs):
+    fpars, apars = pars
+    _, _, circ = get_input_dists(
+        sgs, ['activity.npy', 'circadian.npy', 'frequency.npy'], '../inputs/')
     nhrs = len(circ)
-    fpars, apars = params[3]
     act = gen_act(apars, nhrs)
-    f = gen_freq(fpars, params[6])
+    f = gen_freq(fpars, sgs)
     act = act / act.sum()
     f = f / f.sum()
-    inputs = (act, f, circ)
-    params[3] = inputs
-    df = begin_unicity_series(*params)
-    nmils = params[0] // 1e6
-    df.to_csv(
-        '../results/gridsearch_{:.0f}M/iter_{}.csv'.format(nmils, params[7]))
+    return act, f, circ
+
+
+def worker(params):
+    print('Instantiating unicity worker {}'.format(params[-1]))
+    params[3] = config_inputs(params[3], params[6])
+    # results are appended to a store shared by all workers
+    begin_unicity_series(*params, autosave=results_dir(params[0]),
+                         run='iter_{}'.format(params[7]), legacy_rng=True)
+
+
+def shared_worker(params):
+    """Runs a group of configurations in a single pass over the population,
+    sharing the generated clusters and random numbers between them (see
+    begin_unicity_series_multi).
+    """
+    max_size, step, sample_size, group_pars, pl, cs, sgs, seed, ids = params
+    print('Instantiating shared unicity worker {}'.format(seed))
+    inputs_list = [config_inputs(pars, sgs) for pars in group_pars]
+    begin_unicity_series_multi(max_size, step, sample_size, inputs_list, pl,
+                               cs, sgs, seed, autosave=results_dir(max_size),
+                               run=['iter_{}'.format(i) for i in ids])
 
 
 def instantiate_pool(allpars, max_size, step, sample_size, pl, cs, sgs,
-                     max_nprc):
+                     max_nprc, shared=False):
     nproc = min(max_nprc, len(allpars))
-    data = get_pool_data(max_size, step, allpars, sample_size, pl, cs, sgs)
+    if shared:
+        # one group of configurations per process, all groups use the same
+        # seed so that they also share their sample users
+        groups = np.array_split(np.arange(len(allpars)), nproc)
+        data = [[max_size, step, sample_size, [allpars[i] for i in g], pl,
+                 cs, sgs, 1, list(g + 1)] for g in groups]
+        target = shared_worker
+    else:
+        data = get_pool_data(max_size, step, allpars, sample_size, pl, cs,
+                             sgs)
+        target = worker
     print('begining multiprocessed pool:')
     print('Processes:     {}'.format(nproc))
     print('max_size:      {}'.format(max_size))
@@ -47,15 +80,15 @@ def instantiate_pool(allpars, max_size, step, sample_size, pl, cs, sgs,
     print('point list:    {}'.format(pl))
     print('cluster_size:  {}'.format(cs))
     print('subgraph size: {}'.format(sgs))
-    nmils = max_size // 1e6
-    directory = '../results/gridsearch_{:.0f}M/'.format(nmils)
+    print('shared:        {}'.format(shared))
+    directory = results_dir(max_size)
     if not os.path.exists(directory):
         os.makedirs(directory)
 
     mypool = mp.Pool(nproc)
     jobs = []
     for elem in data:
-        jobs.append(mypool.apply_async(worker, args=(elem,)))
+        jobs.append(mypool.apply_async(target, args=(elem,)))
 
     mypool.close()
 
@@ -64,6 +97,9 @@ def instantiate_pool(allpars, max_size, step, sample_size, pl, cs, sgs,
 
     mypool.join()
 
+    # one CSV per configuration, as in the results folder
+    export_results(os.path.join(directory, 'results.sqlite'), directory)
+
 
 if __name__ == '__main__':
     emthresh = 0.7
@@ -79,12 +115,25 @@ if __name__ == '__main__':
     step = int(5e5)
     sample_size = int(1e4)
     pl = [2, 3, 4, 5]
-    cs = int(1e5)
     sgs = 10
     max_nprc = 12
+    mem_budget = None  # bytes, None for the RAM of the machine
+    # evaluate groups of configurations on shared populations
+    shared = False
+
+    # the chunk size is tuned for this machine and the pool of processes
+    # (see planner.autotune), on the configuration with the most records per
+    # user. Batches stay at step users, as the users drawn with legacy_rng
+    # depend on them.
+    nproc = min(max_nprc, len(allpars))
+    cs = autotune(max_size, step, sample_size,
+                  heaviest_inputs([config_inputs(pars, sgs)
+                                   for pars in allpars]), mem_budget, pl, sgs,
+                  nconfigs=-(-len(allpars) // nproc) if shared else 1,
+                  nprocs=nproc, step_list=[step])['cs']
     # # created in fiiting_forms.ipynb
     # with open('../inputs/gridsearch_params_1M.p', 'rb') as gsp:
     #     allpars = pickle.load(gsp)
 
     instantiate_pool(allpars, max_size, step,
-                     sample_size, pl, cs, sgs, max_nprc)
+                     sample_size, pl, cs, sgs, max_nprc, shared)
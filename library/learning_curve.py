@@ -18,6 +18,7 @@ from collections import Counter
 import unicity_utils as uut
 import os
 import multiprocessing as mp
+from results_store import export_results
 
 
 def extract_time(u2p, lhrs, lants):
@@ -169,7 +170,7 @@ def gen_unicity_vals(inputs, max_size, step, sample_size=int(1e4),
     dflist = []
     for inp in tq(inputs):
         df = uut.begin_unicity_series(
-            max_size, step, sample_size, inp, seed=seed)
+            max_size, step, sample_size, inp, seed=seed, legacy_rng=True)
         dflist.append(df)
     return dflist
 
@@ -180,8 +181,10 @@ def worker(params):
     AF
     """
     max_size, step, sample_size, inp, seed, samppop, resd = params
-    df = uut.begin_unicity_series(max_size, step, sample_size, inp, seed=seed)
-    df.to_csv('{}iter_{:d}.csv'.format(resd, samppop))
+    # results are appended to a store shared by all workers
+    uut.begin_unicity_series(max_size, step, sample_size, inp, seed=seed,
+                             autosave=resd, run='iter_{:d}'.format(samppop),
+                             legacy_rng=True)
 
 
 def instantiate_pool(inputs, sampsizes, max_size, step, sample_size, seed,
@@ -206,7 +209,7 @@ def instantiate_pool(inputs, sampsizes, max_size, step, sample_size, seed,
         proc.get()
 
     mypool.join()
-    pass
+    export_results(os.path.join(resd, 'results.sqlite'), resd)
 
 
 if __name__ == '__main__':
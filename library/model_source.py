@@ -11,15 +11,23 @@ Author: Ali Farzanehfar (AF)
 
 import numpy as np
 import random as rnd
+import multiprocessing as mp
+import hashlib
+import os
+from sampling_utils import draw_with_replacement, draw_without_replacement
+from sampling_utils import inverse_cdf, get_rng
+from dataformat_utils import gather_ranges, project_u2p
 
 
-def gen_cluster(size, ana, ana_keys):
+def gen_cluster(size, ana, ana_keys, rng=None):
     """This generates a cluster of unique antennas of fixed size.
 
     Inputs:
         - size: int, indicates size of cluster
         - ana: dict, output of the get_geo function
         - ana_keys: list, the keys of ana which enumerates all antennas present
+        - rng: numpy.random.Generator or None, if None the global random and
+          numpy.random generators are used (see sampling_utils.get_rng)
 
     Outputs:
         - ndarray of ints which consitutes a connected path of fixed size on
@@ -28,31 +36,41 @@ def gen_cluster(size, ana, ana_keys):
     -------
     AF
     """
-    start = rnd.sample(ana_keys, 1)[0]
+    if rng is None:
+        def pick(seq):
+            return rnd.sample(seq, 1)[0]
+    else:
+        def pick(seq):
+            if isinstance(seq, set):
+                seq = tuple(seq)
+            return seq[rng.integers(len(seq))]
+
+    start = pick(ana_keys)
     current_ant = start
     visited = {current_ant}
     choices = set()
     while len(visited) != size:
         choices = choices.union(ana[current_ant]) - visited
         if len(choices) == 0:  # if this happens then restart
-            current_ant = rnd.sample(ana_keys, 1)[0]
+            current_ant = pick(ana_keys)
             visited = {current_ant}
             choices = choices.union(ana[current_ant]) - visited
-        current_ant = rnd.sample(choices, 1)[0]
+        current_ant = pick(choices)
         visited.add(current_ant)
     v = list(visited)
     v = np.array(v, dtype=np.int32)
-    np.random.shuffle(v)
+    get_rng(rng).shuffle(v)
     return v
 
 
-def create_cluster_array(nusers, size, ana):
+def create_cluster_array(nusers, size, ana, rng=None):
     """Generates a 'nusers' clusters of fixed size on the antenna network
 
     Inputs:
         - nusers: int, number of clusters
         - size: int, size of each cluster
         - ana: dict, output of get_geo
+        - rng: see gen_cluster
 
     Outputs:
         - ndarray of shape (nusers, size)
@@ -63,11 +81,146 @@ def create_cluster_array(nusers, size, ana):
     antlist = list(ana.keys())
     arr = np.zeros((nusers, size), dtype=np.int32)
     for i in range(nusers):
-        arr[i] = gen_cluster(size, ana, antlist)
+        arr[i] = gen_cluster(size, ana, antlist, rng)
     return arr
 
 
-def resampler(nusers, cluster_array, inputs, ana):
+def grow_clusters(nclusters, size, indptr, indices, keys, seed):
+    """Generates clusters in the same way as gen_cluster, but directly on the
+    CSR form of the antenna network (see geoloc_utils.get_geo_csr) and with its
+    own random number generator so it can be run in parallel.
+
+    Inputs:
+        - nclusters: int, number of clusters to generate
+        - size: int, size of each cluster
+        - indptr, indices, keys: CSR antenna network, output of get_geo_csr
+        - seed: int or numpy.random.SeedSequence
+
+    Outputs:
+        - ndarray of shape (nclusters, size)
+
+    -------
+    AF
+    """
+    rng = np.random.default_rng(seed)
+    nbrs = [indices[indptr[a]:indptr[a + 1]].tolist()
+            for a in range(len(indptr) - 1)]
+    keys = keys.tolist()
+    arr = np.zeros((nclusters, size), dtype=np.int32)
+    for i in range(nclusters):
+        visited = []
+        while len(visited) != size:
+            current = keys[rng.integers(len(keys))]
+            visited = [current]
+            vset = {current}
+            choices = set()
+            while len(visited) != size:
+                choices.update(nbrs[current])
+                choices -= vset
+                if len(choices) == 0:  # restart from a new antenna
+                    break
+                choices_t = tuple(choices)
+                current = choices_t[rng.integers(len(choices_t))]
+                visited.append(current)
+                vset.add(current)
+        arr[i] = visited
+    # the order of the antennas in a cluster sets their frequency rank
+    perm = np.argsort(rng.random(arr.shape), axis=1)
+    return np.take_along_axis(arr, perm, axis=1)
+
+
+def _grow_clusters_star(args):
+    return grow_clusters(*args)
+
+
+def get_cluster_bank(geo_csr, size, nbank, seed=0, cachedir='../inputs/cache/',
+                     nproc=1, segment=int(1e5)):
+    """Returns a large bank of pre-computed clusters for a given antenna
+    network and cluster size. The bank is computed once and stored as a .npy
+    file in cachedir, keyed by the hash of the network, the cluster size, the
+    bank size and the seed. It is returned memory-mapped, so that many
+    processes can share it without copying it.
+
+    Inputs:
+        - geo_csr: 3-tuple, output of geoloc_utils.get_geo_csr
+        - size: int, size of each cluster
+        - nbank: int, number of clusters in the bank
+        - seed: int, seed used to generate the bank
+        - cachedir: str, directory where banks are stored
+        - nproc: int, number of processes used to build the bank
+        - segment: int, number of clusters generated by each task
+
+    Outputs:
+        - read-only numpy.memmap of shape (nbank, size)
+
+    -------
+    AF
+    """
+    indptr, indices, keys = geo_csr
+    ghash = hashlib.sha1(indptr.tobytes() + indices.tobytes()).hexdigest()
+    fname = 'cluster_bank.{}.sgs{:d}.n{:d}.s{:d}.npy'.format(
+        ghash[:16], size, nbank, seed)
+    fpath = os.path.join(cachedir, fname)
+    if os.path.exists(fpath):
+        return np.load(fpath, mmap_mode='r')
+
+    os.makedirs(cachedir, exist_ok=True)
+    tmp = '{}.{}.tmp'.format(fpath, os.getpid())
+    bank = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.int32,
+                                     shape=(nbank, size))
+    starts = np.arange(0, nbank, segment)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    tasks = [(min(segment, nbank - st), size, indptr, indices, keys, ss)
+             for st, ss in zip(starts, seeds)]
+    if nproc > 1:
+        with mp.Pool(nproc) as pool:
+            segs = pool.imap(_grow_clusters_star, tasks)
+            for st, seg in zip(starts, segs):
+                bank[st:st + len(seg)] = seg
+    else:
+        for st, task in zip(starts, tasks):
+            bank[st:st + task[0]] = grow_clusters(*task)
+    bank.flush()
+    del bank
+    os.replace(tmp, fpath)
+    return np.load(fpath, mmap_mode='r')
+
+
+def draw_clusters(bank, nusers, reshuffle=True, rng=None):
+    """Draws clusters from a cluster bank (see get_cluster_bank) by random
+    index. Within a call no cluster is used twice unless nusers is larger than
+    the bank, so the reuse rate over a whole run is the total number of users
+    divided by the size of the bank.
+
+    Inputs:
+        - bank: ndarray of shape (nbank, size)
+        - nusers: int, number of clusters to draw
+        - reshuffle: bool, if True the antennas of each drawn cluster are
+          randomly re-ordered. Since the order sets the frequency rank of each
+          antenna, reused clusters are then not exact copies of each other.
+        - rng: see sampling_utils.get_rng
+
+    Outputs:
+        - ndarray of shape (nusers, size)
+
+    -------
+    AF
+    """
+    nbank = len(bank)
+    rng = get_rng(rng)
+    idx = rng.choice(nbank, size=nusers, replace=nusers > nbank)
+    # reading in sorted order keeps the access to the memory map sequential
+    order = np.argsort(idx)
+    arr = np.empty((nusers, bank.shape[1]), dtype=np.int32)
+    arr[order] = bank[idx[order]]
+    if reshuffle:
+        perm = np.argsort(rng.random(arr.shape), axis=1)
+        arr = np.take_along_axis(arr, perm, axis=1)
+    return arr
+
+
+def resampler(nusers, cluster_array, inputs, ana, samplers=None,
+              col_map=None, rng=None):
     """
     Generates synthetic data using the input arrays, the antenna network and
     pre-computed antenna clusters. Returns the information such that it can be
@@ -80,6 +233,13 @@ def resampler(nusers, cluster_array, inputs, ana):
         - inputs: 3-tuple of ndarrays, contains the activity, frequency and
           circadian distibutions
         - ana: dict, used only to enumerate over antennas (see get_geo())
+        - samplers: 3-tuple or None, output of build_input_samplers(inputs).
+          If given, all users are generated at once using these samplers,
+          otherwise users are generated one by one with numpy.random.choice.
+        - col_map: ndarray or None, if given the generated points are
+          projected onto the points queried by the samples (see
+          dataformat_utils.get_projection and project_u2p)
+        - rng: see sampling_utils.get_rng
 
     Outputs:
         - data: ndarray of ones. Indicates values of the sparse matrix
@@ -101,8 +261,20 @@ def resampler(nusers, cluster_array, inputs, ana):
 
     p = n * len(time)
     shape = (nusers, p)
+    rng = get_rng(rng)
 
-    rand_acts = np.random.choice(acts, size=nusers, p=act)
+    if samplers is not None:
+        act_s, f_s, time_s = samplers
+        rand_acts = acts[draw_with_replacement(act_s, nusers, rng)]
+        rows = np.repeat(np.arange(nusers, dtype=np.int32), rand_acts)
+        t = draw_without_replacement(time_s, rand_acts, rng=rng)
+        x = cluster_array[rows, draw_with_replacement(f_s, len(rows), rng)]
+        cols = t * n + x
+        data = np.ones(len(cols), dtype=np.int8)
+        u2p = data, rows, cols, shape, rand_acts
+        return u2p if col_map is None else project_u2p(u2p, col_map)
+
+    rand_acts = rng.choice(acts, size=nusers, p=act)
     nnz = rand_acts.sum()
     rows, cols = np.ones(nnz, dtype=np.int32), np.zeros(nnz, dtype=np.int32)
     data = np.ones(nnz, dtype=np.int8)
@@ -110,16 +282,73 @@ def resampler(nusers, cluster_array, inputs, ana):
     currind = 0
     for user in range(nusers):
         a = rand_acts[user]
-        t = np.random.choice(hrs, size=a, p=time, replace=False)
+        t = rng.choice(hrs, size=a, p=time, replace=False)
         s = cluster_array[user]
-        x = np.random.choice(s, a, p=fbar)
+        x = rng.choice(s, a, p=fbar)
         cols[currind: currind + a] = t * n + x
         rows[currind: currind + a] = user * rows[currind: currind + a]
         currind += a
-    return data, rows, cols, shape, rand_acts
+    u2p = data, rows, cols, shape, rand_acts
+    return u2p if col_map is None else project_u2p(u2p, col_map)
+
+
+def resampler_shared(nusers, cluster_array, inputs_list, ana, time_sampler,
+                     col_map=None, rng=None):
+    """Generates the same synthetic users for several input distributions at
+    once, using common random numbers: the clusters are shared, the activity
+    and frequency rank of each user and point are obtained from the same
+    uniforms through the inverse cdf of each activity and frequency
+    distribution, and the hours of a user are the first hours of a single
+    sequence drawn without replacement from the (shared) circadian
+    distribution.
+
+    Inputs:
+        - nusers: int, indicates the number of users to be generated
+        - cluster_array: ndarray containing pre-computed clusters (see
+          create_cluster_array() for more info)
+        - inputs_list: list of 3-tuples of ndarrays, the activity, frequency
+          and circadian distibutions of each configuration. The circadian
+          distribution must be the same for all configurations.
+        - ana: dict, used only to enumerate over antennas (see get_geo())
+        - time_sampler: sampler of the circadian distribution (see
+          sampling_utils.build_sampler)
+        - col_map, rng: see resampler
+
+    Outputs:
+        - list of 5-tuples, one output of resampler per configuration
+    -------
+    AF
+    """
+    assert len(cluster_array) >= nusers
+    n = len(ana)
+    sgs = cluster_array.shape[1]
+    ntime = len(time_sampler[2])
+    shape = (nusers, n * ntime)
+    assert all(np.array_equal(inputs_list[0][2], inp[2])
+               for inp in inputs_list), 'circadian distributions must match'
 
+    rng = get_rng(rng)
+    u = rng.random(nusers)
+    acts_list = [sgs + inverse_cdf(act, u) for act, _, _ in inputs_list]
+    amax = np.max(acts_list, axis=0)
+    t = draw_without_replacement(time_sampler, amax, rng=rng)
+    v = rng.random(len(t))
+    starts = np.cumsum(amax) - amax
 
-def resampler_non_sparse_matrix(nusers, cluster_array, input_dists, ana):
+    res = []
+    for (_, fbar, _), rand_acts in zip(inputs_list, acts_list):
+        sel = gather_ranges(starts, rand_acts)
+        rows = np.repeat(np.arange(nusers, dtype=np.int32), rand_acts)
+        x = cluster_array[rows, inverse_cdf(fbar, v[sel])]
+        cols = t[sel] * n + x
+        data = np.ones(len(cols), dtype=np.int8)
+        u2p = data, rows, cols, shape, rand_acts
+        res.append(u2p if col_map is None else project_u2p(u2p, col_map))
+    return res
+
+
+def resampler_non_sparse_matrix(nusers, cluster_array, input_dists, ana,
+                                samplers=None, rng=None):
     """Generates the synthetic data and stores data in dictionary.
     See resampler docstring for more info.
 
@@ -127,16 +356,23 @@ def resampler_non_sparse_matrix(nusers, cluster_array, input_dists, ana):
     AF
     """
     assert len(cluster_array) >= nusers
+    if samplers is not None:
+        _, _, cols, _, rand_acts = resampler(nusers, cluster_array,
+                                             input_dists, ana, samplers,
+                                             rng=rng)
+        return dict(enumerate(np.split(cols, np.cumsum(rand_acts)[:-1])))
+
     # unpacking the input distributions
     act, fbar, time = input_dists
     n = len(ana)
     hrs = np.arange(len(time))
     acts = np.arange(cluster_array.shape[1], cluster_array.shape[1] + len(act))
+    rng = get_rng(rng)
     u2p = {}
     for user in range(nusers):
-        a = np.random.choice(acts, p=act)
-        t = np.random.choice(hrs, size=a, p=time, replace=False)
+        a = rng.choice(acts, p=act)
+        t = rng.choice(hrs, size=a, p=time, replace=False)
         s = cluster_array[user]
-        x = np.random.choice(s, a, p=fbar)
+        x = rng.choice(s, a, p=fbar)
         u2p[user] = t * n + x
     return u2p
@@ -0,0 +1,423 @@
+"""
+This file predicts the runtime, peak memory and disk output of a unicity
+series (e.g. 60M_run.py or a gridsearch) before it is launched.
+
+A short calibration generates a small population, draws a few steps of sample
+queries and multiplies them, measuring the time and the memory (tracemalloc)
+of each stage. These are then extrapolated to the full configuration:
+ - generating the users and the sample queries scales with the number of
+   steps,
+ - step i multiplies its users by the queries of the nsteps - i remaining
+   steps, so the multiplications grow quadratically with the number of steps
+   (with an explicit grid of sizes, each batch of users is multiplied by the
+   queries of the sizes it contributes to, see unicity_utils.get_batches),
+ - the population is projected onto the queried points (see get_projection),
+   whose share of the space-time points grows with the number of queries.
+
+autotune uses these predictions to choose the chunk size cs and the size of
+the batches of users (step) of a series on the current machine: it calibrates
+every candidate chunk size, and picks the fastest combination whose predicted
+peak memory fits a budget. The choice is stored in a profile file, and later
+runs with the same machine and configuration read it back.
+
+Running this file plans the configuration given on the command line, or
+autotunes it for a memory budget in GB (default: the RAM of the machine):
+    python planner.py MAX_SIZE STEP [SAMPLE_SIZE [CS]]
+    python planner.py autotune MAX_SIZE STEP [SAMPLE_SIZE [BUDGET]]
+
+Author: Ali Farzanehfar
+"""
+
+import numpy as np
+import time
+import tracemalloc
+import os
+import sys
+import json
+import platform
+import hashlib
+from dataformat_utils import get_input_dists, query_last_use, get_projection
+from dataformat_utils import project_u2p, chunkify_mat_list
+from dataformat_utils import sparsify_mat_list
+from unicity_utils import get_population_generator, get_sample_queries
+from unicity_utils import step_match_counts, get_streams, get_batches
+
+
+PROFILE = '../inputs/cache/autotune.json'
+
+
+def _measure(func, *args):
+    """Runs func(*args) twice, returning its output, its runtime, and the peak
+    memory it allocated (measured in the second run, as tracemalloc slows
+    down the code).
+    -------
+    AF
+    """
+    t0 = time.time()
+    res = func(*args)
+    elapsed = time.time() - t0
+    del res
+    tracemalloc.start()
+    res = func(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return res, elapsed, peak
+
+
+def _nbytes(mats):
+    """Total size of the arrays of sparse matrices or tuples of arrays.
+    -------
+    AF
+    """
+    total = 0
+    for mat in mats:
+        if isinstance(mat, tuple):
+            total += sum(a.nbytes for a in mat if isinstance(a, np.ndarray))
+        else:
+            total += mat.data.nbytes + mat.indices.nbytes + mat.indptr.nbytes
+    return total
+
+
+def calibrate(inputs, sample_size, pl=[2, 3, 4, 5], cs=int(1e4), sgs=10,
+              cluster_bank=None, fast_sampling=False, ncal=int(2e4), nq=3,
+              seed=0):
+    """Measures the cost of each stage of a unicity series on a small
+    population.
+
+    Inputs:
+        - inputs, sample_size, pl, sgs, cluster_bank, fast_sampling: see
+          begin_unicity_series
+        - cs: int, see begin_unicity_series, or list of ints to calibrate
+          several chunk sizes on the same population (see autotune)
+        - ncal: int, number of users generated for the calibration
+        - nq: int, number of steps of sample queries used for the calibration
+        - seed: int, seed of the calibration
+
+    Outputs:
+        - calib: dict of the measured rates, to be passed to plan_run, or
+          list of them if cs is a list
+    -------
+    AF
+    """
+    step_seqs, sample_seqs, _ = get_streams(seed, nq)
+    scal = min(sample_size, ncal // 4)
+    new_population = get_population_generator(
+        [inputs], ncal, sgs, cluster_bank, fast_sampling)
+
+    u2ps, t_gen, m_gen = _measure(new_population, None,
+                                  np.random.default_rng(step_seqs[0]))
+    s_u2p = u2ps[0]
+    nnz = len(s_u2p[2])
+
+    queries, t_query, _ = _measure(get_sample_queries, s_u2p, sample_seqs[0],
+                                   scal, pl, fast_sampling)
+    last_use = query_last_use([queries])
+
+    # share of the nonzeros kept by the projection onto one step of queries
+    col_map, q_rows = get_projection(last_use, nq - 1)
+    kept1 = np.count_nonzero(col_map[s_u2p[2]] >= 0) / nnz
+
+    u2p_1 = project_u2p(s_u2p, col_map)
+    q_rows_1 = q_rows
+    (col_map, q_rows), t_batch, _ = _measure(get_projection, last_use, 0)
+    u2p = project_u2p(s_u2p, col_map)
+
+    npoints = scal * sum(pl)
+    calib = {'ncal': ncal, 'scal': scal,
+             'gen_time': t_gen / ncal,
+             'gen_mem': m_gen / ncal,
+             'user_bytes': _nbytes([s_u2p]) / ncal,
+             'query_time': t_query / (nq * scal),
+             'query_bytes': _nbytes([q for q, _ in queries]) / (nq * scal),
+             # the rate at which queried points capture the nonzeros
+             'kept_rate': -np.log(1 - min(kept1, 1 - 1e-12)) / npoints,
+             'batch_time': t_batch,
+             'npoints': s_u2p[3][1]}
+
+    calibs = []
+    for chunk in (cs if isinstance(cs, list) else [cs]):
+        chunk = min(chunk, ncal)
+        # multiplication against 1 and nq steps of queries
+        _, t_1, _ = _measure(step_match_counts, u2p_1, queries[-1:], pl,
+                             chunk, q_rows_1)
+        chunk_bytes = _nbytes(sparsify_mat_list(chunkify_mat_list(u2p,
+                                                                  chunk)))
+        _, t_m, m_mult = _measure(step_match_counts, u2p, queries, pl, chunk,
+                                  q_rows)
+        per_query = (t_m - t_1) / (nq - 1)
+        calibs.append(dict(
+            calib, cs=chunk,
+            mult_base=max(t_1 - per_query, 0) / ncal,
+            mult_query=max(per_query, 0) / (ncal * scal),
+            chunk_bytes=chunk_bytes / ncal,
+            # the products of a chunk, the chunks are counted above
+            prod_mem=max(m_mult - chunk_bytes, 0) / (chunk * scal)))
+    return calibs if isinstance(cs, list) else calibs[0]
+
+
+def _fmt_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if n < 1024 or unit == 'TB':
+            return '{:.1f} {}'.format(n, unit)
+        n /= 1024
+
+
+def _fmt_time(s):
+    if s < 120:
+        return '{:.1f} s'.format(s)
+    if s < 7200:
+        return '{:.1f} min'.format(s / 60)
+    if s < 172800:
+        return '{:.1f} h'.format(s / 3600)
+    return '{:.1f} days'.format(s / 86400)
+
+
+def plan_run(max_size, step, sample_size, inputs, pl=[2, 3, 4, 5],
+             cs=int(1e4), sgs=10, cluster_bank=None, fast_sampling=False,
+             nconfigs=1, nprocs=1, calib=None, mem_budget=None, verbose=True,
+             sizes=None):
+    """Extrapolates the runtime, peak memory and disk output of a unicity
+    series from a calibration.
+
+    Inputs:
+        - max_size, step, sample_size, inputs, pl, cs, sgs, cluster_bank,
+          fast_sampling: see begin_unicity_series
+        - nconfigs: int, number of configurations evaluated by the series
+          (see begin_unicity_series_multi). The generation cost is counted
+          once per configuration, which is an upper bound.
+        - nprocs: int, number of series run at the same time (e.g. the pool
+          of gridsearch.py). Memory and disk are multiplied by it.
+        - calib: dict or None, output of calibrate. Computed if not given.
+        - mem_budget: int or None, number of bytes. If the predicted peak
+          memory exceeds it, MemoryError is raised.
+        - verbose: bool, if true then print the report
+        - sizes: None or sorted list of ints, see begin_unicity_series
+
+    Outputs:
+        - plan: dict of the predictions (seconds and bytes)
+    -------
+    AF
+    """
+    if calib is None:
+        calib = calibrate(inputs, sample_size, pl, cs, sgs, cluster_bank,
+                          fast_sampling)
+    if sizes is None:
+        sizes = np.arange(step, max_size + step, step)
+    nsteps = len(sizes)
+    batch_sizes, batch_steps = get_batches(sizes, step)
+    # the users of each batch times the number of steps they are queried by
+    nquery_users = (batch_sizes * (nsteps - batch_steps)).sum()
+
+    t_gen = batch_sizes.sum() * calib['gen_time'] * nconfigs
+    t_query = nsteps * sample_size * calib['query_time'] * nconfigs
+    t_mult = nconfigs * (batch_sizes.sum() * calib['mult_base'] +
+                         nquery_users * sample_size * calib['mult_query']) + \
+        len(batch_sizes) * calib['batch_time']  # projections
+
+    # share of the nonzeros kept by the projection of the first step
+    npoints = nsteps * sample_size * sum(pl)
+    kept = 1 - np.exp(-calib['kept_rate'] * npoints)
+    persistent = nconfigs * (
+        batch_sizes[0] * calib['user_bytes'] +  # users of the samples
+        nsteps * sample_size * calib['query_bytes'] +
+        nsteps * sample_size * len(pl) * 8) + \
+        calib['npoints'] * 8  # last_use and col_map
+    # a batch is generated, then split into chunks which are multiplied one
+    # at a time
+    batch = batch_sizes.max()
+    transient = max(batch * calib['gen_mem'] * nconfigs,
+                    batch * calib['chunk_bytes'] +
+                    min(cs, batch) * sample_size * calib['prod_mem'])
+    peak = nprocs * (persistent + transient)
+
+    # one row per step, point count and configuration
+    nrecords = nsteps * len(pl) * nconfigs * nprocs
+    disk = nrecords * 64 + nrecords * 12
+    if cluster_bank:
+        disk += int(cluster_bank) * sgs * 4
+
+    plan = {'nsteps': nsteps, 'generation_time': t_gen,
+            'query_time': t_query, 'multiply_time': t_mult,
+            'total_time': t_gen + t_query + t_mult,
+            'kept_share': kept, 'persistent_memory': nprocs * persistent,
+            'peak_memory': peak, 'disk': disk}
+
+    if verbose:
+        print('Plan for max_size={:d}, step={:d}, sample_size={:d}, '
+              'cs={:d}, pl={}'.format(int(sizes[-1]), step, sample_size, cs,
+                                      pl))
+        print('    {:<26s}{:d}'.format('steps', nsteps))
+        print('    {:<26s}{:d}'.format('batches', len(batch_sizes)))
+        for name in ['generation_time', 'query_time', 'multiply_time',
+                     'total_time']:
+            print('    {:<26s}{}'.format(name.replace('_', ' '),
+                                         _fmt_time(plan[name])))
+        print('    {:<26s}{:.1%}'.format('nonzeros kept (step 1)', kept))
+        for name in ['persistent_memory', 'peak_memory', 'disk']:
+            print('    {:<26s}{}'.format(name.replace('_', ' '),
+                                         _fmt_bytes(plan[name])))
+        if mem_budget is not None:
+            print('    {:<26s}{}'.format('memory budget',
+                                         _fmt_bytes(mem_budget)))
+
+    if mem_budget is not None and peak > mem_budget:
+        raise MemoryError('Predicted peak memory {} exceeds the budget of '
+                          '{}'.format(_fmt_bytes(peak),
+                                      _fmt_bytes(mem_budget)))
+    return plan
+
+
+def _ram():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def _inputs_digest(inputs):
+    return hashlib.sha1(np.concatenate([
+        np.asarray(dist, dtype=np.float64) for dist in inputs]).tobytes()
+    ).hexdigest()
+
+
+def heaviest_inputs(inputs_list):
+    """Returns the input distributions of inputs_list with the most records
+    per user on average, whose series store the most entries and so take the
+    most memory and time. A choice of autotune for them fits the budget for
+    all the others.
+
+    Inputs:
+        - inputs_list: list of 3-tuples of input distributions (see
+          get_input_dists)
+
+    Outputs:
+        - 3-tuple, the element of inputs_list
+    -------
+    AF
+    """
+    return max(inputs_list,
+               key=lambda inputs: np.dot(inputs[0], np.arange(len(inputs[0]))))
+
+
+def autotune(max_size, step, sample_size, inputs, mem_budget=None,
+             pl=[2, 3, 4, 5], sgs=10, cluster_bank=None, fast_sampling=False,
+             nconfigs=1, nprocs=1, sizes=None,
+             cs_list=[int(5e3), int(1e4), int(3e4), int(1e5)], step_list=None,
+             profile=PROFILE, refresh=False, verbose=True):
+    """Chooses the chunk size and the batch size of a unicity series which
+    minimise its predicted runtime (see plan_run) under a memory budget.
+
+    Inputs:
+        - max_size, step, sample_size, inputs, pl, sgs, cluster_bank,
+          fast_sampling, sizes: see begin_unicity_series. They give the
+          population sizes of the series, which do not depend on the choice.
+        - mem_budget: int or None, number of bytes (default: the RAM of the
+          machine)
+        - nconfigs, nprocs: see plan_run
+        - cs_list: list of ints, the candidate chunk sizes, each of which is
+          calibrated on max(cs_list) users
+        - step_list: list of ints or None, the candidate batch sizes (default:
+          step, step / 2, step / 4 and step / 8). Batches larger than step
+          are split (see unicity_utils.get_batches), and batches smaller than
+          sample_size are left out.
+        - profile: str, the JSON file in which the choices are stored
+        - refresh: bool, if true then calibrate again even if the profile
+          holds a choice for this machine and configuration (including the
+          input distributions)
+        - verbose: bool, if true then print the candidates
+
+    Outputs:
+        - tuned: dict with keys 'cs' and 'step', to be passed to
+          begin_unicity_series together with 'sizes' (None if the grid is
+          the linear grid of step), and the predicted 'total_time' and
+          'peak_memory'
+    -------
+    AF
+    """
+    fprint = print if verbose else lambda *x, **y: None
+    mem_budget = _ram() if mem_budget is None else int(mem_budget)
+    if step_list is None:
+        step_list = [step // d for d in [1, 2, 4, 8]]
+    grid = np.arange(step, max_size + step, step) if sizes is None else \
+        np.array(sizes)
+    # the choices of a machine and configuration are stored under the hash
+    # of their description
+    key = hashlib.sha1(json.dumps([
+        platform.node(), os.cpu_count(), _ram(), _inputs_digest(inputs),
+        sample_size, pl, sgs,
+        cluster_bank, fast_sampling, nconfigs, nprocs, grid.tolist(),
+        [int(c) for c in cs_list], [int(s) for s in step_list],
+        mem_budget]).encode()).hexdigest()
+    tuned_all = {}
+    if os.path.exists(profile):
+        with open(profile) as f:
+            tuned_all = json.load(f)
+    if key not in tuned_all or refresh:
+        tuned_all[key] = _tune(grid, sample_size, inputs, mem_budget, pl, sgs,
+                               cluster_bank, fast_sampling, nconfigs, nprocs,
+                               cs_list, step_list, fprint)
+        os.makedirs(os.path.dirname(profile) or '.', exist_ok=True)
+        tmp = '{}.{}.tmp'.format(profile, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(tuned_all, f, indent=1)
+        os.replace(tmp, profile)
+    else:
+        fprint('Autotuning read from {}'.format(profile))
+    tuned = dict(tuned_all[key], sizes=None)
+    if sizes is not None or tuned['step'] != step:
+        tuned['sizes'] = grid.tolist()
+    return tuned
+
+
+def _tune(grid, sample_size, inputs, mem_budget, pl, sgs, cluster_bank,
+          fast_sampling, nconfigs, nprocs, cs_list, step_list, fprint):
+    """Calibrates the candidates of autotune and returns the best one.
+    -------
+    AF
+    """
+    # the plans assume the samples are drawn from the first batch
+    step_list = [batch for batch in step_list if batch >= sample_size]
+    if not step_list:
+        raise ValueError('No candidate batch size holds the sample of {} '
+                         'users'.format(sample_size))
+    best = None
+    calibs = calibrate(inputs, sample_size, pl, [int(c) for c in cs_list],
+                       sgs, cluster_bank, fast_sampling,
+                       ncal=int(max(cs_list)))
+    for cs, calib in zip(cs_list, calibs):
+        rate = 1 / (calib['mult_base'] + sample_size * calib['mult_query'])
+        for batch in step_list:
+            plan = plan_run(grid[-1], int(batch), sample_size, inputs, pl,
+                            int(cs), sgs, cluster_bank, fast_sampling,
+                            nconfigs, nprocs, calib, verbose=False,
+                            sizes=grid)
+            fits = plan['peak_memory'] <= mem_budget
+            fprint('    cs={:<8d} step={:<9d} {:.2e} users/s/step  {:>10s}'
+                   '  {:>10s}{}'.format(int(cs), int(batch), rate,
+                                        _fmt_time(plan['total_time']),
+                                        _fmt_bytes(plan['peak_memory']),
+                                        '' if fits else '  (over budget)'))
+            if fits and (best is None or
+                         plan['total_time'] < best['total_time']):
+                best = {'cs': int(cs), 'step': int(batch),
+                        'total_time': plan['total_time'],
+                        'peak_memory': int(plan['peak_memory'])}
+    if best is None:
+        raise MemoryError('No candidate fits in the budget of {}'.format(
+            _fmt_bytes(mem_budget)))
+    fprint('Chosen: cs={cs}, step={step}'.format(**best))
+    return best
+
+
+if __name__ == '__main__':
+    tune = len(sys.argv) > 1 and sys.argv[1] == 'autotune'
+    args = [float(a) for a in sys.argv[1 + tune:]]
+    max_size, step, sample_size = [
+        int(a) for a in (args + [6e7, 5e5, 1e4][len(args):])[:3]]
+
+    inputs = get_input_dists(10, ['activity.npy', 'circadian.npy',
+                                  'frequency.npy'], '../inputs/')
+    if tune:
+        budget = args[3] * 2 ** 30 if len(args) > 3 else None
+        autotune(max_size, step, sample_size, inputs, budget, refresh=True)
+    else:
+        cs = int(args[3]) if len(args) > 3 else int(1e5)
+        plan_run(max_size, step, sample_size, inputs, cs=cs,
+                 mem_budget=_ram())
@@ -0,0 +1,195 @@
+"""
+This file provides an on-disk cache of synthetic populations, so that runs
+which only differ in what is computed from the population (pl, sample_size,
+resolutions, ...) read the users of each batch from disk instead of
+generating them again.
+
+An entry holds the users of one batch of a series (see
+unicity_utils.get_batches) before their projection onto the queried points,
+in CSR form: indptr (the cumulative activity of the users) and indices (the
+space-time points of their records). It is keyed by the hash of everything
+the users depend on: the random stream of the batch, its size, the input
+distributions, the antenna network, sgs, the cluster bank and the sampling
+method. Entries are read back memory-mapped, and the least recently used
+ones are evicted once the cache exceeds its size bound.
+
+Author: Ali Farzanehfar
+"""
+
+import numpy as np
+import multiprocessing as mp
+import hashlib
+import shutil
+import os
+
+
+_STATS = ['hits', 'misses', 'bytes_read', 'bytes_written', 'evictions']
+
+
+def file_hash(path):
+    """sha1 hex digest of the content of a file.
+    -------
+    AF
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _entry_bytes(path):
+    return sum(os.path.getsize(os.path.join(path, f))
+               for f in os.listdir(path))
+
+
+class PopulationCache:
+    """Size-bounded cache of generated populations in a directory, with one
+    subdirectory of .npy files per entry. The time of the last access of an
+    entry is the modification time of its subdirectory, so that several
+    processes can share the cache.
+
+    The counters of stats() are kept in shared memory, so that the accesses
+    of forked processes (see unicity_utils.prefetch) are counted as well.
+
+    Inputs:
+        - cachedir: str, the directory of the cache
+        - max_bytes: int or None, if given, the least recently used entries
+          are evicted when the cache grows beyond this many bytes
+    -------
+    AF
+    """
+
+    def __init__(self, cachedir='../inputs/cache/population/',
+                 max_bytes=None):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self._stats = mp.Array('q', len(_STATS))
+        os.makedirs(cachedir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """Hashes the parts of a key: ndarrays by their content, anything else
+        by its repr.
+        -------
+        AF
+        """
+        sha = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                sha.update(str(part.dtype).encode())
+                sha.update(np.ascontiguousarray(part).tobytes())
+            else:
+                sha.update(repr(part).encode())
+            sha.update(b'|')
+        return sha.hexdigest()
+
+    def get(self, key):
+        """Reads an entry.
+
+        Inputs:
+            - key: str, output of key
+
+        Outputs:
+            - list of 5-tuples in the format of model_source.resampler, whose
+              cols are memory-mapped, or None if the entry is not cached
+        -------
+        AF
+        """
+        path = os.path.join(self.cachedir, key)
+        try:
+            ncols, nconfigs = np.load(os.path.join(path, 'meta.npy'))
+            u2ps = []
+            for ind in range(nconfigs):
+                indptr = np.load(os.path.join(path, 'indptr{}.npy'.format(
+                    ind)))
+                cols = np.load(os.path.join(path, 'indices{}.npy'.format(
+                    ind)), mmap_mode='r')
+                rand_acts = np.diff(indptr).astype(np.int32)
+                nusers = len(rand_acts)
+                rows = np.repeat(np.arange(nusers, dtype=np.int32),
+                                 rand_acts)
+                u2ps.append((np.ones(len(cols), dtype=np.int8), rows, cols,
+                             (nusers, int(ncols)), rand_acts))
+            os.utime(path)
+            nbytes = _entry_bytes(path)
+        except FileNotFoundError:  # not cached, or evicted meanwhile
+            self._count(misses=1)
+            return None
+        self._count(hits=1, bytes_read=nbytes)
+        return u2ps
+
+    def put(self, key, u2ps):
+        """Writes an entry, then evicts the least recently used entries if the
+        cache is too large.
+
+        Inputs:
+            - key: str, output of key
+            - u2ps: list of 5-tuples, outputs of model_source.resampler
+        -------
+        AF
+        """
+        path = os.path.join(self.cachedir, key)
+        if os.path.exists(path):
+            return
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        np.save(os.path.join(tmp, 'meta.npy'),
+                np.array([u2ps[0][3][1], len(u2ps)], dtype=np.int64))
+        for ind, (_, _, cols, _, rand_acts) in enumerate(u2ps):
+            indptr = np.concatenate([[0], np.cumsum(rand_acts,
+                                                    dtype=np.int64)])
+            np.save(os.path.join(tmp, 'indptr{}.npy'.format(ind)), indptr)
+            np.save(os.path.join(tmp, 'indices{}.npy'.format(ind)),
+                    cols.astype(np.int32, copy=False))
+        nbytes = _entry_bytes(tmp)
+        try:
+            os.replace(tmp, path)
+        except OSError:  # written by another process meanwhile
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self._count(bytes_written=nbytes)
+        if self.max_bytes is not None:
+            self._evict(keep=key)
+
+    def _evict(self, keep):
+        entries = []
+        for name in os.listdir(self.cachedir):
+            path = os.path.join(self.cachedir, name)
+            if name.endswith('.tmp') or not os.path.isdir(path):
+                continue
+            try:
+                entries.append((os.path.getmtime(path), _entry_bytes(path),
+                                name))
+            except FileNotFoundError:
+                pass
+        total = sum(e[1] for e in entries)
+        for _, nbytes, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            # readers keep their memory maps of a removed entry
+            shutil.rmtree(os.path.join(self.cachedir, name),
+                          ignore_errors=True)
+            total -= nbytes
+            self._count(evictions=1)
+
+    def _count(self, **counts):
+        with self._stats.get_lock():
+            for name, val in counts.items():
+                self._stats[_STATS.index(name)] += val
+
+    def stats(self):
+        """Returns the number of hits, misses and evictions and the number of
+        bytes read and written since the cache was opened (or since the last
+        call to reset_stats).
+        -------
+        AF
+        """
+        with self._stats.get_lock():
+            return dict(zip(_STATS, self._stats[:]))
+
+    def reset_stats(self):
+        with self._stats.get_lock():
+            self._stats[:] = [0] * len(_STATS)
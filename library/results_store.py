@@ -0,0 +1,170 @@
+"""
+This file provides an append-only store for unicity results. Each record is
+the unicity of one configuration, at one population size, for one number of
+points. Records are written to a SQLite database by a background thread, so
+that saving results costs a queue insertion in the compute loop and many
+processes can share the same database file. The loader assembles the records
+into the dataframes (and CSV files) of the results folder.
+
+Author: Ali Farzanehfar
+"""
+
+import sqlite3
+import threading
+import queue
+import time
+import os
+import pandas as pd
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS unicity (
+    run TEXT NOT NULL,
+    config INTEGER NOT NULL,
+    step INTEGER NOT NULL,
+    population INTEGER NOT NULL,
+    points INTEGER NOT NULL,
+    unicity REAL NOT NULL,
+    created REAL NOT NULL
+)
+"""
+
+
+def _connect(path):
+    """Opens a connection to the store at path, creating it if needed.
+    -------
+    AF
+    """
+    con = sqlite3.connect(path, timeout=60)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute(_SCHEMA)
+    con.commit()
+    return con
+
+
+class ResultsStore:
+    """Append-only store of unicity records backed by a SQLite database.
+
+    Records are queued by append() and written in batches by a background
+    thread, so append() never waits for the disk or for other processes
+    writing to the same database. close() waits for all records to be written.
+
+    Inputs:
+        - path: str, path of the database file
+    -------
+    AF
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.Queue()
+        self._error = None
+        # make sure the database exists before returning
+        _connect(path).close()
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def append(self, run, config, step, population, unicity):
+        """Queues the results of one step.
+
+        Inputs:
+            - run: str, name of the run
+            - config: int, index of the configuration within the run
+            - step: int, index of the step
+            - population: int, population size of the step
+            - unicity: dict, unicity for each number of points
+        -------
+        AF
+        """
+        if self._error is not None:
+            raise self._error
+        now = time.time()
+        self._queue.put([(run, int(config), int(step), int(population),
+                          int(point), float(u), now)
+                         for point, u in unicity.items()])
+
+    def close(self):
+        """Writes the queued records and stops the background thread.
+        -------
+        AF
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _write(self):
+        con = _connect(self.path)
+        done = False
+        while not done:
+            records = [self._queue.get()]
+            # write everything that has been queued in the meantime at once
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in records:
+                done = True
+            rows = [r for rec in records if rec is not None for r in rec]
+            if not rows:
+                continue
+            try:
+                con.executemany(
+                    'INSERT INTO unicity VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                con.commit()
+            except sqlite3.Error as err:
+                self._error = err
+        con.close()
+
+
+def load_results(path, run=None):
+    """Assembles the records of a store into dataframes.
+
+    Inputs:
+        - path: str, path of the database file
+        - run: str or None, if given only the records of this run are loaded
+
+    Outputs:
+        - dict with (run, config) keys and pandas.DataFrame() values in the
+          same format as the output of begin_unicity_series. If a step was
+          recorded more than once, the latest record is used.
+    -------
+    AF
+    """
+    con = _connect(path)
+    query = 'SELECT rowid, * FROM unicity'
+    params = ()
+    if run is not None:
+        query += ' WHERE run = ?'
+        params = (run,)
+    records = pd.read_sql_query(query, con, params=params)
+    con.close()
+
+    records = records.sort_values('rowid')
+    records = records.drop_duplicates(['run', 'config', 'population',
+                                       'points'], keep='last')
+    res = {}
+    for key, group in records.groupby(['run', 'config']):
+        df = group.pivot(index='population', columns='points',
+                         values='unicity')
+        df.index.name = None
+        df.columns.name = None
+        res[key] = df.sort_index()
+    return res
+
+
+def export_results(path, outdir, fname='{run}.csv', run=None):
+    """Writes the results of a store as CSV files in the layout of the results
+    folder.
+
+    Inputs:
+        - path: str, path of the database file
+        - outdir: str, the folder in which the CSV files are written
+        - fname: str, format of the file names, can use {run} and {config}
+        - run: str or None, if given only this run is exported
+    -------
+    AF
+    """
+    for (crun, config), df in load_results(path, run).items():
+        df.to_csv(os.path.join(outdir, fname.format(run=crun, config=config)))
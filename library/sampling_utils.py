@@ -0,0 +1,321 @@
+"""
+This file contains the weighted sampling routines used to generate synthetic
+trajectories in bulk. A sampler is built once per input distribution and then
+used to draw many values at once:
+ - draws with replacement (activity, frequency) use Walker's alias method,
+   which costs O(1) per draw once the table is built.
+ - draws without replacement (hours) follow the same sequential process as
+   numpy.random.choice(..., replace=False), i.e. every new value is drawn
+   proportionally to the weights of the values not yet chosen. For small draws
+   this is done by rejecting repeated alias draws, and for draws covering a
+   large part of the support with the Gumbel-top-k trick.
+
+Every routine draws from the numpy.random.Generator given as its rng
+argument, or from the global numpy random state if it is None (see get_rng).
+
+Running this file checks the sampled marginals against the legacy numpy
+routines and prints the throughput of both.
+
+Author: Ali Farzanehfar (AF)
+"""
+
+import numpy as np
+import time as timer
+from dataformat_utils import gather_ranges
+
+
+def get_rng(rng=None):
+    """Returns the random number generator to draw from.
+
+    Inputs:
+        - rng: None, numpy.random.Generator, numpy.random.SeedSequence or
+          int. If None, the global numpy random state is returned, so that
+          draws follow numpy.random.seed as in the publication. Otherwise
+          the output of numpy.random.default_rng(rng).
+
+    Outputs:
+        - numpy.random.Generator, or numpy.random.RandomState
+    -------
+    AF
+    """
+    if rng is None:
+        return np.random.mtrand._rand
+    if isinstance(rng, np.random.RandomState):
+        return rng
+    return np.random.default_rng(rng)
+
+
+def build_sampler(p):
+    """Builds the alias table (Vose's method) of a discrete distribution.
+
+    Inputs:
+        - p: ndarray, probabilities of the values 0..len(p)-1
+
+    Outputs:
+        - sampler: 3-tuple (prob, alias, p) of ndarrays to be passed to
+          draw_with_replacement and draw_without_replacement
+    -------
+    AF
+    """
+    p = np.asarray(p, dtype=np.float64)
+    p = p / p.sum()
+    n = len(p)
+    prob = p * n
+    alias = np.arange(n, dtype=np.int32)
+    small = list(np.nonzero(prob < 1)[0])
+    large = list(np.nonzero(prob >= 1)[0])
+    while small and large:
+        s = small.pop()
+        lg = large[-1]
+        alias[s] = lg
+        prob[lg] = prob[lg] + prob[s] - 1
+        if prob[lg] < 1:
+            small.append(large.pop())
+    # what is left is only due to rounding errors
+    prob[small] = 1
+    prob[large] = 1
+    return prob, alias, p
+
+
+def build_input_samplers(inputs):
+    """Builds the samplers of the three input distributions.
+
+    Inputs:
+        - inputs: 3-tuple of ndarrays, the activity, frequency and circadian
+          distributions (see get_input_dists)
+
+    Outputs:
+        - 3-tuple of samplers in the same order as inputs
+    -------
+    AF
+    """
+    return tuple(build_sampler(dist) for dist in inputs)
+
+
+def draw_with_replacement(sampler, size, rng=None):
+    """Draws 'size' values from the distribution of a sampler.
+
+    Inputs:
+        - sampler: 3-tuple, output of build_sampler
+        - size: int or tuple, number (or shape) of values to draw
+        - rng: see get_rng
+
+    Outputs:
+        - ndarray of int32 of indices drawn with probabilities p
+    -------
+    AF
+    """
+    prob, alias, _ = sampler
+    # the integer part picks the column of the table, the fractional part is
+    # the uniform used to accept it or take its alias
+    u = get_rng(rng).random(size) * len(prob)
+    ind = u.astype(np.int32)
+    u -= ind
+    return np.where(u < prob[ind], ind, alias[ind])
+
+
+def _gumbel_top_k(logp, counts, rng):
+    """Returns, for each row, the 'counts' values with the largest Gumbel
+    perturbed log-probabilities in decreasing order of their keys, which is
+    the order in which they would have been drawn sequentially. See
+    draw_without_replacement.
+    -------
+    AF
+    """
+    keys = logp - np.log(-np.log(rng.random((len(counts), len(logp)))))
+    order = np.argsort(-keys, axis=1).astype(np.int32)
+    return order[np.arange(len(logp))[None, :] < counts[:, None]]
+
+
+def _reject_repeats(sampler, counts, seen, rows, out, starts, rng,
+                    group=4096):
+    """Writes, for each row, the first 'counts' distinct values of a stream of
+    alias draws into out[starts[row]:starts[row] + counts[row]], using seen to
+    mark the values already drawn. See draw_without_replacement.
+
+    Rows are processed in groups of similar counts. The draws of a group are
+    stored in a (ndraws, group) array which is then scanned one draw of every
+    row at a time, so that no sorting is needed.
+    -------
+    AF
+    """
+    n = seen.shape[1]
+    flat_seen = seen.reshape(-1)
+    got = np.zeros(len(rows), dtype=np.int64)
+    pending = np.argsort(counts, kind='stable')
+    while len(pending):
+        for g0 in range(0, len(pending), group):
+            grp = pending[g0:g0 + group]
+            grows = rows[grp]
+            gcounts = counts[grp]
+            gpos = starts[grp] + got[grp]
+            gend = starts[grp] + gcounts
+            # over-draw a little so that most rows finish in one round
+            ndraws = int((gcounts - got[grp]).max() * 1.2) + 8
+            draws = draw_with_replacement(sampler, (ndraws, len(grp)), rng)
+            active = np.arange(len(grp))
+            for j, d in enumerate(draws):
+                if j % 32 == 0:
+                    # drop the rows which are already complete
+                    active = active[gpos[active] < gend[active]]
+                    if len(active) == 0:
+                        break
+                    base = grows[active] * n
+                    apos, aend = gpos[active], gend[active]
+                d = d[active]
+                idx = base + d
+                new = ~flat_seen[idx] & (apos < aend)
+                flat_seen[idx[new]] = True
+                out[apos[new]] = d[new]
+                apos += new
+                gpos[active] = apos
+            got[grp] = gpos - starts[grp]
+        pending = pending[got[pending] < counts[pending]]
+
+
+def draw_without_replacement(sampler, counts, batch=int(2e4), rng=None):
+    """Draws counts[i] distinct values for every i, as a sequence of draws
+    without replacement from the distribution of a sampler. This is equivalent
+    to calling numpy.random.choice(len(p), counts[i], p=p, replace=False) for
+    each i, but is done in bulk.
+
+    Inputs:
+        - sampler: 3-tuple, output of build_sampler
+        - counts: ndarray of ints, the number of values for each draw
+        - batch: int, number of draws processed at once (bounds the memory)
+        - rng: see get_rng
+
+    Outputs:
+        - ndarray of int32 of size counts.sum() containing the values of each
+          draw back to back, in the order in which they were drawn. Any prefix
+          of a draw is thus itself a draw without replacement of that size.
+    -------
+    AF
+    """
+    _, _, p = sampler
+    n = len(p)
+    rng = get_rng(rng)
+    counts = np.asarray(counts, dtype=np.int64)
+    assert counts.max(initial=0) <= np.count_nonzero(p), \
+        'Cannot draw more distinct values than the size of the support'
+    with np.errstate(divide='ignore'):
+        logp = np.log(p)
+    out = np.empty(counts.sum(), dtype=np.int32)
+    starts = np.cumsum(counts) - counts
+    for b0 in range(0, len(counts), batch):
+        c = counts[b0:b0 + batch]
+        seen = np.zeros((len(c), n), dtype=bool)
+        # rejection becomes slow once most of the support has been drawn
+        big = c > n // 2
+        rows = np.nonzero(big)[0]
+        if len(rows):
+            out[gather_ranges(starts[b0 + rows], c[rows])] = \
+                _gumbel_top_k(logp, c[rows], rng)
+        rows = np.nonzero(~big)[0]
+        if len(rows):
+            _reject_repeats(sampler, c[rows], seen, rows, out,
+                            starts[b0 + rows], rng)
+    return out
+
+
+def inverse_cdf(p, u):
+    """Maps uniform values u in [0, 1) to values drawn with probabilities p.
+    Used to couple draws from different distributions through the same
+    uniforms (common random numbers).
+
+    Inputs:
+        - p: ndarray, probabilities of the values 0..len(p)-1
+        - u: ndarray of uniform values
+
+    Outputs:
+        - ndarray of int32 of the same shape as u
+    -------
+    AF
+    """
+    cdf = np.cumsum(p)
+    ind = np.searchsorted(cdf / cdf[-1], u, side='right')
+    return np.minimum(ind, len(p) - 1).astype(np.int32)
+
+
+def draw_from_segments(lengths, k, rng=None):
+    """Uniformly chooses k distinct positions within each segment of a flat
+    array made of segments of the given lengths (e.g. k points from each user
+    in the cols array of resampler).
+
+    Inputs:
+        - lengths: ndarray of ints, the length of each segment
+        - k: int, number of positions to choose in each segment
+        - rng: see get_rng
+
+    Outputs:
+        - ndarray of int64 of size k * len(lengths), indices into the flat
+          array, grouped by segment
+    -------
+    AF
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    assert lengths.min(initial=k) >= k
+    total = lengths.sum()
+    starts = np.cumsum(lengths) - lengths
+    seg = np.repeat(np.arange(len(lengths)), lengths)
+    order = np.lexsort((get_rng(rng).random(total), seg))
+    rank = np.arange(total) - np.repeat(starts, lengths)
+    return order[rank < k]
+
+
+if __name__ == '__main__':
+    from dataformat_utils import get_input_dists
+
+    np.random.seed(1038)
+    act, fbar, time = get_input_dists(
+        10, ['activity.npy', 'circadian.npy', 'frequency.npy'], '../inputs/')
+    act_s, f_s, time_s = build_input_samplers((act, fbar, time))
+    nacts = int(1e6)
+
+    print('With replacement (activity), {:.0e} draws:'.format(nacts))
+    t0 = timer.time()
+    legacy = np.random.choice(len(act), size=nacts, p=act)
+    t1 = timer.time()
+    fast = draw_with_replacement(act_s, nacts)
+    t2 = timer.time()
+    # the expected TV distance of nacts exact draws, from the normal
+    # approximation of the count of each value
+    expected = 0.5 * np.sum(np.sqrt(2 * act * (1 - act) / (np.pi * nacts)))
+    print('    expected TV distance: {:.4f}'.format(expected))
+    for name, draws in [('legacy', legacy), ('alias', fast)]:
+        emp = np.bincount(draws, minlength=len(act)) / nacts
+        tv = 0.5 * np.abs(emp - act).sum()
+        print('    {:7s} TV distance: {:.4f}'.format(name, tv))
+        assert tv < 1.5 * expected, \
+            'The {} draws do not follow the distribution'.format(name)
+    print('    legacy: {:.2e} draws/s, alias: {:.2e} draws/s'.format(
+        nacts / (t1 - t0), nacts / (t2 - t1)))
+
+    nusers = int(5e3)
+    counts = np.random.choice(np.arange(10, 10 + len(act)), size=nusers,
+                              p=act)
+    print('Without replacement (hours), {} users:'.format(nusers))
+    t0 = timer.time()
+    legacy = np.concatenate([
+        np.random.choice(len(time), size=a, p=time, replace=False)
+        for a in counts])
+    t1 = timer.time()
+    fast = draw_without_replacement(time_s, counts)
+    t2 = timer.time()
+    # every user's draw must be made of distinct values
+    seg = np.repeat(np.arange(nusers), counts)
+    assert len(np.unique(seg * len(time) + fast)) == len(fast)
+    emp_l = np.bincount(legacy, minlength=len(time)) / nusers
+    emp_f = np.bincount(fast, minlength=len(time)) / nusers
+    # the expected mean absolute difference between the inclusion rates of
+    # two independent exact draws
+    rate = (emp_l + emp_f) / 2
+    expected = np.mean(np.sqrt(4 * rate * (1 - rate) / (np.pi * nusers)))
+    diff = np.abs(emp_l - emp_f).mean()
+    print('    mean abs. difference of inclusion rates: {:.4f} '
+          '(expected {:.4f}, mean rate {:.4f})'.format(diff, expected,
+                                                       emp_l.mean()))
+    assert diff < 1.5 * expected, \
+        'The fast hours do not follow those of numpy.random.choice'
+    print('    legacy: {:.2e} users/s, fast: {:.2e} users/s'.format(
+        nusers / (t1 - t0), nusers / (t2 - t1)))
@@ -0,0 +1,361 @@
+"""
+This file contains a long-running local unicity service, so that many small
+unicity series do not each pay for the imports and for loading the antenna
+network, the input distributions and the cluster bank, and so that they can
+share a population cache (see population_cache.py).
+
+The service listens on a Unix socket or on a TCP port of the local machine
+(multiprocessing.connection, as distributed.py) and runs the requested series
+on a pool of worker processes, forked once everything has been loaded. The
+results of every step of a series are sent back to the client as soon as they
+are computed, followed by the dataframe of the whole series. A series whose
+worker dies (e.g. killed when out of memory) fails instead of never
+completing, and the pool replaces the worker.
+
+The service is started with:
+    python service.py [ADDRESS [NWORKERS [CACHEDIR]]]
+where ADDRESS is the path of a Unix socket or HOST:PORT, and prints a random
+key. It is queried with ServiceClient, which reads the key from
+UNICITY_AUTHKEY or UNICITY_AUTHKEY_FILE (see distributed.read_authkey) unless
+it is given one. The messages are pickled, so anyone holding the key can run
+code on the service.
+
+Author: Ali Farzanehfar
+"""
+
+import multiprocessing as mp
+import threading
+import itertools
+import traceback
+import queue
+import time
+import os
+import sys
+from multiprocessing.connection import Listener, Client
+from multiprocessing import AuthenticationError
+from unicity_utils import begin_unicity_series, get_population_generator
+from dataformat_utils import get_input_dists
+from population_cache import PopulationCache
+from distributed import new_authkey, read_authkey
+
+
+# the state of the pool workers, inherited from the service
+_WORKER = {}
+
+
+class _QueueSink:
+    """Forwards the rows of a series to the service (see
+    unicity_utils.begin_unicity_series).
+    -------
+    AF
+    """
+
+    def __init__(self, job):
+        self.job = job
+
+    def append(self, run, config, step, population, unicity):
+        _WORKER['results'].put(('row', self.job, int(population),
+                                dict(unicity), int(config)))
+
+
+def _init_worker(results, cache):
+    _WORKER.update(results=results, cache=cache)
+
+
+def _run_job(job, request):
+    # the service fails the job if this process dies before it completes
+    _WORKER['results'].put(('start', job, os.getpid()))
+    try:
+        cache = _WORKER['cache']
+        if cache is not None and request.get('seed') is not None and \
+                not request.get('legacy_rng'):
+            request.setdefault('cache', cache)
+        df = begin_unicity_series(sink=_QueueSink(job), **request)
+        _WORKER['results'].put(('done', job, df))
+    except Exception:
+        _WORKER['results'].put(('error', job, traceback.format_exc()))
+
+
+def _load_inputs(sgs):
+    return get_input_dists(sgs, ['activity.npy', 'circadian.npy',
+                                 'frequency.npy'], '../inputs/')
+
+
+def _complete_request(request, inputs, sgs, cluster_bank):
+    """Fills in the defaults of a request and checks it. sgs and
+    cluster_bank default to those of the service, and inputs to the input
+    distributions of the service if the request has its sgs.
+    -------
+    AF
+    """
+    request = dict(request)
+    request.setdefault('sgs', sgs)
+    request.setdefault('cluster_bank', cluster_bank)
+    if request.get('inputs') is None:
+        # the frequency vector has one entry per antenna of a cluster
+        request['inputs'] = inputs if request['sgs'] == sgs else \
+            _load_inputs(request['sgs'])
+    if request.get('sizes') is not None:
+        request['sizes'] = sorted(int(s) for s in request['sizes'])
+        request.setdefault('max_size', request['sizes'][-1])
+    for name in ['max_size', 'step', 'sample_size']:
+        if name not in request:
+            raise ValueError('The request has no {}'.format(name))
+    if request.get('nproc', 0) > 0:
+        raise ValueError('nproc is not available, the series of the '
+                         'service are already run by a pool of processes')
+    if request.get('autosave') or request.get('sink') is not None:
+        raise ValueError('The results are sent back to the client')
+    request['verbose'] = False
+    return request
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def run_service(address=('localhost', 0), authkey=None, nworkers=1,
+                cachedir=None, max_bytes=None, sgs=10, cluster_bank=None,
+                verbose=False, check_every=1.):
+    """Loads the inputs of the model and serves unicity series until a
+    client asks for the service to stop.
+
+    Inputs:
+        - address: str, the path of a Unix socket, or 2-tuple (host, port)
+          of a TCP port. Port 0 picks a free port.
+        - authkey: bytes or None, the key shared with the clients. If None,
+          a random key is drawn and printed in hexadecimal, for the clients
+          to read (see distributed.read_authkey).
+        - nworkers: int, number of series computed at the same time
+        - cachedir: str or None, if given, the series with a seed share a
+          population cache in this directory (see PopulationCache)
+        - max_bytes: int or None, the size bound of the population cache
+        - sgs, cluster_bank: the cluster size and bank loaded in advance
+          (see begin_unicity_series), and the defaults of the requests.
+          Requests for other values work, but load their network and bank
+          in the worker running them.
+        - verbose: bool, if true then print the requests
+        - check_every: float, the interval in seconds at which the workers
+          running a series are checked. The series of a worker which died
+          fail.
+    -------
+    AF
+    """
+    if authkey is None:
+        authkey = new_authkey()
+        print('Service key: {}'.format(authkey.hex()), flush=True)
+    fprint = print if verbose else lambda *x, **y: None
+    fprint('Loading inputs...')
+    inputs = _load_inputs(sgs)
+    get_population_generator([inputs], 1, sgs, cluster_bank)
+    cache = PopulationCache(cachedir, max_bytes) if cachedir else None
+
+    # the workers are forked now, so that they start with everything loaded
+    ctx = mp.get_context('fork')
+    results = ctx.Queue()
+    pool = ctx.Pool(nworkers, _init_worker, (results, cache))
+
+    family = 'AF_UNIX' if isinstance(address, str) else 'AF_INET'
+    listener = Listener(address, family, authkey=authkey)
+    fprint('Unicity service listening on {}'.format(listener.address))
+    lock = threading.Lock()
+    routes = {}  # job -> function sending to its client
+    running = {}  # job -> pid of the worker running it
+    jobs = itertools.count()
+    counts = {'submitted': 0, 'done': 0, 'failed': 0}
+    stopping = threading.Event()
+
+    def forward(send, msg):
+        if send is not None:
+            try:
+                send(msg)
+            except OSError:  # the client is gone
+                pass
+
+    def check_workers():
+        with lock:
+            dead = [(job, pid) for job, pid in running.items()
+                    if not _is_alive(pid)]
+            sends = []
+            for job, pid in dead:
+                del running[job]
+                sends.append((routes.pop(job, None), job, pid))
+                counts['failed'] += 1
+        for send, job, pid in sends:
+            fprint('Job {}: worker {} died'.format(job, pid))
+            forward(send, ('error', job, 'The worker {} running the series '
+                           'died (e.g. out of memory)'.format(pid)))
+
+    def dispatch():
+        checked = time.time()
+        while True:
+            try:
+                msg = results.get(timeout=check_every)
+            except queue.Empty:
+                msg = ()
+            if msg is None:
+                return
+            if time.time() - checked >= check_every:
+                check_workers()
+                checked = time.time()
+            if not msg:
+                continue
+            with lock:
+                if msg[0] == 'start':
+                    if msg[1] in routes:
+                        running[msg[1]] = msg[2]
+                    continue
+                send = routes.get(msg[1])
+                if msg[0] != 'row':
+                    routes.pop(msg[1], None)
+                    running.pop(msg[1], None)
+                    counts['done' if msg[0] == 'done' else 'failed'] += 1
+            forward(send, msg)
+
+    def serve(conn):
+        send_lock = threading.Lock()
+
+        def send(msg):
+            with send_lock:
+                conn.send(msg)
+
+        try:
+            while True:
+                msg = conn.recv()
+                if msg[0] == 'series':
+                    job = next(jobs)
+                    try:
+                        request = _complete_request(msg[1], inputs, sgs,
+                                                    cluster_bank)
+                    except ValueError as err:
+                        send(('error', job, str(err)))
+                        continue
+                    fprint('Job {}: {}'.format(job, {
+                        k: v for k, v in request.items() if k != 'inputs'}))
+                    with lock:
+                        routes[job] = send
+                        counts['submitted'] += 1
+                    send(('accepted', job))
+                    pool.apply_async(_run_job, (job, request))
+                elif msg[0] == 'stats':
+                    with lock:
+                        stats = dict(counts, workers=nworkers,
+                                     running=len(routes))
+                    if cache is not None:
+                        stats['cache'] = cache.stats()
+                    send(('stats', stats))
+                elif msg[0] == 'shutdown':
+                    send(('bye',))
+                    stopping.set()
+                    # wakes up the accept of the main thread
+                    Client(listener.address, family, authkey=authkey).close()
+                    return
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    dispatcher = threading.Thread(target=dispatch, daemon=True)
+    dispatcher.start()
+    while not stopping.is_set():
+        try:
+            conn = listener.accept()
+        except (OSError, EOFError, AuthenticationError):  # e.g. a wrong key
+            continue
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    listener.close()
+    pool.terminate()
+    results.put(None)
+    dispatcher.join()
+    fprint('Unicity service stopped')
+
+
+class ServiceClient:
+    """Client of a unicity service (see run_service).
+
+    Inputs:
+        - address: str or 2-tuple, the address of the service
+        - authkey: bytes or None, the key shared with the service. If None,
+          it is read with distributed.read_authkey.
+    -------
+    AF
+    """
+
+    def __init__(self, address, authkey=None):
+        if authkey is None:
+            authkey = read_authkey()
+        family = 'AF_UNIX' if isinstance(address, str) else 'AF_INET'
+        self.conn = Client(address, family, authkey=authkey)
+
+    def series(self, on_row=None, timeout=None, **request):
+        """Computes a unicity series on the service.
+
+        Inputs:
+            - on_row: function or None, called with the population, the dict
+              of the unicity for each number of points and the index of the
+              curve (see resolutions) of every step as soon as the service
+              sends them
+            - timeout: float or None, if given, the largest number of
+              seconds to wait for the next message of the service, after
+              which TimeoutError is raised
+            - request: the keyword arguments of begin_unicity_series. sgs
+              and cluster_bank default to those of the service (see
+              run_service), whose network, bank and inputs are loaded in
+              advance. inputs defaults to the input distributions of the
+              service for its sgs, and to those of the sgs of the request
+              otherwise. max_size defaults to the largest of sizes.
+
+        Outputs:
+            - df: pandas.DataFrame(), see begin_unicity_series
+        -------
+        AF
+        """
+        self.conn.send(('series', request))
+        while True:
+            if timeout is not None and not self.conn.poll(timeout):
+                raise TimeoutError('The unicity service sent nothing for '
+                                   '{} seconds'.format(timeout))
+            msg = self.conn.recv()
+            if msg[0] == 'row':
+                if on_row is not None:
+                    on_row(msg[2], msg[3], msg[4])
+            elif msg[0] == 'done':
+                return msg[2]
+            elif msg[0] == 'error':
+                raise RuntimeError('The unicity service failed:\n' + msg[2])
+
+    def stats(self):
+        """Returns the number of series submitted, done, failed and running,
+        and the statistics of the population cache.
+        -------
+        AF
+        """
+        self.conn.send(('stats',))
+        return self.conn.recv()[1]
+
+    def shutdown(self):
+        """Stops the service.
+        -------
+        AF
+        """
+        self.conn.send(('shutdown',))
+        self.conn.recv()
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    address = sys.argv[1] if len(sys.argv) > 1 else '/tmp/unicity.sock'
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        address = (host, int(port))
+    nworkers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    cachedir = sys.argv[3] if len(sys.argv) > 3 else None
+    run_service(address, nworkers=nworkers, cachedir=cachedir, verbose=True)
@@ -10,23 +10,39 @@ Author: Ali Farzanehfar (AF)
 import numpy as np
 import os
 from scipy import sparse as sps
-from dataformat_utils import sparsify_mat_list, vstack_multiply
-from dataformat_utils import chunkify_mat_list
-from geoloc_utils import get_geo
+from dataformat_utils import sparsify_mat_list, stack_queries, hstack_queries
+from dataformat_utils import chunkify_mat_list, multiply_matches
+from dataformat_utils import nested_matches
+from dataformat_utils import query_last_use, get_projection, project_u2p
+from dataformat_utils import gather_ranges, coarsen_query, coarsen_columns
+from dataformat_utils import coarsen_u2p, concat_u2p
+from geoloc_utils import get_geo, get_geo_csr, get_geo_legacy
 from model_source import create_cluster_array, resampler
-from collections import defaultdict
+from model_source import get_cluster_bank, draw_clusters, resampler_shared
+from sampling_utils import build_input_samplers, build_sampler
+from sampling_utils import draw_from_segments, get_rng
+from results_store import ResultsStore
+from population_cache import file_hash
+from collections import defaultdict, deque
 import pandas as pd
 import random as rnd
+import threading
+import queue
+import time
+import multiprocessing as mp
 from tqdm import tqdm as tq
 
 
-def get_sample(u2p, sample_size, seed=None):
+def get_sample(u2p, sample_size, seed=None, rng=None):
     """Randomly samples a part of the original u2p matrix.
 
     Inputs:
         - u2p: 5-tuple, output of resampler
         - sample_size: int, specifies the size of population to be sampled
-        - seed: int, a seed for the numpy random number generator
+        - seed: int, a seed for the global numpy random number generator
+        - rng: numpy.random.Generator or None, if given the sample is drawn
+          from it instead of the global generator (see
+          sampling_utils.get_rng)
 
     Outputs:
         - sample: 5-tuple similar to output of resampler
@@ -37,34 +53,198 @@ def get_sample(u2p, sample_size, seed=None):
     if seed is not None:
         np.random.seed(seed)
 
+    n = u2p[3][0]
+    pop = get_rng(rng).choice(np.arange(n, dtype=np.int32),
+                              size=sample_size, replace=False)
+    return select_users(u2p, pop)
+
+
+def select_users(u2p, pop):
+    """Extracts the given users of u2p, in the given order.
+
+    Inputs:
+        - u2p: 5-tuple, output of resampler
+        - pop: ndarray of ints, the rows of the users to extract
+
+    Outputs:
+        - sample: 5-tuple similar to output of resampler
+    -------
+    AF
+    """
     data, rows, cols, shape, rand_acts = u2p
-    n, p = shape
-    pop = np.random.choice(np.arange(n, dtype=np.int32),
-                           size=sample_size, replace=False)
     sacts = rand_acts[pop]
+    starts = np.cumsum(rand_acts, dtype=np.int64) - rand_acts
+    ss = (len(pop), shape[1])  # sample shape
 
-    start_inds = np.cumsum(rand_acts, dtype=np.int32)
-    ss = (sample_size, p)  # sample shape
-
-    ll = sacts.sum()
-    sr = np.ones(ll, dtype=np.int32)  # rows
-    sc = np.zeros(ll, dtype=np.int32)  # cols
-    sd = np.ones(ll, dtype=np.int8)  # data
-
-    cind = 0
-    for user in range(sample_size):
-        ind = pop[user]
-        a = sacts[user]
-        sr[cind:cind + a] = user * sr[cind:cind + a]
-        start = start_inds[ind]
-        sc[cind:cind + a] = cols[start - a:start]
-        cind += a
+    sr = np.repeat(np.arange(len(pop), dtype=np.int32), sacts)  # rows
+    sc = cols[gather_ranges(starts[pop], sacts)]  # cols
+    sd = np.ones(len(sc), dtype=np.int8)  # data
     return sd, sr, sc, ss, sacts
 
 
+def get_strata(rand_acts, nstrata):
+    """Splits users into strata of similar activity, using the quantiles of
+    the activity. Strata which are empty because of ties are dropped.
+
+    Inputs:
+        - rand_acts: ndarray, the activity of each user (see resampler)
+        - nstrata: int, the number of strata
+
+    Outputs:
+        - members: list of ndarrays, the users of each stratum
+        - weights: ndarray, the share of the users in each stratum
+    -------
+    AF
+    """
+    edges = np.quantile(rand_acts, np.linspace(0, 1, nstrata + 1)[1:-1])
+    labels = np.searchsorted(np.unique(edges), rand_acts, side='right')
+    members = [np.flatnonzero(labels == h) for h in np.unique(labels)]
+    weights = np.array([len(m) for m in members]) / len(rand_acts)
+    return members, weights
+
+
+def allocate_sample(members, weights, sample_size, sd=None, min_size=2):
+    """Splits the sample between strata.
+
+    Inputs:
+        - members, weights: output of get_strata
+        - sample_size: int, the total sample size
+        - sd: ndarray or None, the standard deviation of uniqueness in each
+          stratum. If given, the sample is split proportionally to
+          weights * sd (Neyman allocation), otherwise to the weights.
+        - min_size: int, the smallest sample of a stratum, so that its
+          variance can be estimated
+
+    Outputs:
+        - counts: ndarray of ints summing to sample_size, the sample size of
+          each stratum
+    -------
+    AF
+    """
+    share = weights if sd is None else weights * sd
+    if share.sum() == 0:
+        share = weights
+    share = share / share.sum()
+    sizes = np.array([len(m) for m in members])
+    counts = np.minimum(np.maximum(np.floor(share * sample_size), min_size),
+                        sizes).astype(int)
+    # hand out (or take back) the rest by largest remainder
+    target = share * sample_size
+    while counts.sum() < sample_size:
+        room = np.flatnonzero(counts < sizes)
+        counts[room[np.argmax((target - counts)[room])]] += 1
+    while counts.sum() > sample_size:
+        room = np.flatnonzero(counts > np.minimum(min_size, sizes))
+        counts[room[np.argmin((target - counts)[room])]] -= 1
+    return counts
+
+
+def get_stratified_sample(u2p, members, counts, seed=None, rng=None):
+    """Samples counts[h] users uniformly from each stratum h. The users of the
+    sample are grouped by stratum, in the order of the strata.
+
+    Inputs:
+        - u2p: 5-tuple, output of resampler
+        - members: list of ndarrays, see get_strata
+        - counts: ndarray of ints, see allocate_sample
+        - seed, rng: see get_sample
+
+    Outputs:
+        - sample: 5-tuple similar to output of resampler
+    -------
+    AF
+    """
+    if seed is not None:
+        np.random.seed(seed)
+    rng = get_rng(rng)
+    pop = np.concatenate([rng.choice(m, size=c, replace=False)
+                          for m, c in zip(members, counts)])
+    return select_users(u2p, pop)
+
+
+def stratified_estimate(unique, counts, weights):
+    """Estimates the unicity of a population from a stratified sample.
+
+    Inputs:
+        - unique: bool ndarray whose last axis is the sample, grouped by
+          stratum (see get_stratified_sample)
+        - counts: ndarray of ints, the sample size of each stratum
+        - weights: ndarray, the share of the population in each stratum
+
+    Outputs:
+        - est: ndarray, the estimated unicity (the mean of unique for a
+          single stratum)
+        - var: ndarray, the estimated variance of est
+    -------
+    AF
+    """
+    starts = np.cumsum(counts) - counts
+    p_h = np.add.reduceat(unique, starts, axis=-1, dtype=np.int64) / counts
+    est = (p_h * weights).sum(axis=-1)
+    var = (weights ** 2 * p_h * (1 - p_h) /
+           np.maximum(counts - 1, 1)).sum(axis=-1)
+    return est, var
+
+
+def get_sample_strata(s_u2p, sample_size, pl, cs, nstrata, allocation,
+                      fast_sampling, rng=None):
+    """Stratifies the users of s_u2p by activity and splits the sample
+    between the strata.
+
+    With Neyman allocation, the standard deviation of uniqueness in each
+    stratum is estimated from a uniform pilot sample matched against s_u2p
+    itself, and averaged over the numbers of points. Since unicity is
+    higher in s_u2p than in larger populations, this only approximates the
+    optimal split, which affects the variance but not the bias of the
+    estimates.
+
+    Inputs:
+        - s_u2p: 5-tuple, output of resampler
+        - sample_size, pl, cs, fast_sampling: see begin_unicity_series
+        - nstrata: int, see get_strata
+        - allocation: str, 'neyman' or 'proportional'
+        - rng: numpy.random.Generator or None, the generator of the pilot
+          (see sampling_utils.get_rng)
+
+    Outputs:
+        - members, counts, weights: see get_strata and allocate_sample
+    -------
+    AF
+    """
+    members, weights = get_strata(s_u2p[4], nstrata)
+    sd = None
+    if allocation == 'neyman':
+        pilot = get_rng(rng).choice(s_u2p[3][0], size=sample_size,
+                                    replace=False)
+        sample = select_users(s_u2p, pilot)
+        query = stack_queries(get_random_points(pl, sample,
+                                                fast=fast_sampling, rng=rng))
+        counts = step_match_counts(s_u2p, [query], pl, cs)
+        label = np.zeros(s_u2p[3][0], dtype=int)
+        for h, m in enumerate(members):
+            label[m] = h
+        sd = np.zeros(len(members))
+        npilot = np.bincount(label[pilot], minlength=len(members))
+        for point in pl:
+            unique = counts[point][0] == 1
+            # Jeffreys estimate, so that no stratum is left out because its
+            # pilot users were all unique
+            p_h = (np.bincount(label[pilot], weights=unique,
+                               minlength=len(members)) + 0.5) / (npilot + 1)
+            sd += np.sqrt(p_h * (1 - p_h)) / len(pl)
+    else:
+        assert allocation == 'proportional', \
+            'Unknown allocation {}'.format(allocation)
+    return members, allocate_sample(members, weights, sample_size, sd), \
+        weights
+
+
 def begin_unicity_series(max_size, step, sample_size, inputs,
                          pl=[2, 3, 4, 5], cs=int(1e4), sgs=10, seed=None,
-                         autosave=False, verbose=False):
+                         autosave=False, verbose=False, cluster_bank=None,
+                         fast_sampling=False, run='tmp', resolutions=None,
+                         pipeline=0, nproc=0, legacy_rng=False, sizes=None,
+                         cache=None, sink=None, nested=False):
     """computes the unicity from 'sample_size' to 'max_size' population in
     steps.
 
@@ -80,103 +260,893 @@ def begin_unicity_series(max_size, step, sample_size, inputs,
         - cs: int, chunk_size which represents the size of chunks for sparse
           matrices to be generated
         - sgs: int, the size of antenna clusters used for each user
-        - seed: int, seed for both numpy.random.seed and random.seed
-        - autosave: bool or str, if not False then after each loop a copy of the dataframe
-          is saved to the temporary folder autosave.
+        - seed: int, the seed of the random streams (see get_streams)
+        - autosave: bool or str, if not False then the results of each step
+          are appended to the store autosave/results.sqlite (see
+          results_store.ResultsStore) from a background thread.
         - verbose: bool, if true then display some information about the current
           status of the computation.
+        - cluster_bank: int or None, if given, clusters are drawn from a
+          pre-computed bank of this many clusters (see get_cluster_bank)
+          instead of being generated at each step. Each banked cluster is then
+          used max_size / cluster_bank times on average.
+        - fast_sampling: bool, if True the users and the sample points are
+          drawn in bulk with the samplers of sampling_utils, otherwise they
+          are drawn one user at a time with numpy.random.choice as in the
+          publication (the default). The fast samplers draw from the same
+          distributions, but not the same users for a given seed.
+        - run: str, name under which the results are saved when autosave is
+          set. Use results_store.load_results to read them back.
+        - resolutions: None or list of 2-tuples (ant_map, hour_map), see
+          dataformat_utils.coarsen_columns (None in the list stands for the
+          resolution of the model). If given, the unicity is computed at each
+          resolution from the same population: the antennas and hours of the
+          users and of the sample points are mapped to the coarser cells and
+          bins, and a sample matches the users holding all of its coarse
+          points.
+        - pipeline: int, if positive, the users of the next steps are
+          generated and split into sparse chunks by a background thread while
+          the current step is multiplied, at most 'pipeline' steps ahead (see
+          prefetch). The results are the same as without it.
+        - nproc: int, if positive, the steps are generated by this many
+          processes instead of a single thread. The results are the same as
+          without it.
+        - legacy_rng: bool, if True the global numpy.random and random
+          generators are seeded with seed and every draw is taken from them
+          in turn, as for the results of the publication. It implies
+          fast_sampling=False and the neighbour sets of the publication (see
+          geoloc_utils.get_geo_legacy), which the draws depend on. The
+          results then depend on nproc: with several processes each step
+          reseeds the global generators from its own seed.
+        - sizes: None or sorted list of ints, the population sizes at which
+          the unicity is computed, replacing the grid step, 2 * step, ...,
+          max_size (e.g. a log-spaced grid). The population grows by the
+          differences between consecutive sizes, generated in batches of at
+          most step users (see get_batches), and the samples are only
+          evaluated at these sizes. The samples are drawn from the users of
+          the first batches, so the first size must be at least sample_size.
+        - cache: population_cache.PopulationCache or None, if given the
+          users of each batch are read from the cache, or generated and
+          stored in it if they are not cached yet. The results are the same
+          as without it. Requires a seed and legacy_rng=False.
+        - sink: None or object with an append method such as
+          results_store.ResultsStore.append, to which the results of each
+          step are passed as soon as they are computed (see service.py)
+        - nested: bool, if True the sample points of every number of points
+          contain those of the smaller numbers of points (see
+          get_random_points). The population is then only multiplied by the
+          sample queries with the fewest points, and the larger ones are
+          evaluated on the users matching the smaller ones (see
+          dataformat_utils.nested_matches), which is several times faster.
+          The unicity for each number of points has the same distribution as
+          with independent points, but the results differ for a given seed.
 
     Outputs:
         - df: pandas.DataFrame() object which contains the results of the
           calculation. Each row represnts a population size while each column
           represnts the unicity for a particular number of points.
-          It is indexed by the population values.
+          It is indexed by the population values. If resolutions is given, a
+          list with one such dataframe per resolution is returned instead.
     -------
     AF
     """
-    if seed is not None:
-        np.random.seed(seed)
-        rnd.seed(seed)
+    dfs, _ = _unicity_series(max_size, step, sample_size, [inputs], pl, cs,
+                             sgs, seed, autosave, verbose, cluster_bank,
+                             fast_sampling, [run], shared=False,
+                             resolutions=resolutions, pipeline=pipeline,
+                             nproc=nproc, legacy_rng=legacy_rng, sizes=sizes,
+                             cache=cache, sink=sink, nested=nested)
+    return dfs if resolutions is not None else dfs[0]
+
+
+def begin_unicity_series_stratified(max_size, step, sample_size, inputs,
+                                    nstrata=5, allocation='proportional',
+                                    pl=[2, 3, 4, 5], cs=int(1e4), sgs=10,
+                                    seed=None, autosave=False, verbose=False,
+                                    cluster_bank=None, fast_sampling=False,
+                                    run='tmp', legacy_rng=False, sizes=None,
+                                    cache=None, nested=False):
+    """Same as begin_unicity_series, with samples stratified by activity.
+
+    Uniqueness depends strongly on activity, so drawing the sample users of
+    every step from strata of similar activity (see get_strata) and
+    reweighting the unicity of each stratum by its share of the population
+    (see stratified_estimate) reaches the precision of a uniform sample with
+    fewer sample users, provided that uniqueness varies between strata. The
+    proportional allocation is never less precise than a uniform sample,
+    while the Neyman allocation puts more of the sample in the strata whose
+    uniqueness varies the most, as estimated by a pilot (see
+    get_sample_strata). The report gives the variance reduction achieved.
+
+    Inputs:
+        - nstrata: int, the number of activity strata
+        - allocation: str, 'neyman' or 'proportional'
+        - all other inputs are the same as for begin_unicity_series.
+
+    Outputs:
+        - df: pandas.DataFrame(), see begin_unicity_series
+        - report: pandas.DataFrame() indexed by the population values, with
+          (number of points, 'se') columns holding the standard error of the
+          estimates and (number of points, 'deff') columns holding the ratio
+          of their variance to that of a uniform sample of the same size.
+          sample_size / deff is the size of the uniform sample with the same
+          precision.
+    -------
+    AF
+    """
+    dfs, reports = _unicity_series(max_size, step, sample_size, [inputs], pl,
+                                   cs, sgs, seed, autosave, verbose,
+                                   cluster_bank, fast_sampling, [run],
+                                   shared=False,
+                                   strata=(nstrata, allocation),
+                                   legacy_rng=legacy_rng, sizes=sizes,
+                                   cache=cache, nested=nested)
+    if verbose:
+        for point in pl:
+            print('{:d} points: mean variance ratio to a uniform sample '
+                  '{:.3f}'.format(point, reports[0][(point, 'deff')].mean()))
+    return dfs[0], reports[0]
+
+
+def begin_unicity_ensemble(max_size, step, sample_size, inputs, nrep,
+                           pl=[2, 3, 4, 5], cs=int(1e4), sgs=10, seed=None,
+                           autosave=False, verbose=False, cluster_bank=None,
+                           fast_sampling=False, quantiles=[0.05, 0.5, 0.95],
+                           run='tmp', legacy_rng=False, sizes=None,
+                           cache=None, nested=False):
+    """Computes 'nrep' replicates of a unicity series in one pass, to put
+    error bars on the unicity curve.
+
+    The replicates share the population and draw independent samples (users
+    and points) from it. Their sample queries are evaluated by a single
+    multiplication per population chunk, so that the population is generated
+    once for all replicates. The spread of the replicates is thus conditional
+    on the population and sample batch they share: it is the sampling error
+    of the estimates for that one population, and it understates the
+    variance between independent runs, which also draw a new population.
+
+    Inputs:
+        - nrep: int, number of replicates
+        - quantiles: list of floats, the quantiles of the replicates to return
+        - run: str, name under which the results are saved when autosave is
+          set. The replicates are told apart by their index in the store.
+        - all other inputs are the same as for begin_unicity_series.
+
+    Outputs:
+        - summary: pandas.DataFrame() indexed by the population values, with
+          a (number of points, statistic) column for the mean, standard
+          deviation and quantiles of the replicates
+        - dfs: list of the nrep pandas.DataFrame() of the replicates (see
+          begin_unicity_series)
+    -------
+    AF
+    """
+    dfs, _ = _unicity_series(max_size, step, sample_size, [inputs], pl, cs,
+                             sgs, seed, autosave, verbose, cluster_bank,
+                             fast_sampling, [run], shared=False, nrep=nrep,
+                             legacy_rng=legacy_rng, sizes=sizes, cache=cache,
+                             nested=nested)
+    return summarize_replicates(dfs, quantiles), dfs
+
+
+def summarize_replicates(dfs, quantiles=[0.05, 0.5, 0.95]):
+    """Computes the mean, standard deviation and quantiles of unicity series.
+
+    Inputs:
+        - dfs: list of pandas.DataFrame() returned by begin_unicity_series
+        - quantiles: list of floats, the quantiles to compute
+
+    Outputs:
+        - summary: pandas.DataFrame() with (number of points, statistic)
+          columns, see begin_unicity_ensemble
+    -------
+    AF
+    """
+    vals = np.stack([df.values for df in dfs])
+    stats = {}
+    for j, point in enumerate(dfs[0].columns):
+        stats[(point, 'mean')] = vals[:, :, j].mean(axis=0)
+        stats[(point, 'std')] = vals[:, :, j].std(axis=0, ddof=1) \
+            if len(dfs) > 1 else np.zeros(len(dfs[0]))
+        for q in quantiles:
+            stats[(point, 'q{:g}'.format(q))] = np.quantile(vals[:, :, j], q,
+                                                           axis=0)
+    return pd.DataFrame(stats, index=dfs[0].index)
+
+
+def begin_unicity_series_multi(max_size, step, sample_size, inputs_list,
+                               pl=[2, 3, 4, 5], cs=int(1e4), sgs=10,
+                               seed=None, autosave=False, verbose=False,
+                               cluster_bank=None, run='tmp', pipeline=0,
+                               nproc=0, legacy_rng=False, sizes=None,
+                               cache=None, nested=False):
+    """Computes the unicity series of several input distributions (e.g. the
+    configurations of the gridsearch) in a single pass over the population.
+    The clusters, the hours and the random numbers behind the activity and
+    frequency draws are generated once per step and shared by all the
+    configurations (see model_source.resampler_shared), as are the sample
+    users and points. Beyond saving the generation cost, using common random
+    numbers reduces the variance between the curves of different
+    configurations.
+
+    Inputs:
+        - inputs_list: list of 3-tuples of numpy arrays similar to the output
+          of get_input_dists(). They must all share the same circadian
+          distribution.
+        - run: str or list of str, the name under which the results of each
+          configuration are saved. If a single name is given, configurations
+          are told apart by their index in the store.
+        - all other inputs are the same as for begin_unicity_series.
+
+    Outputs:
+        - dfs: list of pandas.DataFrame() objects, one per element of
+          inputs_list (see begin_unicity_series)
+    -------
+    AF
+    """
+    return _unicity_series(max_size, step, sample_size, inputs_list, pl, cs,
+                           sgs, seed, autosave, verbose, cluster_bank, True,
+                           run, shared=True, pipeline=pipeline,
+                           nproc=nproc, legacy_rng=legacy_rng,
+                           sizes=sizes, cache=cache, nested=nested)[0]
+
+
+# inputs loaded at most once per process, so that long-running processes
+# (see service.py) keep them between series
+_LOADED = {}
+
+
+def _load_once(key, load, *args):
+    if key not in _LOADED:
+        _LOADED[key] = load(*args)
+    return _LOADED[key]
+
+
+def get_population_generator(inputs_list, step, sgs, cluster_bank=None,
+                             fast_sampling=False, shared=False,
+                             fprint=lambda *x, **y: None, legacy_geo=False):
+    """Loads everything needed to generate the population (antenna network,
+    cluster bank, samplers) and returns a function generating the users of
+    one step (or batch).
+
+    Inputs:
+        - inputs_list: list of 3-tuples of input distributions. Must contain
+          a single element unless shared is True.
+        - step: int, number of users generated at each call, unless the
+          call gives another one
+        - sgs, cluster_bank, fast_sampling: see begin_unicity_series
+        - shared: bool, if True the users of all configurations are generated
+          with common random numbers (see begin_unicity_series_multi)
+        - fprint: logging function
+        - legacy_geo: bool, if True the antenna network is loaded with
+          get_geo_legacy, as needed by legacy_rng (see begin_unicity_series)
+
+    Outputs:
+        - function returning a list with one output of resampler per
+          configuration. It takes optional col_map and rng arguments (see
+          resampler), and nusers, the number of users to generate.
+    -------
+    AF
+    """
+    # getting geographical inputs
+    fprint('Loading geographical inputs...')
+    if legacy_geo:
+        ana = _load_once('geo_legacy', get_geo_legacy, '../inputs/',
+                         'location_grid.txt')
+    else:
+        ana = _load_once('geo', get_geo, '../inputs/', 'location_grid.txt')
+
+    if cluster_bank:
+        fprint('Loading cluster bank...')
+        geo_csr = _load_once('geo_csr', get_geo_csr, '../inputs/',
+                             'location_grid.txt')
+        bank = _load_once(('bank', sgs, int(cluster_bank)), get_cluster_bank,
+                          geo_csr, sgs, int(cluster_bank))
+
+        def new_clusters(nusers, rng):
+            return draw_clusters(bank, nusers, rng=rng)
+    else:
+        def new_clusters(nusers, rng):
+            return create_cluster_array(nusers, sgs, ana, rng)
+
+    if shared:
+        time_sampler = build_sampler(inputs_list[0][2])
+
+        def new_population(col_map=None, rng=None, nusers=step):
+            return resampler_shared(nusers, new_clusters(nusers, rng),
+                                    inputs_list, ana, time_sampler, col_map,
+                                    rng)
+    else:
+        assert len(inputs_list) == 1
+        samplers = build_input_samplers(inputs_list[0]) \
+            if fast_sampling else None
+
+        def new_population(col_map=None, rng=None, nusers=step):
+            return [resampler(nusers, new_clusters(nusers, rng),
+                              inputs_list[0], ana, samplers, col_map, rng)]
+    return new_population
+
 
-    # Create the target folder, if needed.
+def get_batches(sizes, step):
+    """Splits the growth of the population between consecutive sizes into
+    batches of at most step users. Each increment is made of full batches
+    followed by the remaining users, so a grid of multiples of step gives one
+    batch per size.
+
+    Inputs:
+        - sizes: sorted list of ints, the population sizes
+        - step: int, the largest number of users generated at once
+
+    Outputs:
+        - batch_sizes: ndarray of ints, the number of users of each batch
+        - batch_steps: ndarray of ints, the index of the size that each batch
+          completes the population of
+    -------
+    AF
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    assert len(sizes) > 0 and sizes[0] > 0 and np.all(np.diff(sizes) > 0), \
+        'sizes must be positive and strictly increasing'
+    incs = np.diff(sizes, prepend=0)
+    nbatches = -(-incs // step)
+    batch_sizes = np.full(nbatches.sum(), step, dtype=np.int64)
+    batch_sizes[np.cumsum(nbatches) - 1] = incs - (nbatches - 1) * step
+    return batch_sizes, np.repeat(np.arange(len(sizes)), nbatches)
+
+
+def get_streams(seed, nsteps, nrep=1, nbatches=None):
+    """Spawns the independent random streams of a unicity series from a
+    single seed (see numpy.random.SeedSequence): one per population batch,
+    one per sample and one for the pilot of the strata. Every part of the series
+    draws from its own stream only, so the results do not depend on the
+    order in which the parts are computed nor on the process computing them,
+    and the stream of a step or sample does not depend on the number of
+    steps.
+
+    Inputs:
+        - seed: int or None, if None fresh entropy is drawn from the system
+        - nsteps: int, the number of steps
+        - nrep: int, the number of replicates
+        - nbatches: int or None, the number of population batches (see
+          get_batches), nsteps if None
+
+    Outputs:
+        - step_seqs: list of nbatches numpy.random.SeedSequence
+        - sample_seqs: list of nrep lists of nsteps numpy.random.SeedSequence
+        - pilot_seq: numpy.random.SeedSequence
+    -------
+    AF
+    """
+    nbatches = nsteps if nbatches is None else nbatches
+    steps, samples, pilot = np.random.SeedSequence(seed).spawn(3)
+    return steps.spawn(nbatches), \
+        [rep.spawn(nsteps) for rep in samples.spawn(nrep)], pilot
+
+
+def _unicity_series(max_size, step, sample_size, inputs_list, pl, cs, sgs,
+                    seed, autosave, verbose, cluster_bank, fast_sampling,
+                    run, shared, nrep=1, strata=None, resolutions=None,
+                    pipeline=0, nproc=0, legacy_rng=False, sizes=None,
+                    cache=None, sink=None, nested=False):
+    """Implementation of begin_unicity_series, begin_unicity_series_multi,
+    begin_unicity_ensemble and begin_unicity_series_stratified. When shared
+    is False, inputs_list must contain a single configuration. strata is None
+    or a 2-tuple (nstrata, allocation).
+
+    The population is generated in batches (see get_batches), and the
+    population of a batch is matched against the samples of the size it
+    completes and of the larger sizes.
+
+    Every configuration is evaluated at every resolution (None being the
+    resolution of the model), from the same population. The population is
+    projected onto the points whose image at some resolution is queried.
+
+    Returns a list of results dataframes and a list of reports (see
+    begin_unicity_series_stratified), with one element per configuration,
+    resolution and replicate, grouped by configuration then resolution.
+    -------
+    AF
+    """
+    if sizes is None:
+        sizes = np.arange(step, max_size + step, step)
+    pop_list = np.asarray(sizes, dtype=np.int32)
+    nsteps = len(pop_list)
+    batch_sizes, batch_steps = get_batches(pop_list, step)
+    nbatches = len(batch_sizes)
+    assert sample_size <= pop_list[0], \
+        'The samples must fit in the first population size'
+    # the samples are drawn from the first batches holding sample_size users
+    nfirst = int(np.searchsorted(np.cumsum(batch_sizes), sample_size)) + 1
+    first_starts = np.concatenate([[0], np.cumsum(batch_sizes[:nfirst])])
+
+    # the random streams of the batches, the samples and the pilot, None
+    # standing for the global generators. The draws of the publication are
+    # only reproduced with its samplers.
+    if legacy_rng:
+        fast_sampling = False
+        if seed is not None:
+            np.random.seed(seed)
+            rnd.seed(seed)
+        step_seqs, pilot_seq = [None] * nbatches, None
+    else:
+        step_seqs, sample_seqs, pilot_seq = get_streams(seed, nsteps, nrep,
+                                                        nbatches)
+
+    def stream(seq):
+        return None if seq is None else np.random.default_rng(seq)
+
+    # the users of a batch only depend on its stream and size and on what
+    # goes into pop_key
+    if cache is not None:
+        assert seed is not None and not legacy_rng, \
+            'The population cache needs the random streams of a seed'
+        pop_key = cache.key(*[dist for inputs in inputs_list
+                              for dist in inputs],
+                            _load_once('geo_hash', file_hash,
+                                       '../inputs/location_grid.txt'), sgs,
+                            cluster_bank, fast_sampling, shared)
+        cache_start = cache.stats()
+
+    # the publication reseeded numpy.random with the sample seeds after
+    # every step, so the users of every later step were drawn from the state
+    # left by the last sample (see legacy_state below)
+    legacy_state = None
+
+    def generate(bbb, col_map=None):
+        if legacy_state is not None and bbb > 0:
+            np.random.set_state(legacy_state)
+        rng = stream(step_seqs[bbb])
+        if cache is None:
+            return new_population(col_map, rng, batch_sizes[bbb])
+        seq = step_seqs[bbb]
+        key = cache.key(pop_key, seq.entropy, seq.spawn_key,
+                        int(batch_sizes[bbb]))
+        u2ps = cache.get(key)
+        if u2ps is None:
+            u2ps = new_population(None, rng, batch_sizes[bbb])
+            cache.put(key, u2ps)
+        if col_map is None:
+            return u2ps
+        return [project_u2p(u2p, col_map) for u2p in u2ps]
+
+    # Create the target folder and the results store, if needed.
+    store = None
     if autosave:
         if not os.path.exists(autosave):
             os.mkdir(autosave)
+        store = ResultsStore(os.path.join(autosave, 'results.sqlite'))
+    if isinstance(run, str):
+        run = [run] * len(inputs_list)
+    sinks = [target for target in [store, sink] if target is not None]
 
     fprint = print if verbose else lambda *x, **y: None  # Logging function
 
-    # getting geographical inputs
-    fprint('Loading geographical inputs...')
-    ana = get_geo('../inputs/', 'location_grid.txt')
-
+    new_population = get_population_generator(
+        inputs_list, step, sgs, cluster_bank, fast_sampling, shared, fprint,
+        legacy_rng)
+    if cluster_bank:
+        fprint('Cluster reuse rate: {:.2f}'.format(max_size / cluster_bank))
 
     # generating the first step
     fprint('Generating clusters...')
-    carr = create_cluster_array(step, sgs, ana)
-    s_u2p = resampler(step, carr, inputs, ana)
+    s_u2ps = generate(0)
+    if nfirst > 1:
+        s_u2ps = [concat_u2p(u2ps) for u2ps in zip(
+            s_u2ps, *[generate(bbb) for bbb in range(1, nfirst)])]
 
-    pop_list = np.arange(step, max_size + step, step, dtype=np.int32)
-    nsteps = len(pop_list)
+    # splitting the samples between strata of activity, a uniform sample is
+    # a single stratum
+    if strata is not None:
+        fprint('Stratifying the samples...')
+        strata_list = [get_sample_strata(s_u2p, sample_size, pl, cs, *strata,
+                                         fast_sampling, stream(pilot_seq))
+                       for s_u2p in s_u2ps]
+    else:
+        strata_list = [(None, np.array([sample_size]), np.ones(1))] * \
+            len(s_u2ps)
 
-    # generating the samples
-    sample_seeds = np.random.permutation(nsteps)
+    # generating the samples, the queries of the replicates of a step are
+    # evaluated together
+    if legacy_rng:
+        sample_seeds = np.random.permutation(nsteps * nrep).reshape(nrep,
+                                                                    nsteps)
+    else:
+        sample_seeds = sample_seqs
+    queries_list = []
+    for s_u2p, (members, scounts, _) in zip(s_u2ps, strata_list):
+        rep_queries = [get_sample_queries(
+            s_u2p, seeds, sample_size, pl, fast_sampling,
+            None if members is None else (members, scounts), nested)
+            for seeds in sample_seeds]
+        queries_list.append([hstack_queries(list(step_queries))
+                             for step_queries in zip(*rep_queries)])
+    if legacy_rng and nproc == 0:
+        legacy_state = np.random.get_state()
+    # the queries of every configuration at every resolution
+    resolutions = [None] if resolutions is None else resolutions
+    views = [(ind, res) for ind in range(len(inputs_list))
+             for res in resolutions]
+    npoints = s_u2ps[0][3][1]
+    lants = npoints // len(inputs_list[0][2])
+    view_queries = [queries_list[ind] if res is None else
+                    [coarsen_query(q, res, lants) for q in queries_list[ind]]
+                    for ind, res in views]
 
-    # creating the results dataframe
-    vals = np.zeros((len(pl), nsteps))
-    inputdict = dict(zip(pl, vals))
-    df = pd.DataFrame(inputdict)
-    df = df.set_index(pop_list)
+    # the last step in which each space-time point is queried, at the
+    # resolution of each view and at the resolution of the model
+    view_last_use = [query_last_use([queries]) for queries in view_queries]
+    last_use = np.full(npoints, -1, dtype=np.int32)
+    for (_, res), v_last_use in zip(views, view_last_use):
+        if res is not None:
+            v_last_use = v_last_use[coarsen_columns(
+                np.arange(npoints, dtype=np.int32), res, lants)]
+        last_use = np.maximum(last_use, v_last_use)
 
-    # creating the housing for the colsums
-    colsum_dict = {}
-    for point in pl:
-        colsum_dict[point] = np.zeros((nsteps, sample_size))
+    # creating the results dataframes
+    dfs = []
+    reports = []
+    for _ in range(len(views) * nrep):
+        vals = np.zeros((len(pl), nsteps))
+        inputdict = dict(zip(pl, vals))
+        df = pd.DataFrame(inputdict)
+        dfs.append(df.set_index(pop_list))
+        reports.append(pd.DataFrame(
+            np.zeros((nsteps, 2 * len(pl))), index=pop_list,
+            columns=pd.MultiIndex.from_product([pl, ['se', 'deff']])))
 
-    for iii in range(nsteps):
+    # creating the housing for the colsums
+    colsum_dicts = []
+    for _ in views:
+        colsum_dict = {}
+        for point in pl:
+            colsum_dict[point] = np.zeros((nsteps, nrep * sample_size))
+        colsum_dicts.append(colsum_dict)
 
-        fprint('\rStep %d/%d...' % (iii+1,nsteps), end='')
+    def prepare(bbb):
+        # only the points queried from now on are kept
+        iii = batch_steps[bbb]
+        col_map, q_rows = get_projection(last_use, iii)
 
-        # if it's the first one make sure to not regenerate
-        if iii != 0:
-            carr = create_cluster_array(step, sgs, ana)
-            u2p = resampler(step, carr, inputs, ana)
+        # the first batches hold the samples, make sure to not regenerate
+        if bbb >= nfirst:
+            u2ps = generate(bbb, col_map)
+        elif nfirst == 1:
+            u2ps = [project_u2p(s_u2p, col_map) for s_u2p in s_u2ps]
         else:
-            u2p = s_u2p
+            users = np.arange(first_starts[bbb], first_starts[bbb + 1])
+            u2ps = [project_u2p(select_users(s_u2p, users), col_map)
+                    for s_u2p in s_u2ps]
 
-        ml = chunkify_mat_list(u2p, cs)
-        sml = sparsify_mat_list(ml)
+        chunks = []
+        for (ind, res), v_last_use in zip(views, view_last_use):
+            u2p, v_rows = u2ps[ind], q_rows
+            if res is not None:
+                v_map, v_rows = get_projection(v_last_use, iii)
+                u2p = project_u2p(coarsen_u2p(u2p, res, lants, q_rows),
+                                  v_map)
+            chunks.append((sparsify_mat_list(chunkify_mat_list(u2p, cs)),
+                           v_rows))
+        return chunks
 
-        for jjj in range(iii, nsteps):
-            sample = get_sample(s_u2p, sample_size, sample_seeds[jjj])
-            smats = get_random_points(pl, sample, sample_seeds[jjj])
-            ps = vstack_multiply(sml, smats)
+    # with several processes and the global generators, each batch reseeds
+    # them from its own seed
+    step_seeds = np.random.randint(2 ** 31 - 1, size=nbatches) \
+        if nproc > 0 and legacy_rng else None
 
-            # computing the unicity
-            for point in pl:
-                csum = ps[point] / point
-                csum = csum.floor()
-                csum = csum.sum(axis=0)
-                colsum_dict[point][jjj] += np.array(csum)[0]
+    stats = {}
+    start = time.time()
+    try:
+        for bbb, chunks in enumerate(prefetch(prepare, nbatches, pipeline,
+                                              stats, nproc, step_seeds)):
+            iii = batch_steps[bbb]
 
-        for point in pl:
-            u = np.count_nonzero(colsum_dict[point][iii] == 1) / sample_size
-            df[point].loc[pop_list[iii]] = u
-        if autosave:
-            df.to_csv(os.path.join(autosave, 'tmp.csv'))
+            fprint('\rStep %d/%d...' % (iii+1,nsteps), end='')
+
+            for (sml, v_rows), queries, colsum_dict in zip(
+                    chunks, view_queries, colsum_dicts):
+                counts = chunk_match_counts(sml, queries[iii:], pl, v_rows,
+                                            nested)
+                for point in pl:
+                    colsum_dict[point][iii:] += counts[point]
+            del chunks
+
+            # the population of this size is not complete yet
+            if bbb + 1 < nbatches and batch_steps[bbb + 1] == iii:
+                continue
+
+            for ind, colsum_dict in enumerate(colsum_dicts):
+                _, scounts, weights = strata_list[views[ind][0]]
+                for point in pl:
+                    unique = colsum_dict[point][iii].reshape(
+                        nrep, sample_size) == 1
+                    u, var = stratified_estimate(unique, scounts, weights)
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        deff = var / (u * (1 - u) / (sample_size - 1))
+                    for rep in range(nrep):
+                        dfs[ind * nrep + rep].loc[pop_list[iii], point] = \
+                            u[rep]
+                        report = reports[ind * nrep + rep]
+                        report.loc[pop_list[iii], (point, 'se')] = \
+                            np.sqrt(var[rep])
+                        report.loc[pop_list[iii], (point, 'deff')] = deff[rep]
+                for target in sinks:
+                    for rep in range(nrep):
+                        target.append(run[views[ind][0]], ind * nrep + rep,
+                                      iii, pop_list[iii],
+                                      dfs[ind * nrep + rep].loc[
+                                          pop_list[iii]].to_dict())
+    finally:
+        if store is not None:
+            store.close()
 
     fprint('\nDone!')
-    return df
+    wall = time.time() - start
+    fprint('Generation {:.1f} s, multiplication {:.1f} s, wall {:.1f} s, '
+           'waiting for generation {:.1f} s'.format(
+               stats['produce'], stats['consume'], wall, stats['wait']))
+    if pipeline > 0 or nproc > 0:
+        fprint('Overlap efficiency: {:.0%}'.format(pipeline_overlap(stats,
+                                                                    wall)))
+    if cache is not None:
+        used = {k: v - cache_start[k] for k, v in cache.stats().items()}
+        fprint('Population cache: {:d} hits, {:d} misses, {:.1f} MB read, '
+               '{:.1f} MB written, {:d} evictions'.format(
+                   used['hits'], used['misses'], used['bytes_read'] / 1e6,
+                   used['bytes_written'] / 1e6, used['evictions']))
+    return dfs, reports
+
+
+# the producer of the running prefetch, inherited by the forked workers
+_PREFETCH = {}
+
+
+def _prefetch_task(iii):
+    if _PREFETCH['seeds'] is not None:
+        seed = _PREFETCH['seeds'][iii]
+        np.random.seed(seed)
+        rnd.seed(int(seed))
+    t0 = time.time()
+    item = _PREFETCH['produce'](iii)
+    return item, time.time() - t0
+
+
+def prefetch(produce, nitems, depth, stats=None, nproc=0, seeds=None):
+    """Yields produce(0), ..., produce(nitems - 1) in order. If depth is
+    positive, the items are produced by a background thread while the caller
+    consumes the previous ones, at most 'depth' items ahead: the thread waits
+    when the queue is full, so that at most depth + 2 items (queued, being
+    produced and being consumed) are in memory at once. Items are produced in
+    order by a single thread, so the random draws happen in the same order as
+    without a thread.
+
+    If nproc is positive, the items are produced by a pool of forked
+    processes instead, at most max(depth, nproc) items ahead of the caller.
+    If seeds is given, the global random generators are seeded with seeds[i]
+    before producing item i, so that the items do not depend on the process
+    producing them.
+
+    Inputs:
+        - produce: function of the item index
+        - nitems: int, the number of items
+        - depth: int, the size of the queue, 0 to produce the items in the
+          calling thread
+        - stats: dict or None, filled with the time spent producing
+          ('produce') and consuming ('consume') items, and waiting for them
+          ('wait')
+        - nproc: int, number of producing processes
+        - seeds: ndarray of ints or None, the seed of each item when
+          nproc > 0
+
+    Outputs:
+        - generator of the items
+    -------
+    AF
+    """
+    stats = {} if stats is None else stats
+    stats.update(produce=0., consume=0., wait=0.)
+    if nproc > 0:
+        _PREFETCH.update(produce=produce, seeds=seeds)
+        pool = mp.get_context('fork').Pool(nproc)
+        ahead = max(depth, nproc)
+        pending = deque()
+        try:
+            for iii in range(nitems):
+                while len(pending) < ahead and iii + len(pending) < nitems:
+                    pending.append(pool.apply_async(
+                        _prefetch_task, (iii + len(pending),)))
+                t0 = time.time()
+                item, elapsed = pending.popleft().get()
+                stats['wait'] += time.time() - t0
+                stats['produce'] += elapsed
+                t0 = time.time()
+                yield item
+                del item
+                stats['consume'] += time.time() - t0
+        finally:
+            pool.terminate()
+            _PREFETCH.clear()
+        return
+
+    if depth <= 0:
+        for iii in range(nitems):
+            t0 = time.time()
+            item = produce(iii)
+            stats['produce'] += time.time() - t0
+            t0 = time.time()
+            yield item
+            stats['consume'] += time.time() - t0
+        return
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def worker():
+        try:
+            for iii in range(nitems):
+                t0 = time.time()
+                item = produce(iii)
+                stats['produce'] += time.time() - t0
+                put((item, None))
+                del item
+        except BaseException as err:
+            put((None, err))
+
+    threading.Thread(target=worker, daemon=True).start()
+    try:
+        for _ in range(nitems):
+            t0 = time.time()
+            item, err = items.get()
+            stats['wait'] += time.time() - t0
+            if err is not None:
+                raise err
+            t0 = time.time()
+            yield item
+            del item
+            stats['consume'] += time.time() - t0
+    finally:
+        stop.set()
 
 
-def get_random_points(pl, sample, seed=None):
+def pipeline_overlap(stats, wall):
+    """Share of the shorter of production and consumption (see prefetch)
+    which was hidden behind the other one: 0 when they ran one after the
+    other, 1 when they fully overlapped.
+    -------
+    AF
+    """
+    shorter = min(stats['produce'], stats['consume'])
+    if shorter == 0:
+        return 0.
+    return min(max((stats['produce'] + stats['consume'] - wall) / shorter,
+                   0.), 1.)
+
+
+def get_sample_queries(s_u2p, sample_seeds, sample_size, pl, fast_sampling,
+                       strata=None, nested=False):
+    """Draws the sample and the sample points of every step.
+
+    Inputs:
+        - s_u2p: 5-tuple, output of resampler, the users from which the
+          samples are drawn
+        - sample_seeds: ndarray of ints, the seed of the sample of each step
+          for the global generators, or list of numpy.random.SeedSequence,
+          the stream of the sample of each step (see get_streams)
+        - sample_size, pl, fast_sampling: see begin_unicity_series
+        - strata: None or 2-tuple (members, counts), if given the samples are
+          stratified (see get_stratified_sample)
+        - nested: bool, see get_random_points
+
+    Outputs:
+        - list with one output of dataformat_utils.stack_queries per step
+    -------
+    AF
+    """
+    queries = []
+    for seed in sample_seeds:
+        rng = None
+        if isinstance(seed, np.random.SeedSequence):
+            rng, seed = np.random.default_rng(seed), None
+        if strata is None:
+            sample = get_sample(s_u2p, sample_size, seed, rng)
+        else:
+            sample = get_stratified_sample(s_u2p, *strata, seed, rng)
+        smats = get_random_points(pl, sample, seed, fast_sampling, rng,
+                                  nested)
+        queries.append(stack_queries(smats))
+    return queries
+
+
+def step_match_counts(u2p, queries, pl, cs, q_rows=None, nested=False):
+    """Counts, for the sample queries of several steps, the number of users of
+    one step of the population that match each sample query.
+
+    Inputs:
+        - u2p: 5-tuple, output of resampler, the users generated at this step
+        - queries: list of outputs of stack_queries, the queries to evaluate
+        - pl, cs: see begin_unicity_series
+        - q_rows: ndarray or None, if u2p was projected (see get_projection),
+          the rows of the queries which correspond to its columns
+        - nested: bool, if True the queries are those of nested point sets
+          (see get_random_points) and are evaluated with
+          dataformat_utils.nested_matches
+
+    Outputs:
+        - counts: dict with keys being the number of points and values being
+          ndarrays of shape (len(queries), number of query columns with this
+          number of points)
+    -------
+    AF
+    """
+    ml = chunkify_mat_list(u2p, cs)
+    sml = sparsify_mat_list(ml)
+    return chunk_match_counts(sml, queries, pl, q_rows, nested)
+
+
+def chunk_match_counts(sml, queries, pl, q_rows=None, nested=False):
+    """Same as step_match_counts, for a population which is already split
+    into sparse chunks.
+
+    Inputs:
+        - sml: list of scipy.sparse.csr_matrix(), output of sparsify_mat_list
+        - queries, pl, q_rows, nested: see step_match_counts
+
+    Outputs:
+        - counts: see step_match_counts
+    -------
+    AF
+    """
+    counts = {}
+    for ind, (query, colk) in enumerate(queries):
+        if q_rows is not None:
+            # the points of these queries are all kept by the projection
+            query = sps.csc_matrix(
+                (query.data, np.searchsorted(q_rows, query.indices),
+                 query.indptr), shape=(len(q_rows), query.shape[1]))
+        if nested:
+            matches = nested_matches(sml, query, colk)
+        else:
+            matches = multiply_matches(sml, query, colk)
+        for point in pl:
+            if ind == 0:
+                counts[point] = np.zeros(
+                    (len(queries), np.count_nonzero(colk == point)),
+                    dtype=np.int32)
+            counts[point][ind] = matches[colk == point]
+    return counts
+
+
+def get_random_points(pl, sample, seed=None, fast=False, rng=None,
+                      nested=False):
     """Samples a fix number of rows from a population. From each row, it samples
     a fixed number of points.
 
+    With nested, the points of a row are drawn once, in a random order, and
+    the set of k points is made of the first k of them, so that it contains
+    the sets of fewer points. Each set is still a uniformly drawn set of k
+    distinct points of the row, as the first k of a random permutation are,
+    so the unicity for each number of points has the same distribution as
+    with independent draws. Only the estimates for different numbers of
+    points become dependent through their shared points (and can no longer
+    decrease with the number of points for a given sample), which matters
+    when they are compared to each other, not for each of them.
+
     Inputs:
         - pl: list of ints, specifies the number of points to be sampled from
           each row
         - sample: 5-tuple returned by resampler
-        - seed: int, seed for the numpy random number generator
+        - seed: int, seed for the global numpy random number generator
+        - fast: bool, if True the points of all rows are drawn at once (see
+          sampling_utils.draw_from_segments)
+        - rng: see get_sample
+        - nested: bool, if True the sets of points are nested, see above
 
     Outputs:
         - smats: a dict of scipy.sparse.csr_matrix() objects containing the
@@ -189,6 +1159,22 @@ def get_random_points(pl, sample, seed=None):
         np.random.seed(seed)
     data, rows, cols, shape, rand_acts = sample
     n, p = shape
+    rng = get_rng(rng)
+    if fast:
+        smats = {}
+        if nested:
+            drawn = draw_from_segments(rand_acts, max(pl), rng).reshape(n, -1)
+        for cp in pl:
+            if nested:
+                currows = cols[drawn[:, :cp].ravel()]
+            else:
+                currows = cols[draw_from_segments(rand_acts, cp, rng)]
+            currcols = np.repeat(np.arange(n, dtype=np.int32), cp)
+            smats[cp] = sps.csr_matrix(
+                (np.ones(n * cp, dtype=np.int8), (currows, currcols)),
+                shape=(p, n))
+        return smats
+
     smat_list = defaultdict(list)
     for cp in pl:
         smat_list[cp].append(np.ones(n * cp, dtype=np.int8))  # data
@@ -202,9 +1188,15 @@ def get_random_points(pl, sample, seed=None):
     for uid in range(n):
         a = rand_acts[uid]
         start = col_starts[uid]
+        if nested:
+            drawn = rng.choice(cols[start - a:start], size=max(pl),
+                               replace=False)
         for cp in pl:
-            currows = np.random.choice(cols[start - a:start], size=cp,
-                                       replace=False)
+            if nested:
+                currows = drawn[:cp]
+            else:
+                currows = rng.choice(cols[start - a:start], size=cp,
+                                     replace=False)
             currcols = uid * smat_list[cp][2][currind[cp]:currind[cp] + cp]
             smat_list[cp][1][currind[cp]:currind[cp] + cp] = currows
             smat_list[cp][2][currind[cp]:currind[cp] + cp] = currcols
@@ -237,7 +1229,8 @@ def check_unique(pop, pset, p2u):
     return int(len(pop) == 1)
 
 
-def get_sample_and_pop(alluserids, smin, smax, step, sample_size=int(1e4)):
+def get_sample_and_pop(alluserids, smin, smax, step, sample_size=int(1e4),
+                       rng=None):
     """This is a helper function that generates 1) a list of sets of increasing
     size containing population user IDs, 2) a list of sets each containing 10K
     user IDs which are the samples and, 3) a numpy array containing the sizes
@@ -249,6 +1242,7 @@ def get_sample_and_pop(alluserids, smin, smax, step, sample_size=int(1e4)):
         - smax: int, the size of the largest population sample to be chosen
         - step: int, the step size from smin to smax for generating populations
         - sample_size, int, the size of the sample for computing unicity
+        - rng: numpy.random.Generator or None, see sampling_utils.get_rng
 
     Outputs:
         - pop_ids: list, a list of sets of increasing size each containing user
@@ -261,17 +1255,19 @@ def get_sample_and_pop(alluserids, smin, smax, step, sample_size=int(1e4)):
     AF
     """
     sizes = np.arange(smin, smax, step, dtype=int)  # inclusive edges
+    rng = get_rng(rng)
     pop_ids = []
     sample_ids = []
     for s in tq(sizes):
-        pop = np.random.choice(alluserids, size=s, replace=False)
-        samp = np.random.choice(pop, size=sample_size, replace=False)
+        pop = rng.choice(alluserids, size=s, replace=False)
+        samp = rng.choice(pop, size=sample_size, replace=False)
         pop_ids.append(set(pop))
         sample_ids.append(set(samp))
     return pop_ids, sample_ids, sizes
 
 
-def compute_unicity(u2p, p2u, popids, sampids, point_list=[2, 3, 4, 5]):
+def compute_unicity(u2p, p2u, popids, sampids, point_list=[2, 3, 4, 5],
+                    rng=None):
     """This computes the unicity for a given population size for varying
     numbers of points of side information (defualt being [2, 3, 4, 5]).
 
@@ -284,6 +1280,7 @@ def compute_unicity(u2p, p2u, popids, sampids, point_list=[2, 3, 4, 5]):
         - sampids: list, a sample of size 10K from popids
         - point_list: list, a list of points representing the number of points
                       used as side information in the unicity computation
+        - rng: numpy.random.Generator or None, see sampling_utils.get_rng
 
     Outputs:
         - res: list, the same size as point_list, contains unicity values
@@ -291,32 +1288,111 @@ def compute_unicity(u2p, p2u, popids, sampids, point_list=[2, 3, 4, 5]):
     -------
     AF
     """
+    rng = get_rng(rng)
     res = np.zeros(len(point_list))
     for i, npoints in enumerate(point_list):
         for uid in sampids:
             trace = u2p[uid]
-            pset = set(np.random.choice(trace, size=npoints, replace=False))
+            pset = set(rng.choice(trace, size=npoints, replace=False))
             res[i] += check_unique(popids, pset, p2u)
     return res
 
 
+def get_nested_sample(alluserids, smin, smax, step, sample_size=int(1e4),
+                      rng=None):
+    """Nested version of get_sample_and_pop: the populations are the prefixes
+    of a single random permutation of the users, and a single sample is drawn
+    from the smallest population so that it belongs to all of them.
+
+    Inputs:
+        - see get_sample_and_pop. sample_size must not exceed smin.
+
+    Outputs:
+        - rank: dict, the position of each user id in the permutation. The
+                population of size s is made of the users of rank < s.
+        - sample_ids: list, the user ids of the sample
+        - sizes: numpy array, an array of integers containing the population
+                 sizes
+    -------
+    AF
+    """
+    sizes = np.arange(smin, smax, step, dtype=int)  # inclusive edges
+    assert sample_size <= sizes[0], \
+        'The sample must fit in the smallest population'
+    rng = get_rng(rng)
+    perm = rng.permutation(len(alluserids))
+    rank = {alluserids[j]: r for r, j in enumerate(perm)}
+    samp = rng.choice(perm[:sizes[0]], size=sample_size, replace=False)
+    return rank, [alluserids[j] for j in samp], sizes
+
+
+def compute_unicity_nested(u2p, p2u, rank, sampids, sizes,
+                           point_list=[2, 3, 4, 5], rng=None):
+    """Computes the number of unique sample users in every nested population
+    at once. Each sample query is matched once against all users, and the
+    number of matching users in the population of size s is the number of
+    them with a rank below s, found by bisection. The cost is thus that of the
+    largest population alone.
+
+    Inputs:
+        - u2p, p2u, point_list, rng: see compute_unicity
+        - rank, sampids, sizes: output of get_nested_sample
+
+    Outputs:
+        - res: numpy array of shape (len(sizes), len(point_list)), the number
+               of unique sample users for each population size and number of
+               points
+    -------
+    AF
+    """
+    rng = get_rng(rng)
+    res = np.zeros((len(sizes), len(point_list)))
+    for i, npoints in enumerate(point_list):
+        for uid in sampids:
+            trace = u2p[uid]
+            pset = set(rng.choice(trace, size=npoints, replace=False))
+            # intersect starting from the least visited point
+            users = sorted((p2u[p] for p in pset), key=len)
+            matches = set(users[0]).intersection(*users[1:])
+            ranks = np.sort(np.fromiter((rank[m] for m in matches),
+                                        dtype=np.int64, count=len(matches)))
+            res[:, i] += np.searchsorted(ranks, sizes) == 1
+    return res
+
+
 def compute_unicity_series_raw(u2p, p2u, smin, smax, step,
-                               sample_size=int(1e4), point_list=[2, 3, 4, 5]):
+                               sample_size=int(1e4), point_list=[2, 3, 4, 5],
+                               nested=False, rng=None):
     """This function is a wrapper for running get_sample_and_pop and
     compute_unicity (defined above) in series and so the docstring is ommitted
     as the variable names are identicle.
+
+    If nested is True, the populations are nested and share one sample (see
+    get_nested_sample and compute_unicity_nested), which costs about as much
+    as computing the unicity of the largest population alone. All draws are
+    taken from rng (see sampling_utils.get_rng).
     -------
     AF
     """
     alluserids = list(u2p.keys())
+    if nested:
+        print('getting samples')
+        rank, sampids, index = get_nested_sample(
+            alluserids, smin, smax, step, sample_size, rng)
+        print('computing unicity')
+        res = compute_unicity_nested(u2p, p2u, rank, sampids, index,
+                                     point_list, rng)
+        return pd.DataFrame(data=res / sample_size, index=index,
+                            columns=point_list)
     print('getting samples')
     popids, sampids, index = get_sample_and_pop(
-        alluserids, smin, smax, step, sample_size)
+        alluserids, smin, smax, step, sample_size, rng)
     print('computing unicity')
     resdf = pd.DataFrame(data=np.zeros(
         shape=(len(popids), len(point_list))), index=index, columns=point_list)
     for i in tq(range(len(index))):
-        nunique = compute_unicity(u2p, p2u, popids[i], sampids[i], point_list)
+        nunique = compute_unicity(u2p, p2u, popids[i], sampids[i], point_list,
+                                  rng)
         unicity = nunique / sample_size
         resdf.loc[index[i], :] = unicity
     return resdf